@@ -1,13 +1,60 @@
 import asyncio
+import concurrent.futures
+import contextvars
 import logging
 import functools
+import sys
+import threading
+import time
+import traceback
 
-async def run_in_loop_executor(func, *args, **kwargs):
+from .ratelimit import get_rate_limiter, is_throttling_error
+
+__all__ = [
+    'LoopWatchdog',
+    'run_in_api_executor',
+    'run_in_loop_executor',
+    'run_with_retries',
+    'start_loop_watchdog'
+]
+
+async def _run_in_executor(executor, func, args, kwargs):
     loop = asyncio.get_running_loop()
     func = functools.partial(func, *args, **kwargs)
-    return await loop.run_in_executor(None, func)
+    # run in copy of current context, so that context variables (e.g. the
+    # AWS profile and region) are visible in the executor thread
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(executor, ctx.run, func)
+
+async def run_in_loop_executor(func, *args, **kwargs):
+    return await _run_in_executor(None, func, args, kwargs)
+
+# Rate limited AWS API calls (see afaws.ratelimit) block their threads while
+# waiting for tokens, so they get their own executor, rather than tying up
+# the loop's default executor, which SSH, S3 transfers, etc. use
+API_EXECUTOR_MAX_WORKERS = 32
+_api_executor = None
+_api_executor_lock = threading.Lock()
+
+def _get_api_executor():
+    global _api_executor
+    with _api_executor_lock:
+        if _api_executor is None:
+            _api_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=API_EXECUTOR_MAX_WORKERS,
+                thread_name_prefix='afaws-api')
+        return _api_executor
+
+async def run_in_api_executor(func, *args, **kwargs):
+    """Like run_in_loop_executor, but for EC2 and ELB API calls, including
+    paginators, waiters, and resource actions, which may be rate limited
+    """
+    return await _run_in_executor(_get_api_executor(), func, args, kwargs)
 
 RETRY_WAIT = 10
+# Throttled calls are retried sooner, since the rate limiter (see
+# afaws.ratelimit) will have reduced the rate at which they're made
+THROTTLING_RETRY_WAIT = 1
 MAX_ATTEMPTS = (60 / RETRY_WAIT) * 5 # retry for up to 5 minutes
 async def run_with_retries(func, args, kwargs, is_async, exception_to_raise,
         extra_exception_args=[], exceptions_whitelist=None,
@@ -36,6 +83,85 @@ async def run_with_retries(func, args, kwargs, is_async, exception_to_raise,
                     max_attempts)
                 raise exception_to_raise(str(e), *extra_exception_args)
 
+            wait = retry_wait
+            if is_throttling_error(e) and get_rate_limiter().enabled:
+                wait = min(retry_wait, THROTTLING_RETRY_WAIT)
             logging.info("%s - Failed. Waiting %s seconds before retrying",
-                log_msg_prefix, retry_wait)
-            await asyncio.sleep(retry_wait)
+                log_msg_prefix, wait)
+            await asyncio.sleep(wait)
+
+
+class LoopWatchdog(object):
+    """Reports callbacks that block the event loop for longer than a
+    threshold, since a blocking call (e.g. a boto3 call made directly in a
+    coroutine) stalls every other task - concurrent ssh sessions, AWS calls,
+    etc. - for its duration.
+
+    The loop updates a heartbeat every threshold / 2 seconds, and a
+    watchdog thread checks it. When the heartbeat is late, the loop thread's
+    current stack, which includes the blocking call, is logged as a
+    warning, and, once the loop resumes, so is the stall's duration.
+    """
+
+    def __init__(self, loop=None, threshold=0.1):
+        """
+        kwargs
+         - loop -- loop to watch; defaults to the running loop
+         - threshold -- seconds the loop may be blocked before reporting
+        """
+        self._loop = loop or asyncio.get_running_loop()
+        self._threshold = threshold
+        self._interval = threshold / 2
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._handle = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._loop.call_soon_threadsafe(self._beat)
+        self._thread = threading.Thread(target=self._watch,
+            name='afaws-loop-watchdog', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._handle:
+            self._handle.cancel()
+
+    def _beat(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        if not self._stopped.is_set():
+            self._handle = self._loop.call_later(self._interval, self._beat)
+
+    def _watch(self):
+        stall_start = None
+        while not self._stopped.wait(self._interval):
+            if self._loop.is_closed():
+                return
+            heartbeat = self._heartbeat
+            lag = time.monotonic() - heartbeat - self._interval
+            if lag > self._threshold:
+                if stall_start != heartbeat:
+                    # Only report each stall once
+                    stall_start = heartbeat
+                    logging.warning("Event loop blocked for over %.3fs in:\n%s",
+                        lag, self._loop_stack())
+            elif stall_start is not None:
+                logging.warning("Event loop was blocked for %.3fs",
+                    heartbeat - stall_start - self._interval)
+                stall_start = None
+
+    def _loop_stack(self):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return "  (stack unavailable)"
+        return ''.join(traceback.format_stack(frame))
+
+
+def start_loop_watchdog(threshold=0.1):
+    """Starts watching the running loop; see LoopWatchdog
+    """
+    return LoopWatchdog(threshold=threshold).start()
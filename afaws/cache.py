@@ -0,0 +1,187 @@
+"""Optional on-disk inventory cache, shared across script invocations.
+
+Describe responses (instances, images, security groups, load balancers,
+etc.) are stored in a SQLite database, by default under ~/.cache/afaws/,
+with a per-type TTL. Modules read through the cache with `get_cache()`:
+
+> cache = get_cache()
+> data = cache.get('Instance', key)
+> if data is None:
+>     data = ...
+>     cache.set('Instance', key, data)
+
+Reads and writes only happen if the cache is enabled (see `configure`).
+Lookups that mutating operations act on (e.g. the rules to revoke when
+cleaning up after terminated instances) are made within `bypass()`, which
+skips reads, so that they don't act on stale entries:
+
+> with bypass():
+>     groups = await SecurityGroup.all()
+
+Invalidation, which modules do after mutating operations (launch,
+shutdown, tagging, rule changes, etc.), applies to an existing cache
+database even if the cache isn't enabled for the current process, so that
+processes not using the cache don't leave stale entries for those that do.
+"""
+
+import contextlib
+import contextvars
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from .session import get_session
+
+__all__ = [
+    'InventoryCache',
+    'bypass',
+    'configure',
+    'get_cache'
+]
+
+# Set within bypass()
+_bypassed = contextvars.ContextVar('afaws_cache_bypassed', default=False)
+
+def _default_path():
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'afaws', 'inventory.sqlite')
+
+class InventoryCache(object):
+
+    # In seconds
+    DEFAULT_TTLS = {
+        'Instance': 300,
+        'Image': 3600,
+        'SecurityGroup': 600,
+        'ElbPool': 60,
+        'InstanceFacts': 900
+    }
+    DEFAULT_TTL = 300
+
+    def __init__(self, path=None, enabled=True, refresh=False, ttls=None,
+            enabled_kinds=None):
+        """
+        kwargs
+         - path -- sqlite database file; defaults to
+            ~/.cache/afaws/inventory.sqlite
+         - enabled -- whether to read from and write to the cache
+         - enabled_kinds -- types to read from and write to the cache even
+            if enabled is False; e.g. ['InstanceFacts']
+         - refresh -- if True, ignore existing entries, but still write
+            new ones
+         - ttls -- dict of TTLs (in seconds) keyed by type, overriding
+            DEFAULT_TTLS
+        """
+        self._path = path or _default_path()
+        self._enabled = enabled
+        self._enabled_kinds = set(enabled_kinds or [])
+        self._refresh = refresh
+        self._ttls = dict(self.DEFAULT_TTLS, **(ttls or {}))
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @property
+    def refresh(self):
+        return self._refresh
+
+    def is_enabled(self, kind):
+        return self._enabled or kind in self._enabled_kinds
+
+    def _connection(self, create=True):
+        if self._conn is None:
+            if not create and not os.path.exists(self._path):
+                return None
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            self._conn = sqlite3.connect(self._path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                "kind TEXT, key TEXT, value BLOB, expires REAL, "
+                "PRIMARY KEY (kind, key))")
+            self._conn.commit()
+        return self._conn
+
+    def _scoped_key(self, key):
+        # Entries are specific to AWS profile and region
+        session = get_session()
+        return '{}|{}|{}'.format(session.profile_name, session.region_name, key)
+
+    def get(self, kind, key):
+        if not self.is_enabled(kind) or self._refresh or _bypassed.get():
+            return None
+
+        key = self._scoped_key(key)
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value, expires FROM entries WHERE kind = ? AND key = ?",
+                (kind, key)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        logging.debug("Inventory cache hit: %s %s", kind, key)
+        return pickle.loads(row[0])
+
+    def set(self, kind, key, value):
+        if not self.is_enabled(kind):
+            return
+
+        key = self._scoped_key(key)
+        expires = time.time() + self._ttls.get(kind, self.DEFAULT_TTL)
+        with self._lock:
+            conn = self._connection()
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (kind, key, pickle.dumps(value), expires))
+            conn.commit()
+
+    def invalidate(self, *kinds):
+        """Removes all entries of the given types, or all entries if no
+        types are specified
+        """
+        with self._lock:
+            try:
+                conn = self._connection(create=bool(self._enabled
+                    or self._enabled_kinds))
+                if conn is None:
+                    return
+                logging.debug("Invalidating inventory cache: %s",
+                    ', '.join(kinds) or 'all')
+                if kinds:
+                    conn.executemany("DELETE FROM entries WHERE kind = ?",
+                        [(k,) for k in kinds])
+                else:
+                    conn.execute("DELETE FROM entries")
+                conn.commit()
+            except sqlite3.Error as e:
+                # Don't fail mutating operations because of the cache
+                logging.warning("Failed to invalidate inventory cache: %s", e)
+
+_cache = None
+
+def configure(**kwargs):
+    """Sets up the process-wide cache. See InventoryCache for kwargs
+    """
+    global _cache
+    _cache = InventoryCache(**kwargs)
+    return _cache
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = InventoryCache(enabled=False)
+    return _cache
+
+@contextlib.contextmanager
+def bypass():
+    """Within the context, cache reads are skipped, though entries are
+    still written (refreshed)
+    """
+    token = _bypassed.set(True)
+    try:
+        yield
+    finally:
+        _bypassed.reset(token)
@@ -0,0 +1,383 @@
+"""Optional long-running daemon that keeps boto3 clients, the inventory
+cache, and ssh connections warm across script invocations.
+
+The daemon (see bin/afaws-daemon) listens on a local Unix socket. Scripts
+run operations with `run_operation`, which sends them to the daemon if
+it's running, and otherwise runs them in process:
+
+> output = await run_operation('ec2.execute', ssh_key='/root/.ssh/id_rsa',
+>     instance_identifiers=['web-1'], commands=['uptime'], method='ssh')
+
+Each request is a single JSON object, written by the client before it
+shuts down its side of the connection:
+
+    {"operation": "ec2.execute", "profile": "default", "region": "us-west-2",
+     "cache": false, "kwargs": {...}}
+
+and the daemon responds with a single JSON object before closing the
+connection - either {"result": ...} or {"error": "...", "error_type": "..."}.
+
+Operations run in the client's effective AWS context - the profile and
+region it would use itself, including those set with AWS_PROFILE and
+AWS_DEFAULT_REGION - and take and return only JSON serializable values.
+Clients with credentials in their environment (e.g. AWS_ACCESS_KEY_ID),
+which the daemon can't use, run operations in process. Operations only
+read through the daemon's inventory cache if the client would read
+through its own (i.e. with --cache, and without --refresh). Since the daemon may have a
+different working directory, clients pass absolute file paths.
+
+Set AFAWS_DAEMON_SOCKET to use a non-default socket path, or
+AFAWS_NO_DAEMON=1 to always run operations in process.
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sys
+
+from .cache import bypass as bypass_cache, get_cache
+from .session import aws_context, current_aws_context, get_session
+
+__all__ = [
+    'DaemonOperationError',
+    'AfawsDaemon',
+    'default_socket_path',
+    'daemon_is_running',
+    'run_operation'
+]
+
+class DaemonOperationError(RuntimeError):
+    """Raised by clients when an operation fails in the daemon with an
+    exception that can't be re-raised as its original type
+    """
+    def __init__(self, msg, error_type=None):
+        super().__init__(msg)
+        self.error_type = error_type
+
+def default_socket_path():
+    if os.environ.get('AFAWS_DAEMON_SOCKET'):
+        return os.environ['AFAWS_DAEMON_SOCKET']
+    run_dir = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'afaws')
+    return os.path.join(run_dir, 'afaws-daemon.sock')
+
+
+##
+## Operations
+##
+
+OPERATIONS = {}
+
+def operation(name):
+    def decorator(func):
+        OPERATIONS[name] = func
+        return func
+    return decorator
+
+# Note that afaws.ec2 and afaws.s3 modules are imported within operations,
+# so that clients talking to the daemon don't load them
+
+def _instance_summary(instance):
+    return {
+        'id': instance.id,
+        'name': instance.name,
+        'ip': (instance.classic_address.public_ip
+            if instance.classic_address else None)
+    }
+
+@operation('ec2.launch')
+async def _launch(new_instance_names, config, options, image=None,
+        instance=None, minutes_until_auto_shutdown=None,
+        auto_shutdown_method='systemd', initialize=False,
+        initialization_method='ssh', ssh_key=None):
+    from .config import Config
+    from .ec2.initialization import (InstanceInitializerSsh,
+        InstanceInitializerSsm)
+    from .ec2.launch import Ec2Launcher, Ec2CloneLauncher
+    from .ec2.shutdown import AutoShutdownScheduler
+
+    config = Config(config)
+    launcher = (Ec2CloneLauncher(instance, config, **options)
+        if instance else Ec2Launcher(image, config, **options))
+    new_instances = await launcher.launch(new_instance_names)
+
+    if minutes_until_auto_shutdown:
+        auto_terminator = AutoShutdownScheduler(ssh_key,
+            method=auto_shutdown_method)
+        await auto_terminator.schedule_termination(new_instances,
+            minutes_until_auto_shutdown)
+
+    if initialize:
+        initializer = (InstanceInitializerSsm(config, emulate=instance)
+            if initialization_method == 'ssm' else
+            InstanceInitializerSsh(ssh_key, config, emulate=instance))
+        await initializer.initialize(new_instances)
+
+    return [_instance_summary(i) for i in new_instances]
+
+@operation('ec2.initialize')
+async def _initialize(instance_identifiers, config, ssh_key=None,
+        method='ssh', emulate=None):
+    from .config import Config
+    from .ec2.initialization import (InstanceInitializerSsh,
+        InstanceInitializerSsm)
+
+    config = Config(config)
+    initializer = (InstanceInitializerSsm(config, emulate=emulate)
+        if method == 'ssm' else
+        InstanceInitializerSsh(ssh_key, config, emulate=emulate))
+    await initializer.initialize(instance_identifiers)
+
+@operation('ec2.execute')
+async def _execute(ssh_key, instance_identifiers, commands, method='ssh'):
+    from .ec2.execute import Ec2SshExecuter, Ec2SsmExecuter
+
+    executer = (Ec2SsmExecuter(instance_identifiers) if method == 'ssm'
+        else Ec2SshExecuter(ssh_key, instance_identifiers))
+    output = await executer.execute(commands)
+    return {k: dict(v) for k, v in output.items()}
+
+@operation('ec2.shutdown')
+async def _shutdown(instance_identifiers, terminate=False, wait=False):
+    from .ec2.shutdown import Ec2Shutdown
+
+    return await Ec2Shutdown().shutdown(instance_identifiers,
+        terminate=terminate, wait=wait)
+
+async def _elb_pools(pool_name=None):
+    from .ec2.elb import ElbPool
+
+    if pool_name:
+        return [await ElbPool.from_name(pool_name)]
+    return await ElbPool.all()
+
+@operation('elb.list')
+async def _elb_list(pool_name=None):
+    return [p.summary() for p in await _elb_pools(pool_name)]
+
+@operation('elb.add')
+async def _elb_add(pool_name, instance_identifiers):
+    pool = (await _elb_pools(pool_name))[0]
+    await pool.add(instance_identifiers)
+    return pool.summary()
+
+@operation('elb.remove')
+async def _elb_remove(pool_name, instance_identifiers):
+    pool = (await _elb_pools(pool_name))[0]
+    await pool.remove(instance_identifiers)
+    return pool.summary()
+
+@operation('s3.download')
+async def _s3_download(dest_dir, bucket_name, path=None, key=None,
+        plan_only=False, **options):
+    from .s3 import S3Downloader
+
+    downloader = S3Downloader(dest_dir, bucket_name, **options)
+    if plan_only:
+        plan = await downloader.plan(path)
+        return {'keys': [o['Key'] for o in plan['objects']],
+            'total_objects': plan['total_objects'],
+            'total_bytes': plan['total_bytes']}
+
+    if path:
+        keys = await downloader.download_all(path)
+    else:
+        keys = [k for k in [await downloader.download_one(key)] if k]
+        downloader.progress.finish()
+    return dict(downloader.progress.summary(), keys=keys)
+
+
+##
+## Daemon
+##
+
+class AfawsDaemon(object):
+
+    def __init__(self, socket_path=None, ssh_connection_max_idle_time=300):
+        """
+        kwargs
+         - socket_path -- defaults to $XDG_RUNTIME_DIR/afaws-daemon.sock,
+            or ~/.cache/afaws/afaws-daemon.sock
+         - ssh_connection_max_idle_time -- how long (in seconds) to keep
+            unused ssh connections open
+        """
+        self._socket_path = socket_path or default_socket_path()
+        self._ssh_connection_max_idle_time = ssh_connection_max_idle_time
+
+    async def serve(self):
+        from .ec2 import ssh
+        ssh.enable_connection_pool(self._ssh_connection_max_idle_time)
+
+        if os.path.exists(self._socket_path):
+            if await daemon_is_running(self._socket_path):
+                raise RuntimeError("Daemon already running on {}".format(
+                    self._socket_path))
+            # stale socket left by daemon that didn't exit cleanly
+            os.remove(self._socket_path)
+
+        os.makedirs(os.path.dirname(self._socket_path), exist_ok=True)
+        # only the current user may connect
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._handle,
+                path=self._socket_path)
+        finally:
+            os.umask(umask)
+
+        logging.info("Listening on %s", self._socket_path)
+        reaper = asyncio.create_task(self._close_idle_ssh_connections())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            reaper.cancel()
+            ssh.get_connection_pool().close_all()
+            if os.path.exists(self._socket_path):
+                os.remove(self._socket_path)
+
+    SSH_REAP_INTERVAL = 60
+
+    async def _close_idle_ssh_connections(self):
+        from .asyncutils import run_in_loop_executor
+        from .ec2 import ssh
+        while True:
+            await asyncio.sleep(self.SSH_REAP_INTERVAL)
+            await run_in_loop_executor(ssh.get_connection_pool().close_expired)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = json.loads((await reader.read()).decode())
+            response = await self._process(request)
+            writer.write(json.dumps(response, default=str).encode())
+            await writer.drain()
+        except Exception:
+            logging.exception("Failed to handle request")
+        finally:
+            writer.close()
+
+    async def _process(self, request):
+        name = request.get('operation')
+        if name == 'ping':
+            return {'result': 'pong'}
+        if name not in OPERATIONS:
+            return {'error': "Invalid operation: {}".format(name),
+                'error_type': 'ValueError'}
+
+        logging.info("Running %s", name)
+        try:
+            # Entries are still written if the client isn't using the cache
+            with aws_context(request.get('profile'), request.get('region')), (
+                    contextlib.nullcontext() if request.get('cache')
+                    else bypass_cache()):
+                result = await OPERATIONS[name](**request.get('kwargs', {}))
+            return {'result': result}
+        except Exception as e:
+            logging.warning("%s failed: %s", name, e)
+            response = {'error': str(e), 'error_type': e.__class__.__name__}
+            if getattr(e, 'instances', None):
+                # e.g. PostLaunchFailure; include the ids of the instances
+                # that were launched, so that clients can clean them up
+                response['instance_ids'] = [i.id for i in e.instances]
+            return response
+
+
+##
+## Client
+##
+
+# Modules whose exceptions are re-raised as their original types by
+# clients, if the client has imported them (e.g. to catch them)
+EXCEPTION_MODULES = [
+    'afaws.ec2.exceptions',
+    'afaws.ec2.execute',
+    'afaws.ec2.resources',
+    'afaws.ec2.elb',
+    'afaws.ec2.launch',
+    'afaws.ec2.shutdown',
+    'afaws.s3'
+]
+
+def _exception(response):
+    msg, error_type = response['error'], response.get('error_type')
+    # e.g. PostLaunchFailure(msg, instance_ids)
+    args = ((msg, response['instance_ids']) if 'instance_ids' in response
+        else (msg,))
+    for module_name in EXCEPTION_MODULES:
+        module = sys.modules.get(module_name)
+        if module and error_type in getattr(module, '__all__', []):
+            return getattr(module, error_type)(*args)
+    return DaemonOperationError(msg, error_type)
+
+async def _send(socket_path, request):
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    return await _exchange(reader, writer, request)
+
+async def _exchange(reader, writer, request):
+    try:
+        # Fails (rather than, e.g., converting values to strings) if any
+        # kwargs aren't JSON serializable, since the operation would
+        # otherwise run with different values than it would in process
+        writer.write(json.dumps(request).encode())
+        writer.write_eof()
+        await writer.drain()
+        response = json.loads((await reader.read()).decode())
+    finally:
+        writer.close()
+
+    if 'error' in response:
+        raise _exception(response)
+    return response['result']
+
+async def daemon_is_running(socket_path=None):
+    socket_path = socket_path or default_socket_path()
+    if not os.path.exists(socket_path):
+        return False
+    try:
+        return await _send(socket_path, {'operation': 'ping'}) == 'pong'
+    except (OSError, ValueError):
+        return False
+
+def _effective_aws_context():
+    """Returns the (profile, region) the current process would use, or
+    None if it would use credentials from its environment, which the
+    daemon wouldn't
+    """
+    profile, region = current_aws_context()
+    if not profile and os.environ.get('AWS_ACCESS_KEY_ID'):
+        return None
+    # The session resolves defaults (e.g. AWS_PROFILE, AWS_DEFAULT_REGION,
+    # and the profile's configured region) as they'd be in process
+    session = get_session()
+    return session.profile_name, session.region_name
+
+async def run_operation(name, **kwargs):
+    """Runs the named operation in the daemon, if running, or else in
+    process, in the current AWS context
+    """
+    socket_path = default_socket_path()
+    context = None
+    if (os.environ.get('AFAWS_NO_DAEMON') != '1'
+            and os.path.exists(socket_path)):
+        context = _effective_aws_context()
+        if not context:
+            logging.debug("Using credentials from environment; running %s "
+                "in process", name)
+
+    if context:
+        profile, region = context
+        cache = get_cache()
+        request = {'operation': name, 'profile': profile, 'region': region,
+            'cache': cache.enabled and not cache.refresh, 'kwargs': kwargs}
+        try:
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+        except OSError as e:
+            # e.g. stale socket left by daemon that didn't exit cleanly
+            logging.debug("Failed to connect to daemon (%s); running %s "
+                "in process", e, name)
+        else:
+            logging.debug("Running %s in daemon", name)
+            return await _exchange(reader, writer, request)
+
+    return await OPERATIONS[name](**kwargs)
@@ -3,39 +3,57 @@
 # Classic load balancer docs are:
 #  https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/elb.html
 
+import json
 import logging
 import sys
 
-import boto3
-
 from .resources import Instance
-from ..asyncutils import run_in_loop_executor
+from ..asyncutils import run_in_api_executor
+from ..cache import bypass as bypass_cache, get_cache
+from ..session import get_client, resolve_aws_context, uses_aws_context
 
 class PoolDoesNotExistError(RuntimeError):
     pass
 
 class ElbPool(object):
 
-    def __init__(self, arn, name=None, client=None):
+    def __init__(self, arn, name=None, client=None, profile=None, region=None):
         """
         Note that name is nice to have to reference later by client,
         but not required.
         """
-        self._client = client or boto3.client('elbv2')
+        self._aws_context = resolve_aws_context(profile, region)
+        self._client = client or get_client('elbv2', *self._aws_context)
         self.arn = arn
         self.name = name
         self._target_groups = None
 
+    @uses_aws_context
     async def load(self, force_reload=False):
         if self._target_groups is None or force_reload:
             await self._load_target_groups()
             await self._load_instances()
 
+    @classmethod
+    async def _describe(cls, client, method_name, **kwargs):
+        """Calls describe method, reading through the inventory cache
+        """
+        cache = get_cache()
+        cache_key = json.dumps(dict(kwargs, method=method_name), sort_keys=True)
+        resp = cache.get(cls.__name__, cache_key)
+        if resp is None:
+            resp = await run_in_api_executor(getattr(client, method_name),
+                **kwargs)
+            cache.set(cls.__name__, cache_key, resp)
+        return resp
+
+    @classmethod
+    def invalidate_cache(cls):
+        get_cache().invalidate(cls.__name__)
+
     async def _load_target_groups(self):
-        resp = await run_in_loop_executor(
-            self._client.describe_target_groups,
-            LoadBalancerArn=self.arn
-        )
+        resp = await self._describe(self._client, 'describe_target_groups',
+            LoadBalancerArn=self.arn)
         if not resp or not resp.get('TargetGroups'):
             raise RuntimeError("No target groups")
         self._target_groups = resp['TargetGroups']
@@ -43,14 +61,15 @@ class ElbPool(object):
 
     async def _load_instances(self):
         for tg in self._target_groups:
-            r = await run_in_loop_executor(
-                self._client.describe_target_health,
-                TargetGroupArn=tg['TargetGroupArn']
-            )
+            r = await self._describe(self._client, 'describe_target_health',
+                TargetGroupArn=tg['TargetGroupArn'])
             if r and r.get('TargetHealthDescriptions'):
                 tg['instances'] = r['TargetHealthDescriptions']
-                for i in tg['instances']:
-                    i['object'] = await Instance(i['Target']['Id'])
+                # look up all of the target group's instances at once
+                instances = await Instance.find_many(
+                    [i['Target']['Id'] for i in tg['instances']])
+                for i, instance in zip(tg['instances'], instances):
+                    i['object'] = instance
                 tg['instances'].sort(key=lambda i: i['object'].name)
             else:
                 logging.warn("Target group %s has no targets (instances)",
@@ -61,37 +80,63 @@ class ElbPool(object):
     def target_groups(self):
         return self._target_groups or []
 
+    def summary(self):
+        """Returns JSON serializable summary of pool, target groups, and
+        target instances
+        """
+        return {
+            'name': self.name,
+            'arn': self.arn,
+            'target_groups': [{
+                'name': tg['TargetGroupName'],
+                'instances': [{
+                    'name': i['object'].name,
+                    'ip': (i['object'].classic_address.public_ip
+                        if i['object'].classic_address else None),
+                    'id': i['Target']['Id'],
+                    'port': i['Target'].get('Port'),
+                    'state': i['TargetHealth']['State']
+                } for i in tg.get('instances', [])]
+            } for tg in self.target_groups]
+        }
+
+    @uses_aws_context
     async def add(self, instance_identifiers):
-        instances = [await Instance(n) for n in instance_identifiers]
-        await self.load()
+        with bypass_cache():
+            instances = [await Instance(n) for n in instance_identifiers]
+            await self.load(force_reload=True)
         for tg in self.target_groups:
             targets = [{'Id': i.id} for i in instances]
-            r = await run_in_loop_executor(
+            r = await run_in_api_executor(
                 self._client.register_targets,
                 TargetGroupArn=tg['TargetGroupArn'],
                 Targets=targets
             )
+        self.invalidate_cache()
         await self.load(force_reload=True)
 
+    @uses_aws_context
     async def remove(self, instance_identifiers):
-        instances = [await Instance(n) for n in instance_identifiers]
-        await self.load()
+        with bypass_cache():
+            instances = [await Instance(n) for n in instance_identifiers]
+            await self.load(force_reload=True)
         for tg in self.target_groups:
             #targets = [{'Id': i.id, 'Port': tg['Port'], 'AvailabilityZone': 'all'} for i in instances]
             targets = [{'Id': i.id} for i in instances]
-            r = await run_in_loop_executor(
+            r = await run_in_api_executor(
                 self._client.deregister_targets,
                 TargetGroupArn=tg['TargetGroupArn'],
                 Targets=targets
             )
+        self.invalidate_cache()
         await self.load(force_reload=True)
 
     @classmethod
     async def from_name(cls, pool_name):
-        client = boto3.client('elbv2')
+        client = get_client('elbv2')
         try:
-            resp = await run_in_loop_executor(
-                client.describe_load_balancers, Names=[pool_name])
+            resp = await cls._describe(client, 'describe_load_balancers',
+                Names=[pool_name])
 
         except client.exceptions.LoadBalancerNotFoundException:
             raise PoolDoesNotExistError("ELB pool does not exist")
@@ -109,8 +154,8 @@ class ElbPool(object):
 
     @classmethod
     async def all(cls):
-        client = boto3.client('elbv2')
-        resp = await run_in_loop_executor(client.describe_load_balancers)
+        client = get_client('elbv2')
+        resp = await cls._describe(client, 'describe_load_balancers')
         pools = []
         for lb in resp['LoadBalancers']:
             # TODO:  if thread safe, pass in client
@@ -3,11 +3,18 @@ __all__ = [
 ]
 
 class PostLaunchFailure(Exception):
+    """Raised when some or all instances were launched, so that they can be
+    reported and cleaned up. instances are instance objects, or, if raised
+    by afaws-daemon clients, instance ids
+    """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._msg = str(args[0])
-        self._instances = args[1]
+        self._instances = args[1] if len(args) > 1 else []
+
+    def __str__(self):
+        return self._msg
 
     @property
     def instances(self):
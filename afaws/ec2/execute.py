@@ -1,40 +1,58 @@
 import asyncio
 import logging
+import os
 import time
 from collections import defaultdict
 
-#import boto3
-import tornado.gen
-
 from .resources import Instance
 from .ssh import SshClient
-from ..asyncutils import run_with_retries
+from ..asyncutils import run_in_loop_executor, run_with_retries
+from ..session import get_client, resolve_aws_context, uses_aws_context
 
 __all__ = [
+    'FailedToConnectError',
     'FailedToSshError',
-    'Ec2SshExecuter'
+    'FailedToReachSsmAgentError',
+    'Ec2SshExecuter',
+    'Ec2SsmExecuter'
 ]
 
-class FailedToSshError(RuntimeError):
+class FailedToConnectError(RuntimeError):
+    pass
+
+class FailedToSshError(FailedToConnectError):
+    pass
+
+class FailedToReachSsmAgentError(FailedToConnectError):
     pass
 
 class Ec2SshExecuter(object):
 
-    def __init__(self, ssh_key, instances_or_identifiers):
+    def __init__(self, ssh_key, instances_or_identifiers, profile=None,
+            region=None, connect_timeout=None):
         # accept single stirng value for 'commands'
         if not hasattr(instances_or_identifiers, 'append'):
             instances_or_identifiers = [instances_or_identifiers]
         self._instances_or_identifiers = instances_or_identifiers
 
         self._ssh_key = ssh_key
+        self._connect_timeout = connect_timeout
         self._ips = None
+        self._aws_context = resolve_aws_context(profile, region)
 
+    @uses_aws_context
     async def ips(self):
         if self._ips is None:
-            self._ips = [(await Instance(i)).classic_address.public_ip
-                for i in self._instances_or_identifiers]
+            # find_many looks up all instances with at most two API calls
+            self._ips = [i.classic_address.public_ip for i in
+                await Instance.find_many(self._instances_or_identifiers)]
         return self._ips
 
+    async def wait_for_connectivity(self):
+        """Common interface with Ec2SsmExecuter
+        """
+        await self.wait_for_ssh_connectivity()
+
     SSH_RETRY_WAIT = 10
     MAX_SSH_ATTEMPTS = (60 / SSH_RETRY_WAIT) * 5 # retry for up to 5 minutes
     # SSH_EXCEPTION_CLASSES = (
@@ -48,7 +66,17 @@ class Ec2SshExecuter(object):
             exception_module_name_whitelist=['paramiko.ssh_exception'],
             log_msg_prefix="Waiting for ssh connectivity")
 
-    async def execute(self, commands, ignore_errors=False):
+    async def execute(self, commands, ignore_errors=False,
+            return_host_errors=False):
+        """Executes commands on all instances concurrently, over one ssh
+        connection per instance.
+
+        kwargs
+         - ignore_errors -- don't fail on commands exiting with non-zero status
+         - return_host_errors -- record failures on any host (e.g. due to
+            being unreachable) in output['ERRORS'], keyed by ip, rather
+            than failing
+        """
         # accept single stirng value for 'commands'
         if hasattr(commands, 'lower'):
             commands = [commands]
@@ -58,14 +86,29 @@ class Ec2SshExecuter(object):
             "STDERR": defaultdict(lambda: []),
             "STDOUT": defaultdict(lambda: [])
         }
+        if return_host_errors:
+            output["ERRORS"] = {}
         await asyncio.gather(*[
-            self._execute_commands(commands, ip, output, ignore_errors)
-                for ip in await self.ips()
+            self._execute_commands(commands, ip, output, ignore_errors,
+                return_host_errors) for ip in await self.ips()
         ])
         return output
 
-    async def _execute_commands(self, commands, ip, output, ignore_errors):
-        with SshClient(self._ssh_key, ip) as client:
+    async def _execute_commands(self, commands, ip, output, ignore_errors,
+            return_host_errors=False):
+        try:
+            await self._execute_commands_on_host(commands, ip, output,
+                ignore_errors)
+        except Exception as e:
+            if not return_host_errors:
+                raise
+            logging.warning("Failed to execute commands on %s: %s", ip, e)
+            output["ERRORS"][ip] = str(e) or e.__class__.__name__
+
+    async def _execute_commands_on_host(self, commands, ip, output,
+            ignore_errors):
+        with SshClient(self._ssh_key, ip,
+                connect_timeout=self._connect_timeout) as client:
             for cmd in commands:
                 logging.info("Running %s on %s", cmd, ip)
                 result = await client.execute(cmd, ignore_errors=ignore_errors)
@@ -82,6 +125,50 @@ class Ec2SshExecuter(object):
                         self._log_output(cmd, ip, out, log_func, k)
                         output[k][ip].append((cmd, out))
 
+    async def put(self, local_file_path, remote_file_path, **kwargs):
+        """Uploads local file(s) to all instances concurrently.
+
+        kwargs are passed through to SshClient.put (e.g. use_tar, compress)
+        """
+        logging.info("Uploading %s to %s on %s", local_file_path,
+            remote_file_path, await self.ips())
+        await asyncio.gather(*[
+            self._put(ip, local_file_path, remote_file_path, **kwargs)
+                for ip in await self.ips()
+        ])
+
+    async def _put(self, ip, local_file_path, remote_file_path, **kwargs):
+        with SshClient(self._ssh_key, ip,
+                connect_timeout=self._connect_timeout) as client:
+            await client.put(local_file_path, remote_file_path, **kwargs)
+
+    async def get(self, remote_file_path, local_dir, **kwargs):
+        """Downloads remote file(s) from all instances concurrently, each
+        into its own sub-directory of local_dir, named by ip address.
+
+        kwargs are passed through to SshClient.get (e.g. recursive, compress)
+        Returns dict of local paths, keyed by ip
+        """
+        logging.info("Downloading %s from %s", remote_file_path,
+            await self.ips())
+        ips = await self.ips()
+        local_paths = {}
+        for ip in ips:
+            ip_dir = os.path.join(local_dir, ip)
+            os.makedirs(ip_dir, exist_ok=True)
+            local_paths[ip] = os.path.join(ip_dir,
+                os.path.basename(remote_file_path.rstrip('/')))
+        await asyncio.gather(*[
+            self._get(ip, remote_file_path, local_paths[ip], **kwargs)
+                for ip in ips
+        ])
+        return local_paths
+
+    async def _get(self, ip, remote_file_path, local_file_path, **kwargs):
+        with SshClient(self._ssh_key, ip,
+                connect_timeout=self._connect_timeout) as client:
+            await client.get(remote_file_path, local_file_path, **kwargs)
+
     def _log_output(self, cmd, ip, lines, log_func, stream_name):
             if lines:
                 log_func("%s of %s on %s: ", stream_name, cmd, ip)
@@ -89,25 +176,204 @@ class Ec2SshExecuter(object):
                     log_func("  [%s]: %s", ip, l.strip())
 
 
+class Ec2SsmExecuter(object):
+    """Executes commands via SSM Run Command rather than ssh, with one
+    SendCommand call per MAX_INSTANCES_PER_COMMAND instances, and results
+    collected with one (paginated) ListCommandInvocations call per
+    SendCommand per poll.
+
+    Has the same interface as Ec2SshExecuter, except that put and get
+    aren't supported. Output is keyed by public ip if an instance has one,
+    and by instance id otherwise. Instances must be running the SSM agent,
+    with an instance profile that allows it to reach SSM.
+
+    Note that SSM truncates the output returned for each invocation
+    (currently to 2500 characters)
+    """
 
+    # SendCommand API limit
+    MAX_INSTANCES_PER_COMMAND = 50
+    DOCUMENT_NAME = 'AWS-RunShellScript'
 
-# Note: couldn't get SSM tow ork
+    POLL_INTERVAL = 2
+    MAX_POLL_ATTEMPTS = (60 / POLL_INTERVAL) * 60 # poll for up to an hour
+    PENDING_STATUSES = ('Pending', 'InProgress', 'Delayed', 'Cancelling')
 
-# class Ec2SsmExecuter(object):
+    # Printed to stdout and stderr before each command, so that output can
+    # be split by command
+    COMMAND_MARKER = '@@afaws-command:'
+    # Separates stdout and stderr in invocation output
+    ERROR_SEPARATOR = '----------ERROR-------'
 
-#     def __init__(self, instance_identifiers):
-#         self._ssm_client = boto3.client('ssm')
-#         self._instance_ids = [Instance(i).id for i in instance_identifiers]
+    def __init__(self, instances_or_identifiers, profile=None, region=None,
+            execution_timeout=3600):
+        # accept single instance or identifier
+        if not hasattr(instances_or_identifiers, 'append'):
+            instances_or_identifiers = [instances_or_identifiers]
+        self._instances_or_identifiers = instances_or_identifiers
+
+        self._execution_timeout = execution_timeout
+        self._instances = None
+        self._aws_context = resolve_aws_context(profile, region)
+        self._client = get_client('ssm', *self._aws_context)
+
+    @uses_aws_context
+    async def instances(self):
+        if self._instances is None:
+            self._instances = await Instance.find_many(
+                self._instances_or_identifiers)
+        return self._instances
+
+    async def ips(self):
+        return [self._host(i) for i in await self.instances()]
+
+    def _host(self, instance):
+        return (instance.classic_address.public_ip
+            if instance.classic_address else instance.id)
+
+    ## Connectivity
+
+    async def wait_for_connectivity(self):
+        logging.info("Waiting for SSM agent on %s", await self.ips())
+        await run_with_retries(self._check_agents_online, [], {}, True,
+            FailedToReachSsmAgentError, log_msg_prefix="Waiting for SSM agent")
+
+    @uses_aws_context
+    async def _check_agents_online(self):
+        instance_ids = [i.id for i in await self.instances()]
+        online = set()
+        for idx in range(0, len(instance_ids), self.MAX_INSTANCES_PER_COMMAND):
+            resp = await run_in_loop_executor(self._describe_instance_information,
+                instance_ids[idx:idx+self.MAX_INSTANCES_PER_COMMAND])
+            online.update(i['InstanceId'] for i in resp
+                if i.get('PingStatus') == 'Online')
+        offline = [i for i in instance_ids if i not in online]
+        if offline:
+            raise FailedToReachSsmAgentError("SSM agent not online on "
+                "{}".format(', '.join(offline)))
+
+    def _describe_instance_information(self, instance_ids):
+        paginator = self._client.get_paginator('describe_instance_information')
+        return [i for page in paginator.paginate(
+                Filters=[{'Key': 'InstanceIds', 'Values': instance_ids}])
+            for i in page['InstanceInformationList']]
+
+    ## Execution
+
+    @uses_aws_context
+    async def execute(self, commands, ignore_errors=False,
+            return_host_errors=False):
+        """Executes commands on all instances, running them as a single
+        script on each.
+
+        kwargs
+         - ignore_errors -- continue running commands after any exits with
+            non-zero status, and don't fail
+         - return_host_errors -- record failures on any host in
+            output['ERRORS'], keyed by ip (or instance id), rather than
+            failing
+        """
+        # accept single stirng value for 'commands'
+        if hasattr(commands, 'lower'):
+            commands = [commands]
+
+        instances = await self.instances()
+        logging.info("Executing commands via SSM on %s", await self.ips())
+        output = {
+            "STDERR": defaultdict(lambda: []),
+            "STDOUT": defaultdict(lambda: [])
+        }
+        errors = {}
+        await asyncio.gather(*[
+            self._execute_batch(commands, instances[idx:idx+self.MAX_INSTANCES_PER_COMMAND],
+                output, errors, ignore_errors)
+            for idx in range(0, len(instances), self.MAX_INSTANCES_PER_COMMAND)
+        ])
+
+        if return_host_errors:
+            output["ERRORS"] = errors
+        elif errors:
+            raise RuntimeError("Commands failed on {}: {}".format(
+                ', '.join(errors), '; '.join(set(errors.values()))))
+        return output
+
+    def _script(self, commands, ignore_errors):
+        lines = [] if ignore_errors else ['set -e']
+        for idx, cmd in enumerate(commands):
+            marker = "'{}{}'".format(self.COMMAND_MARKER, idx)
+            lines.extend(['echo {}'.format(marker),
+                'echo {} >&2'.format(marker), cmd])
+        return lines
+
+    async def _execute_batch(self, commands, instances, output, errors,
+            ignore_errors):
+        instance_ids = [i.id for i in instances]
+        resp = await run_in_loop_executor(self._client.send_command,
+            InstanceIds=instance_ids,
+            DocumentName=self.DOCUMENT_NAME,
+            Parameters={
+                'commands': self._script(commands, ignore_errors),
+                'executionTimeout': [str(self._execution_timeout)]
+            })
+        command_id = resp['Command']['CommandId']
+        logging.debug("Sent SSM command %s to %s", command_id, instance_ids)
+
+        invocations = await self._wait_for_invocations(command_id, instance_ids)
+        for instance in instances:
+            invocation = invocations[instance.id]
+            host = self._host(instance)
+            self._record_output(commands, host, invocation, output)
+            if invocation['Status'] != 'Success' and not ignore_errors:
+                errors[host] = "{} ({})".format(invocation['Status'],
+                    invocation.get('StatusDetails'))
+
+    async def _wait_for_invocations(self, command_id, instance_ids):
+        attempts = 0
+        while True:
+            invocations = {i['InstanceId']: i for i in
+                await run_in_loop_executor(self._list_command_invocations,
+                    command_id)}
+            # invocations may not be listed immediately after sending
+            pending = [i for i in instance_ids if i not in invocations
+                or invocations[i]['Status'] in self.PENDING_STATUSES]
+            if not pending:
+                return invocations
+
+            attempts += 1
+            if attempts >= self.MAX_POLL_ATTEMPTS:
+                raise RuntimeError("SSM command {} didn't complete on {}".format(
+                    command_id, ', '.join(pending)))
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    def _list_command_invocations(self, command_id):
+        paginator = self._client.get_paginator('list_command_invocations')
+        return [i for page in paginator.paginate(CommandId=command_id,
+                Details=True)
+            for i in page['CommandInvocations']]
+
+    def _record_output(self, commands, host, invocation, output):
+        raw = ''.join(p.get('Output') or ''
+            for p in invocation.get('CommandPlugins', []))
+        stdout, _, stderr = raw.partition(self.ERROR_SEPARATOR)
+        for k, out in (('STDOUT', stdout), ('STDERR', stderr)):
+            for cmd, lines in self._split_by_command(commands, out):
+                log_func = logging.debug if k == 'STDOUT' else logging.warn
+                log_func("%s of %s on %s: ", k, cmd, host)
+                for l in lines:
+                    log_func("  [%s]: %s", host, l.strip())
+                output[k][host].append((cmd, lines))
 
-#     def execute(self, commands):
-#         logging.info("Executing commands on %s", self._instance_ids)
-#         r = self._ssm_client.send_command(
-#             DocumentName="AWS-RunShellScript", # One of AWS' preconfigured documents
-#             Parameters={'commands': commands},
-#             InstanceIds=self._instance_ids,
-#         )
-#         output = {i: ssm_client.get_command_invocation(
-#               CommandId=r['Command']['CommandId'],
-#               InstanceId=i,
-#             ) for i in self._instance_ids}
-#         return output
+    def _split_by_command(self, commands, out):
+        """Returns list of (command, lines) tuples, for commands with output
+        """
+        by_command = []
+        lines = None
+        for line in out.strip().split('\n'):
+            if line.startswith(self.COMMAND_MARKER):
+                lines = []
+                idx = int(line[len(self.COMMAND_MARKER):])
+                by_command.append((commands[idx], lines))
+            elif lines is not None:
+                lines.append(line + '\n')
+        return [(cmd, lines) for cmd, lines in by_command if
+            ''.join(lines).strip()]
@@ -0,0 +1,146 @@
+import datetime
+import logging
+
+from .execute import Ec2SshExecuter
+from .resources import Instance
+from ..cache import get_cache
+from ..session import resolve_aws_context, uses_aws_context
+
+__all__ = [
+    'Ec2FactCollector'
+]
+
+class Ec2FactCollector(object):
+    """Collects OS release, kernel, uptime, disk usage, and docker version
+    from instances, concurrently, with one ssh session per instance.
+
+    Facts are cached (see afaws.cache) per instance, so that repeated
+    queries only ssh to instances whose facts aren't cached.
+    """
+
+    FACTS = ('os', 'kernel', 'uptime', 'disk', 'docker')
+
+    CACHE_KIND = 'InstanceFacts'
+
+    # Each fact is printed after a marker line, so that all can be
+    # collected with one command
+    SECTION_MARKER = '@@afaws-fact:'
+    COMMAND = '; '.join([
+        "echo '{m}os'",
+        "(lsb_release -ds 2>/dev/null || (. /etc/os-release && echo $PRETTY_NAME))",
+        "echo '{m}kernel'",
+        "uname -r",
+        "echo '{m}uptime'",
+        "cut -d' ' -f1 /proc/uptime",
+        "echo '{m}disk'",
+        "df -h --output=used,size,pcent / | tail -1",
+        "echo '{m}docker'",
+        "(docker --version 2>/dev/null || true)"
+    ]).format(m=SECTION_MARKER)
+
+    def __init__(self, ssh_key, connect_timeout=5, profile=None, region=None):
+        self._ssh_key = ssh_key
+        self._connect_timeout = connect_timeout
+        self._aws_context = resolve_aws_context(profile, region)
+
+    ## Public Interface
+
+    @uses_aws_context
+    async def collect(self, instances_or_identifiers=None):
+        """Returns dict of facts, keyed by instance id, each with 'name',
+        'ip', 'error', 'collected_at' (UTC), and an entry for each of FACTS
+
+        args
+         - instances_or_identifiers -- instance names, ids, or objects;
+            if not specified, facts are collected from all running instances
+        """
+        if instances_or_identifiers:
+            instances = await Instance.find_many(instances_or_identifiers)
+        else:
+            instances = await Instance.all(states=['running'])
+
+        cache = get_cache()
+        facts = {}
+        to_query = []
+        for instance in instances:
+            cached = cache.get(self.CACHE_KIND, instance.id)
+            if cached:
+                facts[instance.id] = cached
+            elif not self._ip(instance):
+                facts[instance.id] = self._record(instance,
+                    error="No IP available")
+            else:
+                to_query.append(instance)
+
+        if to_query:
+            logging.info("Collecting facts from %s instances", len(to_query))
+            facts.update(await self._query(to_query))
+            for instance in to_query:
+                # don't cache failures, so that they're retried next time
+                if not facts[instance.id]['error']:
+                    cache.set(self.CACHE_KIND, instance.id, facts[instance.id])
+
+        return facts
+
+    ## Helpers
+
+    async def _query(self, instances):
+        executer = Ec2SshExecuter(self._ssh_key, instances,
+            connect_timeout=self._connect_timeout)
+        output = await executer.execute(self.COMMAND, ignore_errors=True,
+            return_host_errors=True)
+
+        facts = {}
+        for instance, ip in zip(instances, await executer.ips()):
+            if ip in output['ERRORS']:
+                facts[instance.id] = self._record(instance,
+                    error=output['ERRORS'][ip])
+            else:
+                lines = [l for _, lines in output['STDOUT'].get(ip, [])
+                    for l in lines]
+                facts[instance.id] = self._record(instance,
+                    **self._parse(lines))
+        return facts
+
+    def _parse(self, lines):
+        sections = {}
+        fact = None
+        for line in lines:
+            line = line.strip()
+            if line.startswith(self.SECTION_MARKER):
+                fact = line[len(self.SECTION_MARKER):]
+                sections[fact] = []
+            elif fact and line:
+                sections[fact].append(line)
+
+        parsed = {f: ' '.join(sections.get(f, [])) or None for f in self.FACTS}
+        if parsed['uptime']:
+            parsed['uptime'] = self._format_uptime(parsed['uptime'])
+        if parsed['docker']:
+            # e.g. 'Docker version 24.0.5, build ced0996' -> '24.0.5'
+            parsed['docker'] = parsed['docker'].replace(
+                'Docker version', '').split(',')[0].strip()
+        return parsed
+
+    def _format_uptime(self, seconds):
+        try:
+            seconds = int(float(seconds))
+        except ValueError:
+            return seconds
+        days, seconds = divmod(seconds, 86400)
+        return '{}d {}h {}m'.format(days, seconds // 3600, (seconds % 3600) // 60)
+
+    def _ip(self, instance):
+        return (instance.classic_address.public_ip
+            if instance.classic_address else None)
+
+    def _record(self, instance, error=None, **facts):
+        record = {
+            'name': instance.name,
+            'ip': self._ip(instance),
+            'error': error,
+            'collected_at': datetime.datetime.utcnow().strftime(
+                '%Y-%m-%dT%H:%M:%SZ')
+        }
+        record.update({f: facts.get(f) for f in self.FACTS})
+        return record
@@ -1,19 +1,26 @@
+import abc
 import asyncio
 import logging
 import os
 import sys
+from collections import defaultdict
 
-from .execute import Ec2SshExecuter
+from .execute import Ec2SshExecuter, Ec2SsmExecuter
+from .resources import Instance
 
 __all__ = [
-    'InstanceInitializer'
+    'InstanceInitializer',
+    'InstanceInitializerSsh',
+    'InstanceInitializerSsm'
 ]
 
-class InstanceInitializerSsh(object):
+class InstanceInitializer(abc.ABC):
+    """Base class for initializers, which differ only in how they run
+    commands on instances
+    """
 
-    def __init__(self, ssh_key, config, emulate=None):
+    def __init__(self, config, emulate=None):
         self._config = config
-        self._ssh_key = ssh_key
         self._emulate = emulate
         self._executer = None
         self._efs_volumes = self._config('default_efs_volumes')
@@ -23,58 +30,88 @@ class InstanceInitializerSsh(object):
     async def initialize(self, instances_or_identifiers):
         await self._initialize_self()
 
+        instances = await Instance.find_many(instances_or_identifiers)
+        executer = self._create_executer(instances)
+        await executer.wait_for_connectivity()
+
         # Note: We're not assuming that instances are all clones of the same
         # source instance, so we'll search for docker-compose yaml files
-        # and Makefiles on each
+        # and Makefiles on each - though with one execute call for all
+        yaml_files = (self._for_each_host(instances, self._yaml_files)
+            if self._yaml_files else await self._find_yaml_files(executer))
+        makefiles = (self._for_each_host(instances, self._makefiles)
+            if self._makefiles else await self._find_makefiles(executer))
+
+        # Instances that need the same commands are initialized with one
+        # execute call (e.g. one SSM SendCommand for all of them)
+        instances_by_cmds = {}
+        for instance in instances:
+            host = self._host(instance)
+            cmds = (
+                    self._get_mount_efs_volumes_cmds()
+                    + self._get_restart_docker_cmd()
+                    + self._get_restart_docker_compose_cmds(yaml_files.get(host, []))
+                    + self._get_restart_make_cmds(makefiles.get(host, []))
+                )
+            instances_by_cmds.setdefault(tuple(cmds), []).append(instance)
         await asyncio.gather(*[
-            self._initialize_instance(i) for i in instances_or_identifiers
+            self._create_executer(group).execute(list(cmds), ignore_errors=True)
+                for cmds, group in instances_by_cmds.items()
         ])
 
     ## General helpers
 
+    @abc.abstractmethod
+    def _create_executer(self, instances_or_identifiers):
+        pass
+
+    def _host(self, instance):
+        """Returns key of instance in executer output - public ip, or, with
+        SSM, instance id if it has none
+        """
+        return (instance.classic_address.public_ip
+            if instance.classic_address else instance.id)
+
+    def _for_each_host(self, instances, value):
+        return {self._host(i): value for i in instances}
+
+    def _from_only_host(self, values_by_host):
+        return list(values_by_host.values())[0] if values_by_host else []
+
     async def _initialize_self(self):
         # Initialize if 'emulate' was specified, but only do it once
         # this has to be called from 'initialize' because __inii__ can be async
         if self._emulate and not self._executer:
             if self._emulate:
-                self._executer = Ec2SshExecuter(self._ssh_key, self._emulate)
+                self._executer = self._create_executer(self._emulate)
                 self._efs_volumes = await self._find_efs_volumes(self._executer)
-                self._yaml_files = await self._find_yaml_files(self._executer)
-                self._makefiles = await self._find_makefiles(self._executer)
-
-    async def _initialize_instance(self, instance_or_identifier):
-        executer = Ec2SshExecuter(self._ssh_key, instance_or_identifier)
-        await executer.wait_for_ssh_connectivity()
-        cmds = (
-                await self._get_mount_efs_volumes_cmds(executer)
-                + await self._get_restart_docker_cmd(executer)
-                + await self._get_restart_docker_compose_cmds(executer)
-                + await self._get_restart_make_cmds(executer)
-            )
-        await executer.execute(cmds, ignore_errors=True)
+                self._yaml_files = self._from_only_host(
+                    await self._find_yaml_files(self._executer))
+                self._makefiles = self._from_only_host(
+                    await self._find_makefiles(self._executer))
 
     async def _find_files(self, executer, root_dirs, filename_pattern, maxdepth=2):
-        files = []
+        """Returns dict of lists of files found, keyed by host
+        """
+        files = defaultdict(list)
         for root_dir in root_dirs:
             cmd = "sudo find {} -name {} -maxdepth {}".format(root_dir,
                 filename_pattern, maxdepth)
             output = await executer.execute(cmd)
-            if output['STDOUT']:
-                files.extend([
-                    f.strip() for f in list(output['STDOUT'].items())[0][1][0][1]
-                ])
+            for host, outputs in output['STDOUT'].items():
+                files[host].extend([f.strip() for f in outputs[0][1]])
         return files
 
     ## Mount Commands
 
     async def _find_efs_volumes(self, executer):
-        logging.info("Finding EFS volumes on %s", executer._ips)
+        logging.info("Finding EFS volumes on %s", await executer.ips())
         cmd = "mount |grep aws |sed -e 's/ on / /g'|sed -e 's/ type .*//g'"
         output = await executer.execute(cmd)
         output_lines = list(output['STDOUT'].items())[0][1][0][1]
         return [l.strip().split(' ') for l in output_lines]
 
-    async def _get_mount_efs_volumes_cmds(self, executer):
+    def _get_mount_efs_volumes_cmds(self):
         def _mnt_cmd(vol):
             return ("sudo mkdir -p {dir} && sudo mount -t nfs4 -o nfsvers=4.1,rsize=1048576,"
                 "wsize=1048576,hard,timeo=600,retrans=2,noresvport "
@@ -83,19 +120,18 @@ class InstanceInitializerSsh(object):
 
     ## Docker commands
 
-    async def _get_restart_docker_cmd(self, executer):
+    def _get_restart_docker_cmd(self):
         return ["sudo service docker restart"]
 
     ## Docker Compose Commmands
 
     async def _find_yaml_files(self, executer):
-        logging.info("Finding yaml files on %s", executer._ips)
+        logging.info("Finding yaml files on %s", await executer.ips())
         return await self._find_files(executer,
             self._config('docker_compose_yaml_root_dirs'),
             'docker-compose*.yml')
 
-    async def _get_restart_docker_compose_cmds(self, executer):
-        yaml_files = self._yaml_files or await self._find_yaml_files(executer)
+    def _get_restart_docker_compose_cmds(self, yaml_files):
         cmds = []
         for yaml_file in yaml_files:
             cmds.extend([
@@ -107,45 +143,30 @@ class InstanceInitializerSsh(object):
     ## Make Commands
 
     async def _find_makefiles(self, executer):
-        logging.info("Finding Makefiles on %s", executer._ips)
+        logging.info("Finding Makefiles on %s", await executer.ips())
         return await self._find_files(executer,
             self._config('makefile_root_dirs'), 'Makefile')
 
-    async def _get_restart_make_cmds(self, executer):
-        makefiles = self._makefiles or await self._find_makefiles(executer)
+    def _get_restart_make_cmds(self, makefiles):
         makefile_dirs = [os.path.dirname(m) for m in makefiles]
         return ["cd {} && make production_bounce".format(make_dir)
             for make_dir in makefile_dirs]
 
 
+class InstanceInitializerSsh(InstanceInitializer):
 
+    def __init__(self, ssh_key, config, emulate=None):
+        super().__init__(config, emulate=emulate)
+        self._ssh_key = ssh_key
 
+    def _create_executer(self, instances_or_identifiers):
+        return Ec2SshExecuter(self._ssh_key, instances_or_identifiers)
 
-# Note: couldn't get SSM tow ork
-
-# class InstanceInitializerSsm(object):
-
-#     async def initialize(self, instances_or_identifiers):
-#         self._ec2_ssm_executer = Ec2Commander(instances_or_identifiers)
-
-#         self._mount_efs_volumes()
-#         self._restart_docker_compose()
-#         self._restart_make()
-
-#     def _mount_efs_volumes(self):
-#         cmds = [("sudo mount -t nfs4 -o nfsvers=4.1,rsize=1048576,"
-#                  "wsize=1048576,hard,timeo=600,retrans=2,noresvport "
-#                  "{}/ {}".format(vol[0], vol[1])) for vol in self._config('default_efs_volumes')]
-#         self._ec2_ssm_executer.execute(cmds)
 
-#     def _restart_docker_compose(self):
-#         cmds = []
-#         for yaml_file in DOCKER_COMPOSE_YAML_FILES:
-#             cmds.extend("docker-compose -f {} down".format(yaml_file))
-#             cmds.extend("docker-compose -f {} up -d".format(yaml_file))
-#         self._ec2_ssm_executer.execute(cmds)
+class InstanceInitializerSsm(InstanceInitializer):
+    """Initializes instances via SSM Run Command, which requires that they
+    run the SSM agent and have an instance profile that allows it
+    """
 
-#     def _restart_make(self):
-#         cmds = ["cd {} && make production_bounce".format(d)
-#             for d in MAKEFILE_DIRS]
-#         self._ec2_ssm_executer.execute(cmds)
+    def _create_executer(self, instances_or_identifiers):
+        return Ec2SsmExecuter(instances_or_identifiers)
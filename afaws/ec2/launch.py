@@ -2,12 +2,13 @@ import datetime
 import logging
 import sys
 
-import boto3
-from botocore.exceptions import ClientError, WaiterError
 from .exceptions import PostLaunchFailure
 from .resources import SecurityGroup, Image, Instance
 from .network import SecurityGroupManager
-from ..asyncutils import run_in_loop_executor
+from ..asyncutils import run_in_api_executor
+from ..cache import bypass as bypass_cache
+from ..session import (get_client, get_resource, resolve_aws_context,
+    uses_aws_context)
 
 __all__ = [
     'Ec2Launcher',
@@ -21,15 +22,18 @@ __all__ = [
 
 class Ec2Launcher(object):
 
-    def __init__(self, image_identifier, config, **options):
+    def __init__(self, image_identifier, config, profile=None, region=None,
+            **options):
         self._config = config
-        self._client = boto3.client('ec2')
-        self._ec2 = boto3.resource('ec2')
+        self._aws_context = resolve_aws_context(profile, region)
+        self._client = get_client('ec2', *self._aws_context)
+        self._ec2 = get_resource('ec2', *self._aws_context)
         self._identifier = image_identifier
         self._set_and_validate_options(options)
 
     ## Public Interface
 
+    @uses_aws_context
     async def launch(self, new_instance_names):
         await self._set_new_instance_fields_from_options()
         self._image = await self._get_image()
@@ -37,7 +41,6 @@ class Ec2Launcher(object):
         await self._validate_new_instance_names(new_instance_names)
         instances = await self._create_instances()
         try:
-            await self._associate_iam_instance_profile(instances)
             await self._post_launch_tasks(instances)
         except Exception as e:
             logging.error("Failure in post-launch tasks: %s", e)
@@ -101,8 +104,16 @@ class Ec2Launcher(object):
             raise RuntimeError("New instance names must be unique")
 
 
-        kwargs = dict(Filters=[{'Name': 'tag:Name', 'Values': new_instance_names}])
-        existing_instances = [i.name for i in await Instance.find(**kwargs)]
+        # Names of terminated (or terminating) instances can be reused
+        kwargs = dict(Filters=[
+            {'Name': 'tag:Name', 'Values': new_instance_names},
+            {'Name': 'instance-state-name', 'Values': ['pending', 'running',
+                'stopping', 'stopped']}
+        ])
+        # Not reading through the inventory cache, which could be missing
+        # recently launched instances
+        with bypass_cache():
+            existing_instances = [i.name for i in await Instance.find(**kwargs)]
         if len(existing_instances) > 0:
             raise RuntimeError("The following instances already exist: "
                 "{}".format(', '.join(existing_instances)))
@@ -119,8 +130,6 @@ class Ec2Launcher(object):
 
     async def _create_instances(self):
         # see https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.ServiceResource.create_instances
-        num_new_instance_names = len(self._new_instance_names)
-
         block_device_mappings = []
         for v in self._volumes:
             block_device_mappings.append({
@@ -137,22 +146,21 @@ class Ec2Launcher(object):
                 # 'NoDevice': 'string'
             })
 
+        # Instances are named and tagged by Instance.create_multiple, in
+        # their launch requests
         kwargs = {
             "ImageId": self._image.id,
             "InstanceType": self._instance_type,
             "KeyName": self._key_pair_name,
-            "MinCount": num_new_instance_names,
-            "MaxCount": num_new_instance_names,
             "SecurityGroupIds": self._security_group_ids,
             "BlockDeviceMappings": block_device_mappings,
             "InstanceInitiatedShutdownBehavior": self._instance_initiated_shutdown_behavior,
-            # TODO: can we name it here rather than create tag below ?
-            # KeyName='mykeyname',
+            "IamInstanceProfile": self._config('iam_instance_profile'),
         }
 
         # TODO: launch with specific public ssh key
 
-        logging.info("Creating %s instances", num_new_instance_names)
+        logging.info("Creating %s instances", len(self._new_instance_names))
         logging.info("  InstanceType: %s", self._instance_type)
         logging.info("  KeyName: %s", self._key_pair_name)
         logging.info("  SecurityGroupIds: %s", self._security_group_ids)
@@ -160,26 +168,19 @@ class Ec2Launcher(object):
             for d in block_device_mappings]))
         logging.info("  InstanceInitiatedShutdownBehavior: %s",
             self._instance_initiated_shutdown_behavior)
+        logging.info("  IamInstanceProfile: %s", kwargs["IamInstanceProfile"])
         instances = await Instance.create_multiple(self._new_instance_names,
             tags=self._options.get('tags', {}), **kwargs)
         # at this point, they must all be running
 
         logging.info("%s instances running", len(instances))
-        return instances
-
-    ## Post Launch
-
-    async def _associate_iam_instance_profile(self, instances):
-
         for instance in instances:
             logging.info("  %s - %s", instance.name,
                 instance.classic_address.public_ip
                 if instance.classic_address else '?')
-            await run_in_loop_executor(
-                self._client.associate_iam_instance_profile,
-                IamInstanceProfile=self._config('iam_instance_profile'),
-                InstanceId = instance.id
-            )
+        return instances
+
+    ## Post Launch
 
     async def _add_instances_to_security_groups(self, instances):
         for rule_args in self._config('per_instance_security_group_rules'):
@@ -230,27 +231,34 @@ class Ec2CloneLauncher(Ec2Launcher):
         if not self._volumes:
             self._volumes = [{
                 'device_name': d['DeviceName'],
-                'size': (await run_in_loop_executor(self._ec2.Volume,
-                    d['Ebs']['VolumeId'])).size
+                'size': await run_in_api_executor(self._volume_size,
+                    d['Ebs']['VolumeId'])
             } for d in instance.block_device_mappings]
 
+    def _volume_size(self, volume_id):
+        # Accessing size loads the volume, and so must also be done in the
+        # executor
+        return self._ec2.Volume(volume_id).size
+
     ## Creating new image
 
     async def _create_image(self, instance):
         name_desc = '-'.join([instance.name, instance.id,
             datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')])
         logging.info("Creating image %s", name_desc)
-        image = instance.create_image(
+        image = await run_in_api_executor(instance.create_image,
             Description=name_desc,
             DryRun=False,
             Name=name_desc,
             NoReboot=True
         )
+        Image.invalidate_cache()
 
+        from botocore.exceptions import WaiterError
         logging.info("Waiting for image %s (%s)", image.id, name_desc)
         while True:
             try:
-                image.wait_until_exists('self',
+                await run_in_api_executor(image.wait_until_exists, 'self',
                     Filters=[{'Name':'state','Values':['available']}])
                 break
             except WaiterError as e:
@@ -267,7 +275,8 @@ class Ec2CloneLauncher(Ec2Launcher):
 
     async def _post_launch_tasks(self, instances):
         await super()._post_launch_tasks(instances)
-        await run_in_loop_executor(
+        await run_in_api_executor(
             self._client.deregister_image,
             ImageId=self._image.id
         )
+        Image.invalidate_cache()
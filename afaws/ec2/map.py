@@ -0,0 +1,242 @@
+"""Distributes work items across a fleet of instances, running a command
+per item over ssh.
+
+Rather than statically splitting items between hosts, each host has a
+number of slots (concurrent commands, each over its own ssh connection),
+and every slot takes the next item from a shared queue as soon as it's
+free. Faster hosts thus take more items, and no host sits idle while
+others work through a backlog.
+
+Items whose commands fail (exit with non-zero status) are retried, up to
+max_attempts, preferably on hosts that haven't yet tried them. Hosts that
+can't be reached (e.g. ssh fails) are taken out of rotation, and the items
+they were running are retried elsewhere.
+"""
+
+import asyncio
+import logging
+import re
+import shlex
+import time
+
+from .resources import Instance
+from .ssh import SshClient
+from ..session import resolve_aws_context, uses_aws_context
+
+__all__ = [
+    'Ec2Mapper'
+]
+
+class _Host(object):
+
+    def __init__(self, instance):
+        self.instance_id = instance.id
+        self.name = instance.name
+        self.ip = (instance.classic_address.public_ip
+            if instance.classic_address else None)
+        self.items = 0
+        self.failed_items = 0
+        self.busy = 0.0
+        self.error = None if self.ip else "No public ip address"
+
+    @property
+    def available(self):
+        return not self.error
+
+    def summary(self):
+        return {
+            'name': self.name,
+            'ip': self.ip,
+            'items': self.items,
+            'failed_items': self.failed_items,
+            'busy_s': round(self.busy, 2),
+            'error': self.error
+        }
+
+
+class Ec2Mapper(object):
+
+    PLACEHOLDER_RE = re.compile(r'{(item|index)}')
+
+    def __init__(self, ssh_key, instances_or_identifiers, profile=None,
+            region=None, slots_per_host=1, max_attempts=3,
+            connect_timeout=None):
+        """
+        args
+         - ssh_key -- key for ssh'ing to instances
+         - instances_or_identifiers -- instances to run items on
+
+        kwargs
+         - slots_per_host -- number of items each instance runs at once
+         - max_attempts -- number of times an item is tried, on different
+            hosts if possible, before giving up on it
+         - connect_timeout -- ssh connection timeout
+        """
+        if not hasattr(instances_or_identifiers, 'append'):
+            instances_or_identifiers = [instances_or_identifiers]
+        self._instances_or_identifiers = instances_or_identifiers
+        self._ssh_key = ssh_key
+        self._slots_per_host = slots_per_host
+        self._max_attempts = max_attempts
+        self._connect_timeout = connect_timeout
+        self._aws_context = resolve_aws_context(profile, region)
+
+    ## Public Interface
+
+    @uses_aws_context
+    async def map(self, command_template, items):
+        """Runs command_template, formatted with each item, across the
+        instances.
+
+        In command_template, '{item}' is replaced with the shell quoted
+        item, and '{index}' with the item's index. e.g.
+        'run-model --input {item} > /data/out-{index}.log'. Other braces
+        (e.g. "awk '{print $1}'" or '${HOME}') are left as is.
+
+        Returns dict with
+         - 'items' -- list of per item results, in the order of items, each
+            with 'item', 'command', 'succeeded', 'host' (name of the instance
+            last tried on), 'attempts', 'return_code', 'stdout', 'stderr',
+            'elapsed_s' (of the last attempt), and 'error'
+         - 'hosts' -- per host 'name', 'ip', 'items' (number run), 'failed_items',
+            'busy_s', and 'error' (if taken out of rotation), keyed by
+            instance id
+         - 'elapsed_s'
+        """
+        start = time.monotonic()
+        hosts = [_Host(i) for i in
+            await Instance.find_many(self._instances_or_identifiers)]
+        self._results = [{
+            'item': item,
+            'command': self._command(command_template, item, idx),
+            'succeeded': False,
+            'host': None,
+            'attempts': 0,
+            'return_code': None,
+            'stdout': None,
+            'stderr': None,
+            'elapsed_s': None,
+            'error': None,
+            # instance ids of hosts tried
+            'tried': set()
+        } for idx, item in enumerate(items)]
+        self._hosts = hosts
+        self._pending = list(range(len(self._results)))
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+
+        logging.info("Running %s items on %s instances, with %s slots each",
+            len(self._results), len(hosts), self._slots_per_host)
+        await asyncio.gather(*[self._run_slot(h) for h in hosts
+            if h.available for _ in range(self._slots_per_host)])
+
+        for idx in self._pending:
+            self._results[idx]['error'] = (self._results[idx]['error']
+                or "No hosts available")
+        for r in self._results:
+            del r['tried']
+
+        return {
+            'items': self._results,
+            'hosts': {h.instance_id: h.summary() for h in hosts},
+            'elapsed_s': round(time.monotonic() - start, 2)
+        }
+
+    def _command(self, command_template, item, idx):
+        # not str.format, which would fail on any other braces in the
+        # command (e.g. in awk programs or shell parameter expansions)
+        values = {'item': shlex.quote(str(item)), 'index': str(idx)}
+        return self.PLACEHOLDER_RE.sub(lambda m: values[m.group(1)],
+            command_template)
+
+    ## Scheduling
+
+    def _is_eligible(self, idx, host):
+        """Items are given to hosts that haven't tried them, unless all
+        available hosts have
+        """
+        tried = self._results[idx]['tried']
+        return (host.instance_id not in tried
+            or all(h.instance_id in tried for h in self._hosts if h.available))
+
+    async def _next_item(self, host):
+        """Returns index of next item for host to run, waiting if items
+        are running elsewhere that may need to be retried, or None if
+        there's nothing left for the host to do
+        """
+        async with self._condition:
+            while True:
+                if not host.available or not (self._pending or self._in_flight):
+                    return None
+                for i, idx in enumerate(self._pending):
+                    if self._is_eligible(idx, host):
+                        del self._pending[i]
+                        self._in_flight += 1
+                        return idx
+                await self._condition.wait()
+
+    async def _finish_item(self, idx, retry):
+        async with self._condition:
+            self._in_flight -= 1
+            if retry:
+                self._pending.append(idx)
+            self._condition.notify_all()
+
+    async def _run_slot(self, host):
+        with SshClient(self._ssh_key, host.ip,
+                connect_timeout=self._connect_timeout) as client:
+            while True:
+                idx = await self._next_item(host)
+                if idx is None:
+                    return
+                retry = await self._run_item(client, host, idx)
+                await self._finish_item(idx, retry)
+
+    ## Running items
+
+    async def _run_item(self, client, host, idx):
+        """Runs item on host, recording the outcome, and returns whether
+        the item should be retried
+        """
+        result = self._results[idx]
+        result['attempts'] += 1
+        result['tried'].add(host.instance_id)
+        result['host'] = host.name or host.instance_id
+
+        start = time.monotonic()
+        try:
+            r = await client.execute(result['command'], ignore_errors=True)
+        except Exception as e:
+            elapsed = time.monotonic() - start
+            host.busy += elapsed
+            result['elapsed_s'] = round(elapsed, 2)
+            result['error'] = "Failed to run on {}: {}".format(host.ip,
+                str(e) or e.__class__.__name__)
+            if host.available:
+                logging.warning("Taking %s (%s) out of rotation: %s",
+                    host.name, host.ip, e)
+                host.error = str(e) or e.__class__.__name__
+            return result['attempts'] < self._max_attempts
+
+        elapsed = time.monotonic() - start
+        host.busy += elapsed
+        host.items += 1
+        result.update({
+            'return_code': r.return_code,
+            'stdout': r.stdout,
+            'stderr': r.stderr,
+            'elapsed_s': round(elapsed, 2),
+            'succeeded': r.return_code == 0,
+            'error': None if r.return_code == 0 else
+                "Exited with status {}".format(r.return_code)
+        })
+        if result['succeeded']:
+            logging.info("Item %s succeeded on %s in %.2fs", idx,
+                host.name, elapsed)
+            return False
+
+        host.failed_items += 1
+        retry = result['attempts'] < self._max_attempts
+        logging.warning("Item %s failed on %s with status %s%s", idx,
+            host.name, r.return_code, "; will retry" if retry else "")
+        return retry
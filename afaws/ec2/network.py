@@ -3,28 +3,29 @@
 TODO:
  - support IPv6 ?
 """
+import asyncio
 import logging
 
-import boto3
-
 from .resources import SecurityGroup, Instance
-from ..asyncutils import run_in_loop_executor
+from ..asyncutils import run_in_api_executor
+from ..cache import bypass as bypass_cache
+from ..session import resolve_aws_context, uses_aws_context
 
 class SecurityGroupManager(object):
 
-    def __init__(self, sg_identifier):
-        self._ec2 = boto3.resource('ec2')
+    def __init__(self, sg_identifier, profile=None, region=None):
         self._sg_identifier = sg_identifier
         self._security_group = None
+        self._aws_context = resolve_aws_context(profile, region)
 
-
+    @uses_aws_context
     async def security_group(self):
         if not self._security_group:
-            sg = await SecurityGroup(self._sg_identifier)
-            self._security_group = await run_in_loop_executor(
-                self._ec2.SecurityGroup, sg.id)
+            # SecurityGroup lookup returns loaded ec2.SecurityGroup object
+            self._security_group = await SecurityGroup(self._sg_identifier)
         return self._security_group
 
+    @uses_aws_context
     async def add_rule(self, is_inbound, protocol, from_port, to_port,
             instance_or_identifier):
         sg = await self.security_group()
@@ -32,11 +33,13 @@ class SecurityGroupManager(object):
             'in' if is_inbound else 'out', protocol, from_port, to_port,
             instance_or_identifier, sg.group_name, sg.id)
 
-        i = await Instance(instance_or_identifier)
+        with bypass_cache():
+            # the rule is for the instance's current ip address
+            i = await Instance(instance_or_identifier)
 
         func_name = 'authorize_{}gress'.format('in' if is_inbound else 'e')
         func = getattr(sg, func_name)
-        func(
+        await run_in_api_executor(func,
             GroupId=sg.id,
             IpPermissions=[{
                 'IpProtocol': protocol,
@@ -48,6 +51,7 @@ class SecurityGroupManager(object):
                 }]
             }]
         )
+        SecurityGroup.invalidate_cache()
 
     async def add_inbound_rule(self, protocol, from_port, to_port, instance_or_identifier):
         """Convenience method for add_rule(True, ...)
@@ -59,6 +63,7 @@ class SecurityGroupManager(object):
         """
         await self.add_rule(False, protocol, from_port, to_port, instance_or_identifier)
 
+    @uses_aws_context
     async def remove_rule(self, is_inbound, protocol, from_port, to_port, cidr_ip):
         sg = await self.security_group()
         logging.info("Removing %sbound auth - %s %s %s:%s %s (%s)",
@@ -66,40 +71,74 @@ class SecurityGroupManager(object):
             to_port, sg.group_name, sg.id)
 
         func_name = 'revoke_{}gress'.format('in' if is_inbound else 'e')
+        ip_permission = {
+            'IpProtocol': protocol,
+            'IpRanges': [{
+                'CidrIp': cidr_ip,
+            }]
+        }
+        # ports aren't defined for 'all traffic' (-1) rules
+        if from_port is not None:
+            ip_permission['FromPort'] = from_port
+        if to_port is not None:
+            ip_permission['ToPort'] = to_port
+
         func = getattr(sg, func_name)
-        func(
+        await run_in_api_executor(func,
             GroupId=sg.id,
-            IpPermissions=[
-                {
-                    'FromPort': from_port,
-                    'IpProtocol': protocol,
-                    'IpRanges': [{
-                        'CidrIp': cidr_ip,
-                    }],
-                    'ToPort': to_port
-                }
-            ]
+            IpPermissions=[ip_permission]
         )
+        SecurityGroup.invalidate_cache()
 
     @classmethod
     async def remove_instance_from_rules(cls, instance_or_identifier):
-        logging.info("Removing instance %s from any security group rules",
-            instance_or_identifier)
-        i = await Instance(instance_or_identifier)
-        cidr_ip = '{}/32'.format(i.classic_address.public_ip)
-        ec2_client = boto3.client('ec2')
-        resp = await run_in_loop_executor(ec2_client.describe_security_groups)
-
-        for sg in resp.get('SecurityGroups', []):
-            sg_manager = cls(sg['GroupId'])
-            for ip_perm in sg['IpPermissions']:
-                for ip_range in ip_perm.get('IpRanges',[]):
-                    if ip_range['CidrIp'] == cidr_ip:
-                        await sg_manager.remove_rule(True, ip_perm['IpProtocol'],
-                            ip_perm['FromPort'], ip_perm['ToPort'], cidr_ip)
-
-            for ip_perm in sg['IpPermissionsEgress']:
-                for ip_range in ip_perm.get('IpRanges',[]):
-                    if ip_range['CidrIp'] == cidr_ip:
-                        await sg_manager.remove_rule(False, ip_perm['IpProtocol'],
-                            ip_perm['FromPort'], ip_perm['ToPort'], cidr_ip)
+        return await cls.remove_instances_from_rules([instance_or_identifier])
+
+    @classmethod
+    async def remove_instances_from_rules(cls, instances_or_identifiers):
+        """Removes any security group rules referencing the instances' ip
+        addresses, with a single DescribeSecurityGroups call and with all
+        revocations run concurrently.
+
+        Returns dict of the number of rules removed, keyed by instance id
+        """
+        logging.info("Removing instances %s from any security group rules",
+            instances_or_identifiers)
+        # Not reading through the inventory cache, which could be missing
+        # recently added rules, leaving rules for ip addresses that may be
+        # reassigned to other instances
+        with bypass_cache():
+            instances = await Instance.find_many(instances_or_identifiers)
+        instance_ids_by_cidr_ip = {
+            '{}/32'.format(i.classic_address.public_ip): i.id
+                for i in instances if i.classic_address
+        }
+        num_removed = {i.id: 0 for i in instances}
+        if not instance_ids_by_cidr_ip:
+            return num_removed
+
+        with bypass_cache():
+            security_groups = [g.meta.data for g in await SecurityGroup.all()]
+
+        rules_by_sg_id = {}
+        for sg in security_groups:
+            for is_inbound, key in ((True, 'IpPermissions'),
+                    (False, 'IpPermissionsEgress')):
+                for ip_perm in sg.get(key, []):
+                    for ip_range in ip_perm.get('IpRanges',[]):
+                        cidr_ip = ip_range['CidrIp']
+                        if cidr_ip in instance_ids_by_cidr_ip:
+                            num_removed[instance_ids_by_cidr_ip[cidr_ip]] += 1
+                            rules_by_sg_id.setdefault(sg['GroupId'], []).append(
+                                (is_inbound, ip_perm['IpProtocol'],
+                                ip_perm.get('FromPort'), ip_perm.get('ToPort'),
+                                cidr_ip))
+
+        await asyncio.gather(*[cls(sg_id)._remove_rules(rules)
+            for sg_id, rules in rules_by_sg_id.items()])
+        return num_removed
+
+    async def _remove_rules(self, rules):
+        # resolve security group once, before removing rules concurrently
+        await self.security_group()
+        await asyncio.gather(*[self.remove_rule(*r) for r in rules])
@@ -1,9 +1,10 @@
 import asyncio
 import logging
 
-import boto3
-
+from .execute import Ec2SshExecuter
 from .resources import Instance
+from ..asyncutils import run_in_api_executor
+from ..session import get_client, resolve_aws_context, uses_aws_context
 
 __all__ = [
     'Ec2Reboot'
@@ -11,19 +12,121 @@ __all__ = [
 
 class Ec2Reboot(object):
 
-    def __init__(self):
-        self._client = boto3.client('ec2')
+    WAIT_MODES = ('status', 'ssh', 'none')
+
+    # Give instances a chance to actually go down before polling status
+    # checks, since checks from before the reboot may still read 'ok'
+    REBOOT_SETTLE_WAIT = 15
+
+    def __init__(self, ssh_key=None, profile=None, region=None):
+        self._aws_context = resolve_aws_context(profile, region)
+        self._client = get_client('ec2', *self._aws_context)
+        self._ssh_key = ssh_key
 
     ## Public Interface
 
-    async def reboot(self, instance_identifiers):
-        instances = [await Instance(n) for n in instance_identifiers]
+    @uses_aws_context
+    async def reboot(self, instance_identifiers, wait='status',
+            max_unavailable=None):
+        """Reboots instances and waits for them to be ready
 
-        instance_ids = [i.id for i in instances]
-        self._client.reboot_instances(InstanceIds=instance_ids, DryRun=False)
+        args
+         - instance_identifiers -- instance names, ids, or objects
+
+        kwargs
+         - wait -- how to determine readiness:
+            'status': system and instance status checks are 'ok'
+            'ssh': instance is accepting ssh connections after having booted
+                (requires ssh_key)
+            'none': don't wait
+         - max_unavailable -- if specified, reboot on a rolling basis, with
+            at most this many instances rebooting at any given time
+        """
+        if wait not in self.WAIT_MODES:
+            raise ValueError("Invalid wait mode '{}'. Must be one of {}".format(
+                wait, ', '.join(self.WAIT_MODES)))
+        if wait == 'ssh' and not self._ssh_key:
+            raise ValueError("ssh key required to wait for ssh connectivity")
+        if max_unavailable is not None and max_unavailable < 1:
+            raise ValueError("max_unavailable must be at least 1")
 
-        await asyncio.gather(*[
-            Instance.wait_until_running(instance) for instance in instances
-        ])
+        instances = await Instance.find_many(instance_identifiers)
+        if not instances:
+            return instances
+
+        batch_size = max_unavailable or len(instances)
+        for idx in range(0, len(instances), batch_size):
+            await self._reboot_batch(instances[idx:idx+batch_size], wait)
 
         return instances
+
+    async def _reboot_batch(self, instances, wait):
+        instance_ids = [i.id for i in instances]
+
+        boot_ids = None
+        if wait == 'ssh':
+            boot_ids = await self._get_boot_ids(instances)
+
+        logging.info("Rebooting instances %s", instance_ids)
+        await run_in_api_executor(self._client.reboot_instances,
+            InstanceIds=instance_ids, DryRun=False)
+
+        if wait == 'status':
+            await asyncio.sleep(self.REBOOT_SETTLE_WAIT)
+            await Instance.wait_for_status_ok(instance_ids)
+
+        elif wait == 'ssh':
+            await asyncio.gather(*[
+                self._wait_for_reboot_over_ssh(instance, boot_ids.get(instance.id))
+                    for instance in instances
+            ])
+
+    ## SSH readiness
+
+    BOOT_ID_CMD = 'cat /proc/sys/kernel/random/boot_id'
+    BOOT_ID_RETRY_WAIT = 10
+    # retry for up to 10 minutes
+    MAX_BOOT_ID_ATTEMPTS = (60 / BOOT_ID_RETRY_WAIT) * 10
+
+    async def _get_boot_ids(self, instances):
+        boot_ids = {}
+        for instance, boot_id in zip(instances, await asyncio.gather(*[
+                self._get_boot_id(instance) for instance in instances])):
+            boot_ids[instance.id] = boot_id
+        return boot_ids
+
+    async def _get_boot_id(self, instance):
+        try:
+            executer = Ec2SshExecuter(self._ssh_key, instance)
+            output = await executer.execute(self.BOOT_ID_CMD)
+            return list(output['STDOUT'].values())[0][0][1][0].strip()
+        except Exception as e:
+            logging.info("Failed to get boot id of %s: %s", instance.id, e)
+            return None
+
+    async def _wait_for_reboot_over_ssh(self, instance, old_boot_id):
+        """Waits until instance accepts ssh connections and reports a boot id
+        different from the one it had before the reboot. If that's unknown,
+        waits for status checks to be 'ok' first, since any successful
+        connection could otherwise be from before the reboot
+        """
+        logging.info("Waiting for %s (%s) to reboot and accept ssh connections",
+            instance.name, instance.id)
+        if old_boot_id is None:
+            logging.info("Boot id of %s (%s) from before reboot unknown; "
+                "waiting for status checks", instance.name, instance.id)
+            await asyncio.sleep(self.REBOOT_SETTLE_WAIT)
+            await Instance.wait_for_status_ok([instance.id])
+
+        attempts = 0
+        while True:
+            boot_id = await self._get_boot_id(instance)
+            if boot_id and boot_id != old_boot_id:
+                logging.info("%s (%s) has rebooted", instance.name, instance.id)
+                return
+
+            attempts += 1
+            if attempts >= self.MAX_BOOT_ID_ATTEMPTS:
+                raise RuntimeError("{} ({}) failed to reboot".format(
+                    instance.name, instance.id))
+            await asyncio.sleep(self.BOOT_ID_RETRY_WAIT)
@@ -0,0 +1,311 @@
+"""Converges EC2 fleets to a desired state.
+
+The desired state is a dict (e.g. loaded from a JSON file) like:
+
+    {
+        "config": {
+            "iam_instance_profile": {"Name": "web-server"}
+        },
+        "fleets": [
+            {
+                "name": "web",
+                "image": "web-5-2018-Nov-15",
+                "name_format": "web-{}",
+                "count": 3,
+                "launch_options": {
+                    "instance_type": "t2.small",
+                    "key_pair_name": "johns_key",
+                    "security_groups": ["web-server-ports"],
+                    "ebs_volume_size": 32,
+                    "ebs_device_name": "/dev/xvda"
+                },
+                "elb_pools": ["web"],
+                "config": {
+                    "per_instance_security_group_rules": [
+                        ["web-db", true, "tcp", 5432, 5432]
+                    ]
+                }
+            }
+        ]
+    }
+
+Instead of "name_format" and "count", fleets may list instance names
+explicitly with "instances". Each fleet's "config" is merged into the
+top level "config", and the result used as launch config (see
+afaws.config.Config). "per_instance_security_group_rules" are also the
+rules that each of the fleet's instances are expected to have.
+
+FleetReconciler fetches current state in bulk - one describe call for all
+instances, and one load per ELB pool and security group - and plans the
+minimal set of actions: launching missing instances, starting stopped
+ones, registering instances missing from pools, and adding missing
+security group rules. Actions run concurrently, except that those
+involving instances being launched, started, or still pending wait for
+them to be running.
+
+Instances that aren't in the desired state are left alone.
+"""
+
+import asyncio
+import copy
+import logging
+
+from .elb import ElbPool
+from .launch import Ec2Launcher
+from .network import SecurityGroupManager
+from .resources import Instance, SecurityGroup
+from ..asyncutils import run_in_api_executor
+from ..cache import bypass as bypass_cache
+from ..config import Config
+from ..session import get_client, resolve_aws_context, uses_aws_context
+
+__all__ = [
+    'InvalidDesiredStateError',
+    'FleetReconciler'
+]
+
+class InvalidDesiredStateError(ValueError):
+    pass
+
+class FleetReconciler(object):
+
+    # Terminated and shutting-down instances are treated as missing
+    EXISTING_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+    def __init__(self, desired_state, profile=None, region=None):
+        self._fleets = [self._normalize_fleet(f, desired_state.get('config', {}))
+            for f in desired_state.get('fleets', [])]
+        names = [n for f in self._fleets for n in f['instances']]
+        if len(names) != len(set(names)):
+            raise InvalidDesiredStateError("Instance names must be unique "
+                "across fleets")
+        self._aws_context = resolve_aws_context(profile, region)
+        self._client = get_client('ec2', *self._aws_context)
+
+    def _normalize_fleet(self, fleet, config):
+        fleet = copy.deepcopy(fleet)
+        if not fleet.get('name') or not fleet.get('image'):
+            raise InvalidDesiredStateError("Each fleet must specify 'name' "
+                "and 'image'")
+
+        if 'instances' not in fleet:
+            if not fleet.get('name_format') or fleet.get('count') is None:
+                raise InvalidDesiredStateError("Fleet {} must specify "
+                    "'instances', or 'name_format' and 'count'".format(
+                    fleet['name']))
+            fleet['instances'] = [fleet['name_format'].format(i)
+                for i in range(1, fleet['count'] + 1)]
+
+        fleet['config'] = dict(config, **fleet.get('config', {}))
+        fleet['rules'] = fleet['config'].get(
+            'per_instance_security_group_rules', [])
+        fleet.setdefault('elb_pools', [])
+        fleet.setdefault('launch_options', {})
+        return fleet
+
+    ## Public Interface
+
+    @uses_aws_context
+    async def plan(self):
+        """Returns list of actions needed to reach the desired state. Each
+        action is a dict with 'type' ('launch', 'start', 'wait' (for
+        pending instances to be running), 'register', or 'add_rule'),
+        'instances', 'depends_on' (index of action that must complete
+        first, or None), and type specific fields ('fleet', 'pool',
+        'security_group', and 'rule')
+        """
+        instances, pools, security_groups = await self._current_state()
+
+        plan = []
+        for fleet in self._fleets:
+            missing = [n for n in fleet['instances'] if n not in instances]
+            stopped = [n for n in fleet['instances'] if n in instances
+                and instances[n].state['Name'] in ('stopping', 'stopped')]
+            pending = [n for n in fleet['instances'] if n in instances
+                and instances[n].state['Name'] == 'pending']
+
+            launch_idx = start_idx = wait_idx = None
+            if missing:
+                # the launcher adds the fleet's security group rules
+                launch_idx = len(plan)
+                plan.append(self._action('launch', missing, fleet=fleet['name']))
+            if stopped:
+                start_idx = len(plan)
+                plan.append(self._action('start', stopped))
+            if pending:
+                # instances must be running to be registered, and have
+                # ip addresses for rules to be added
+                wait_idx = len(plan)
+                plan.append(self._action('wait', pending))
+
+            def _depends_on(name):
+                if name in stopped:
+                    return start_idx
+                if name in pending:
+                    return wait_idx
+                return None
+
+            for pool_name in fleet['elb_pools']:
+                registered = self._registered_ids(pools[pool_name])
+                unregistered = [n for n in fleet['instances'] if n in instances
+                    and instances[n].id not in registered]
+                # one action per action (if any) that instances wait for
+                for depends_on in dict.fromkeys(_depends_on(n)
+                        for n in unregistered):
+                    plan.append(self._action('register',
+                        [n for n in unregistered if _depends_on(n) == depends_on],
+                        pool=pool_name, depends_on=depends_on))
+                if missing:
+                    plan.append(self._action('register', missing,
+                        pool=pool_name, depends_on=launch_idx))
+
+            for rule in fleet['rules']:
+                sg = security_groups[rule[0]]
+                for name in fleet['instances']:
+                    if name not in instances:
+                        continue
+                    if name in stopped or name in pending:
+                        # ip address will be assigned (or, if stopped,
+                        # change) when running
+                        plan.append(self._action('add_rule', [name],
+                            security_group=rule[0], rule=list(rule[1:]),
+                            depends_on=_depends_on(name)))
+                    elif not instances[name].classic_address:
+                        logging.warning("Not adding %s rule for %s, which has "
+                            "no public ip address", rule[0], name)
+                    elif not self._has_rule(sg, instances[name], *rule[1:]):
+                        plan.append(self._action('add_rule', [name],
+                            security_group=rule[0], rule=list(rule[1:])))
+
+        return plan
+
+    @uses_aws_context
+    async def apply(self, plan=None):
+        """Executes plan (computing it if not specified), running
+        independent actions concurrently.
+
+        Returns list of actions, each with 'error' set to None if it
+        succeeded, or to an error message
+        """
+        if plan is None:
+            plan = await self.plan()
+        plan = [dict(a) for a in plan]
+
+        tasks = {}
+        def _task(idx):
+            if idx not in tasks:
+                tasks[idx] = asyncio.ensure_future(self._run(plan, idx, _task))
+            return tasks[idx]
+
+        await asyncio.gather(*[_task(idx) for idx in range(len(plan))])
+        return plan
+
+    ## Current State
+
+    async def _current_state(self):
+        names = [n for f in self._fleets for n in f['instances']]
+        pool_names = sorted(set(p for f in self._fleets for p in f['elb_pools']))
+        sg_identifiers = sorted(set(r[0] for f in self._fleets
+            for r in f['rules']))
+
+        # Not reading through the inventory cache, since actions are
+        # planned based on current state (e.g. existing rules)
+        with bypass_cache():
+            instances, pools, security_groups = await asyncio.gather(
+                self._find_instances(names),
+                asyncio.gather(*[ElbPool.from_name(p) for p in pool_names]),
+                asyncio.gather(*[SecurityGroup(g) for g in sg_identifiers]))
+
+        by_name = {}
+        for i in instances:
+            if i.name in by_name:
+                raise InvalidDesiredStateError("More than one instance named "
+                    "{}".format(i.name))
+            by_name[i.name] = i
+
+        return (by_name, dict(zip(pool_names, pools)),
+            dict(zip(sg_identifiers, security_groups)))
+
+    async def _find_instances(self, names):
+        if not names:
+            return []
+        return await Instance.find_all_by_name(names,
+            states=self.EXISTING_STATES)
+
+    def _registered_ids(self, pool):
+        return set(i['Target']['Id'] for tg in pool.target_groups
+            for i in tg.get('instances', []))
+
+    def _has_rule(self, sg, instance, is_inbound, protocol, from_port, to_port):
+        cidr = '{}/32'.format(instance.classic_address.public_ip)
+        permissions = sg.ip_permissions if is_inbound else sg.ip_permissions_egress
+        return any(p['IpProtocol'] == protocol
+            and p.get('FromPort') == from_port and p.get('ToPort') == to_port
+            and any(r['CidrIp'] == cidr for r in p.get('IpRanges', []))
+            for p in permissions)
+
+    def _action(self, action_type, instances, depends_on=None, **fields):
+        return dict(type=action_type, instances=instances,
+            depends_on=depends_on, **fields)
+
+    ## Execution
+
+    async def _run(self, plan, idx, get_task):
+        action = plan[idx]
+        if action['depends_on'] is not None:
+            await get_task(action['depends_on'])
+            if plan[action['depends_on']]['error']:
+                action['error'] = "Skipped because action {} failed".format(
+                    action['depends_on'])
+                return
+
+        logging.info("Running %s for %s", action['type'],
+            ', '.join(action['instances']))
+        try:
+            await getattr(self, '_run_' + action['type'])(action)
+            action['error'] = None
+        except Exception as e:
+            logging.error("Failed to %s %s: %s", action['type'],
+                ', '.join(action['instances']), e)
+            action['error'] = str(e) or e.__class__.__name__
+
+    async def _run_launch(self, action):
+        fleet = [f for f in self._fleets if f['name'] == action['fleet']][0]
+        launcher = Ec2Launcher(fleet['image'], Config(fleet['config']),
+            **fleet['launch_options'])
+        await launcher.launch(action['instances'])
+
+    async def _run_start(self, action):
+        instances = await Instance.find_many(action['instances'])
+        ids = [i.id for i in instances]
+        # instances that are still stopping can't yet be started
+        await Instance.wait_for_states(ids, 'stopped')
+        await run_in_api_executor(self._client.start_instances,
+            InstanceIds=ids)
+        Instance.invalidate_cache()
+        await self._wait_until_ready(instances)
+
+    async def _run_wait(self, action):
+        await self._wait_until_ready(
+            await Instance.find_many(action['instances']))
+
+    async def _wait_until_ready(self, instances):
+        await Instance.wait_for_states([i.id for i in instances], 'running')
+        # ip addresses are assigned on start
+        await asyncio.gather(*[Instance.wait_for_ip_address(i)
+            for i in instances])
+        Instance.invalidate_cache()
+
+    async def _run_register(self, action):
+        pool = await ElbPool.from_name(action['pool'])
+        await pool.add(action['instances'])
+
+    async def _run_add_rule(self, action):
+        from botocore.exceptions import ClientError
+        sg_manager = SecurityGroupManager(action['security_group'])
+        try:
+            await sg_manager.add_rule(*(action['rule'] + action['instances']))
+        except ClientError as e:
+            # rules for started instances may already exist
+            if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+                raise
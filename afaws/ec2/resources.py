@@ -1,13 +1,12 @@
 import abc
 import asyncio
+import json
 import logging
 
-import boto3
-import tornado.gen
-from botocore.exceptions import ClientError
-
 from .exceptions import PostLaunchFailure
-from ..asyncutils import run_in_loop_executor, run_with_retries
+from ..asyncutils import run_in_api_executor
+from ..cache import get_cache
+from ..session import get_client, get_resource, is_resource
 
 __all__ = [
     'ResourceDoesNotExistError',
@@ -22,8 +21,17 @@ class ResourceDoesNotExistError(Exception):
 class FailedToGetIpAddress(RuntimeError):
     pass
 
+class FailedToReachStateError(RuntimeError):
+    pass
+
 class Ec2Resource(abc.ABC):
 
+    @classmethod
+    def _collection_manager(cls):
+        # Looked up on each use, rather than set at class definition,
+        # so that the ec2 resource is only created if and when needed
+        return getattr(get_resource('ec2'), cls._collection_name)
+
     async def __new__(cls, identifier):
         return cls._with_name(await cls._find_one(identifier))
 
@@ -38,15 +46,18 @@ class Ec2Resource(abc.ABC):
 
     @classmethod
     async def _find_one(cls, identifier):
-        if isinstance(identifier, boto3.resources.base.ServiceResource):
+        if is_resource(identifier):
             # already is a resource object
             return identifier
 
+        # imported here, like boto3 (see afaws.session), so that importing
+        # this module doesn't load botocore
+        from botocore.exceptions import ClientError
+
         # try finding image with given id
         try:
             kwargs = {cls._id_field: [identifier]}
-            objs = list(await run_in_loop_executor(
-                cls._collection_manager.filter, **kwargs))
+            objs = await cls._filter(**kwargs)
             if objs:
                 logging.info("Found %s with id %s", cls.__name__, identifier)
                 return objs[0]
@@ -57,8 +68,7 @@ class Ec2Resource(abc.ABC):
         # try finding image with given name
         try:
             name_kwargs = cls._name_kwargs(identifier)
-            objs = list(await run_in_loop_executor(
-                cls._collection_manager.filter, **name_kwargs))
+            objs = await cls._filter(**name_kwargs)
             if objs:
                 if len(objs) > 1:
                     raise ResourceDoesNotExistError("More than one {} with "
@@ -72,20 +82,77 @@ class Ec2Resource(abc.ABC):
             cls.__name__, identifier))
 
     @classmethod
-    async def _all(cls):
-        # todo: use cls._collection_mananger.all?
-        return [e for e in await run_in_loop_executor(
-            cls._collection_manager.filter)]
+    async def _filter(cls, **kwargs):
+        cache = get_cache()
+        cache_key = json.dumps(kwargs, sort_keys=True)
+        data = cache.get(cls.__name__, cache_key)
+        if data is not None:
+            return [cls._from_data(d) for d in data]
+
+        # The collection is lazy; it's iterated (i.e. the describe call(s)
+        # made) in the executor, so as not to block the event loop
+        objs = await run_in_api_executor(
+            lambda: list(cls._collection_manager().filter(**kwargs)))
+        cache.set(cls.__name__, cache_key, [o.meta.data for o in objs])
+        return objs
+
+    @classmethod
+    def _from_data(cls, data):
+        """Creates resource object from describe data, without any API call
+        """
+        obj = getattr(get_resource('ec2'), cls.__name__)(data[cls._data_id_field])
+        obj.meta.data = data
+        return obj
+
+    @classmethod
+    def invalidate_cache(cls):
+        get_cache().invalidate(cls.__name__)
 
+    # Extra kwargs used when listing all resources of a type
+    _list_kwargs = {}
+
+    # Name of server-side filter on resource state, if supported
+    _state_filter_name = None
+
+    @classmethod
+    def list_kwargs(cls, states=None, tags=None, **kwargs):
+        """Returns kwargs for listing resources, with server-side filters
+        on state and on tags (dict of tag key to value or list of values)
+        """
+        kwargs = dict(cls._list_kwargs, **kwargs)
+        filters = list(kwargs.pop('Filters', []))
+        if states:
+            if not cls._state_filter_name:
+                raise ValueError("Can't filter {}s by state".format(
+                    cls.__name__))
+            filters.append({'Name': cls._state_filter_name,
+                'Values': list(states)})
+        for k, v in (tags or {}).items():
+            filters.append({'Name': 'tag:{}'.format(k),
+                'Values': [v] if isinstance(v, str) else list(v)})
+        if filters:
+            kwargs['Filters'] = filters
+        return kwargs
 
     @classmethod
-    async def all(cls):
-        return cls._with_names(await cls._all())
+    async def all(cls, states=None, tags=None):
+        return await cls.find(**cls.list_kwargs(states=states, tags=tags))
 
     @classmethod
     async def find(cls, **kwargs):
-        return cls._with_names([e for e in await run_in_loop_executor(
-            cls._collection_manager.filter, **kwargs)])
+        return cls._with_names(await cls._filter(**kwargs))
+
+    @classmethod
+    async def iter_pages(cls, **kwargs):
+        """Async generator yielding lists of resources one page at a time,
+        as each page of the describe response arrives
+        """
+        pages = iter(cls._collection_manager().filter(**kwargs).pages())
+        while True:
+            page = await run_in_api_executor(next, pages, None)
+            if page is None:
+                return
+            yield cls._with_names(page)
 
     @classmethod
     def name_from_object(cls, obj):
@@ -98,8 +165,9 @@ class Ec2Resource(abc.ABC):
 
 class SecurityGroup(Ec2Resource):
 
-    _collection_manager = boto3.resource('ec2').security_groups
+    _collection_name = 'security_groups'
     _id_field = 'GroupIds'
+    _data_id_field = 'GroupId'
 
     @classmethod
     def _name_kwargs(cls, identifier):
@@ -114,8 +182,14 @@ class SecurityGroup(Ec2Resource):
 
 class Image(Ec2Resource):
 
-    _collection_manager = boto3.resource('ec2').images
+    _collection_name = 'images'
     _id_field = 'ImageIds'
+    _data_id_field = 'ImageId'
+    _state_filter_name = 'state'
+
+    # Need to specify Owners=['self'] when listing to avoid retrieving
+    # all public AMIs
+    _list_kwargs = {'Owners': ['self']}
 
     @classmethod
     def _name_kwargs(cls, identifier):
@@ -132,63 +206,128 @@ class Image(Ec2Resource):
         # obj.name is already defined; just return object
         return obj
 
-    @classmethod
-    async def all(cls):
-        """Overrides base class 'all'
-
-        base class 'all' hangs, maybe because it's retrieving *all*
-        public AMIs. ('Owners' is not an allowed kwarg in 'all', but maybe
-        there's a nother way to specify owner. not sure if it can be passed
-        into 'find'.)
-        """
-        # Need to specify Owners=['self'] to avoid retrieving all public AMIs
-        response = await run_in_loop_executor(
-            boto3.client('ec2').describe_images, Owners=['self'])
-        return [await cls(i['ImageId']) for i in response['Images']]
-
 
 class Instance(Ec2Resource):
 
-    _collection_manager = boto3.resource('ec2').instances
+    _collection_name = 'instances'
     _id_field = 'InstanceIds'
+    _data_id_field = 'InstanceId'
+    _state_filter_name = 'instance-state-name'
 
     @classmethod
     def _name_kwargs(cls, identifier):
+        values = [identifier] if isinstance(identifier, str) else list(identifier)
         return {
-            "Filters": [{'Name': 'tag:Name', 'Values': [identifier]}]
+            "Filters": [{'Name': 'tag:Name', 'Values': values}]
         }
 
     @classmethod
-    async def find_all_by_name(cls, identifier):
+    async def find_many(cls, instances_or_identifiers):
+        """Resolves multiple instances with at most two API calls - one for
+        ids and one for names - rather than one or two per identifier.
+
+        Returns instances in the same order as the identifiers
+        """
+        objs = {}
+        ids = [i for i in instances_or_identifiers
+            if isinstance(i, str) and i.startswith('i-')]
+        names = [i for i in instances_or_identifiers
+            if isinstance(i, str) and not i.startswith('i-')]
+
+        if ids:
+            # Filtering on instance-id, rather than passing InstanceIds,
+            # since the latter fails outright if any one of the ids is
+            # malformed or doesn't exist
+            for obj in await cls.find(Filters=[
+                    {'Name': 'instance-id', 'Values': ids}]):
+                objs[obj.id] = obj
+
+        # ids that weren't found may actually be names
+        names.extend([i for i in ids if i not in objs])
+        if names:
+            for obj in await cls.find(**cls._name_kwargs(names)):
+                if obj.name in objs:
+                    raise ResourceDoesNotExistError("More than one {} with "
+                        "name '{}'".format(cls.__name__, obj.name))
+                objs[obj.name] = obj
+
+        instances = []
+        for i in instances_or_identifiers:
+            if is_resource(i):
+                instances.append(cls._with_name(i))
+            elif i in objs:
+                instances.append(objs[i])
+            else:
+                raise ResourceDoesNotExistError("No {} identified by '{}'".format(
+                    cls.__name__, i))
+        return instances
+
+    @classmethod
+    async def find_all_by_name(cls, identifier, states=None, tags=None):
         # Note: This doesn't seem to work for finding security groups or
         # images by name pattern (e.g. launch-wizard-*), but it does for
         # instances (e.g. web-*)
+        from botocore.exceptions import ClientError
         try:
-            return await cls.find(**cls._name_kwargs(identifier))
+            return await cls.find(**cls.list_kwargs(states=states, tags=tags,
+                **cls._name_kwargs(identifier)))
         except ClientError:
             return []
 
     @classmethod
     async def create_multiple(cls, new_instance_names, tags={}, **kwargs):
-        # These instances won't have names yet
-        instances = await run_in_loop_executor(
-            boto3.resource('ec2').create_instances, **kwargs)
+        """Launches one instance per name, with a request per instance so
+        that each is named (and tagged) at creation, rather than having to
+        wait for instances to exist before tagging them.
+
+        kwargs are passed to create_instances, except for MinCount,
+        MaxCount, and TagSpecifications, which are set here
+        """
+        results = await asyncio.gather(*[
+            cls._create_one(name, tags, **kwargs)
+                for name in new_instance_names
+        ], return_exceptions=True)
+        cls.invalidate_cache()
+
+        instances = [r for r in results if not isinstance(r, Exception)]
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            logging.error("Failed to launch %s of %s instances: %s",
+                len(errors), len(new_instance_names), errors[0])
+            if not instances:
+                raise errors[0]
+            # Report the instances that were launched, so that they can be
+            # cleaned up
+            raise PostLaunchFailure(errors[0], instances)
 
         try:
-            await cls._post_creation_tasks(instances, new_instance_names, tags)
+            await cls._post_creation_tasks(instances)
         except Exception as e:
             logging.error("Failure in post-launch tasks: %s", e)
             raise PostLaunchFailure(e, instances)
+        finally:
+            # states and ip addresses have changed since launch
+            cls.invalidate_cache()
 
         return instances
 
     @classmethod
-    async def _post_creation_tasks(cls, instances, new_instance_names, tags):
-        await asyncio.gather(*[
-            cls._wait_to_name(instance, new_instance_names[i], tags)
-                for i, instance in enumerate(instances)
+    async def _create_one(cls, name, tags, **kwargs):
+        instance_tags = [{'Key': 'Name','Value': name}]
+        for k,v in tags.items():
+            instance_tags.append({'Key': k,'Value': v})
+        kwargs = dict(kwargs, MinCount=1, MaxCount=1, TagSpecifications=[
+            {'ResourceType': t, 'Tags': instance_tags}
+                for t in ('instance', 'volume')
         ])
-        instances = cls._with_names(instances)
+        instance = (await run_in_api_executor(
+            get_resource('ec2').create_instances, **kwargs))[0]
+        logging.info("Launched instance %s %s", instance.id, name)
+        setattr(instance, 'name', name)
+        return instance
+
+    @classmethod
+    async def _post_creation_tasks(cls, instances):
         await asyncio.gather(*[
             cls.wait_until_running(instance) for instance in instances
         ])
@@ -196,26 +335,83 @@ class Instance(Ec2Resource):
             cls.wait_for_ip_address(instance) for instance in instances
         ])
 
-
-    @classmethod
-    async def _wait_to_name(cls, instance, name, tags):
-        logging.info("Waiting until instance %s exists", instance.id)
-        await run_in_loop_executor(instance.wait_until_exists)
-        logging.info("Naming instance %s %s", instance.id, name)
-        instance_tags = [{'Key': 'Name','Value': name}]
-        for k,v in tags.items():
-            instance_tags.append({'Key': k,'Value': v})
-        # For some reason, we sometimes still get 'not exists' error,
-        # so, just wait and retry
-        await run_with_retries(instance.create_tags, [],
-            {'DryRun': False, 'Tags': instance_tags}, False,
-            RuntimeError, log_msg_prefix="Naming instance")
-
     @classmethod
     async def wait_until_running(cls, instance):
         logging.info("Waiting until instance %s (%s) is running",
             instance.id, instance.name)
-        await run_in_loop_executor(instance.wait_until_running)
+        await run_in_api_executor(instance.wait_until_running)
+
+    STATE_POLL_WAIT = 5
+    # poll for up to 10 minutes
+    MAX_STATE_POLL_ATTEMPTS = (60 / STATE_POLL_WAIT) * 10
+
+    @classmethod
+    async def wait_for_states(cls, instance_ids, states):
+        """Waits until all instances are in one of the given states (e.g.
+        'stopped', 'terminated'), polling them together with a single
+        DescribeInstances call per iteration.
+
+        Returns dict of final state, keyed by instance id
+        """
+        states = [states] if isinstance(states, str) else states
+        return await cls._poll(instance_ids, cls._describe_states,
+            lambda state: state in states,
+            "reach state {}".format('/'.join(states)))
+
+    @classmethod
+    async def wait_for_status_ok(cls, instance_ids):
+        """Waits until system and instance status checks are both 'ok' for
+        all instances, polling them together with a single
+        DescribeInstanceStatus call per iteration.
+
+        Returns dict of final (system, instance) status, keyed by instance id
+        """
+        return await cls._poll(instance_ids, cls._describe_status_checks,
+            lambda status: status == ('ok', 'ok'), "pass status checks")
+
+    @classmethod
+    async def _poll(cls, instance_ids, describe, is_done, description):
+        pending = set(instance_ids)
+        results = {}
+        attempts = 0
+        while pending:
+            results.update(await describe(list(pending)))
+            pending = set(i for i in pending if not is_done(results.get(i)))
+            if not pending:
+                break
+
+            attempts += 1
+            if attempts >= cls.MAX_STATE_POLL_ATTEMPTS:
+                logging.error("Instances %s failed to %s", sorted(pending),
+                    description)
+                raise FailedToReachStateError("Instances {} failed to {}".format(
+                    ', '.join(sorted(pending)), description))
+
+            logging.info("Waiting for %s instance(s) to %s", len(pending),
+                description)
+            await asyncio.sleep(cls.STATE_POLL_WAIT)
+
+        logging.info("Done waiting for instances %s to %s",
+            ', '.join(instance_ids), description)
+        return results
+
+    @classmethod
+    async def _describe_states(cls, instance_ids):
+        paginator = get_client('ec2').get_paginator('describe_instances')
+        pages = await run_in_api_executor(
+            lambda: list(paginator.paginate(InstanceIds=instance_ids)))
+        return {i['InstanceId']: i['State']['Name'] for p in pages
+            for r in p['Reservations'] for i in r['Instances']}
+
+    @classmethod
+    async def _describe_status_checks(cls, instance_ids):
+        paginator = get_client('ec2').get_paginator('describe_instance_status')
+        pages = await run_in_api_executor(
+            lambda: list(paginator.paginate(InstanceIds=instance_ids,
+                IncludeAllInstances=True)))
+        return {s['InstanceId']: (s['SystemStatus']['Status'],
+            s['InstanceStatus']['Status'])
+            for p in pages for s in p['InstanceStatuses']}
 
     CLASSIC_ADDRESS_RETRY_WAIT = 10
     # retry for up to 5 minutes
@@ -233,9 +429,9 @@ class Instance(Ec2Resource):
                     cls.MAX_CLASSIC_ADDRESS_ATTEMPTS)
                 raise FailedToGetIpAddress()
 
-            await tornado.gen.sleep(cls.CLASSIC_ADDRESS_RETRY_WAIT)
+            await asyncio.sleep(cls.CLASSIC_ADDRESS_RETRY_WAIT)
 
-            instance.reload()
+            await run_in_api_executor(instance.reload)
 
         # instance must have ip address at this point.
         logging.info("Instance %s has ip address %s", instance.name,
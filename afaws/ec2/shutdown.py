@@ -1,11 +1,12 @@
+import asyncio
+import datetime
 import logging
 
-import boto3
-from botocore.exceptions import ClientError
-
 from .resources import Instance
 from .network import SecurityGroupManager
-from ..asyncutils import run_in_loop_executor, run_with_retries
+from ..asyncutils import run_in_api_executor, run_with_retries
+from ..cache import bypass as bypass_cache
+from ..session import get_client, resolve_aws_context, uses_aws_context
 from .execute import Ec2SshExecuter
 
 
@@ -19,24 +20,85 @@ class FailedToShutDownError(RuntimeError):
 
 class Ec2Shutdown(object):
 
-    def __init__(self):
-        self._client = boto3.client('ec2')
+    def __init__(self, profile=None, region=None):
+        self._aws_context = resolve_aws_context(profile, region)
+        self._client = get_client('ec2', *self._aws_context)
 
     ## Public Interface
 
-    async def shutdown(self, instance_identifiers, terminate=False):
-        instances = [await Instance(n) for n in instance_identifiers]
+    @uses_aws_context
+    async def shutdown(self, instance_identifiers, terminate=False, wait=False):
+        """Stops, or terminates, instances and removes them from any security
+        group rules.
+
+        Security group cleanup runs concurrently with the stop/terminate
+        request. (Instance ip addresses are looked up before either.) If
+        terminating, instances aren't first stopped.
+
+        kwargs
+         - terminate -- terminate rather than just stop
+         - wait -- wait for instances to reach 'stopped' or 'terminated'
 
+        Returns dict of outcomes, keyed by instance id. Each outcome includes
+        'name', 'action', 'state', 'rules_removed', and 'error' (None, unless
+        something failed)
+        """
+        # Not reading through the inventory cache, since instances (and
+        # their ip addresses) are acted on
+        with bypass_cache():
+            instances = await Instance.find_many(instance_identifiers)
         instance_ids = [i.id for i in instances]
+        action = 'terminate' if terminate else 'stop'
 
-        await self._stop(instance_ids)
+        report = {i.id: {
+            'name': i.name,
+            'action': action,
+            'state': None,
+            'rules_removed': None,
+            'error': None
+        } for i in instances}
 
-        if terminate:
-            await run_in_loop_executor(self._client.terminate_instances,
-                InstanceIds=instance_ids)
+        shutdown_task = (self._terminate(instance_ids) if terminate
+            else self._stop(instance_ids))
+        sg_task = SecurityGroupManager.remove_instances_from_rules(instances)
+        shutdown_result, sg_result = await asyncio.gather(shutdown_task,
+            sg_task, return_exceptions=True)
+        Instance.invalidate_cache()
 
-        for i in instances:
-            await SecurityGroupManager.remove_instance_from_rules(i)
+        if isinstance(sg_result, Exception):
+            logging.error("Failed to remove security group rules: %s", sg_result)
+            self._record_error(report, instance_ids,
+                "security group cleanup failed: {}".format(sg_result))
+        else:
+            for i_id, num_removed in sg_result.items():
+                report[i_id]['rules_removed'] = num_removed
+
+        if isinstance(shutdown_result, Exception):
+            logging.error("Failed to %s instances: %s", action, shutdown_result)
+            self._record_error(report, instance_ids,
+                "{} failed: {}".format(action, shutdown_result))
+
+        else:
+            for i_id, state in shutdown_result.items():
+                report[i_id]['state'] = state
+
+            if wait:
+                final_state = 'terminated' if terminate else 'stopped'
+                try:
+                    for i_id, state in (await Instance.wait_for_states(
+                            instance_ids, final_state)).items():
+                        report[i_id]['state'] = state
+                except Exception as e:
+                    logging.error("Failed waiting for instances to be %s: %s",
+                        final_state, e)
+                    self._record_error(report, instance_ids, str(e))
+
+        return report
+
+    def _record_error(self, report, instance_ids, msg):
+        for i_id in instance_ids:
+            report[i_id]['error'] = '; '.join(
+                [e for e in (report[i_id]['error'], msg) if e])
 
     async def _stop(self, instance_ids):
         logging.info("Stopping instances %s", instance_ids)
@@ -44,23 +106,197 @@ class Ec2Shutdown(object):
         #    botocore.exceptions.ClientError: An error occurred (IncorrectInstanceState)
         #      when calling the StopInstances operation: Instance 'i-0a28ec81c26203dd4'
         #      cannot be stopped as it has never reached the 'running' state.
-        await run_with_retries(run_in_loop_executor, [self._client.stop_instances],
-            {'InstanceIds': instance_ids}, True, FailedToShutDownError,
+        from botocore.exceptions import ClientError
+        resp = {}
+        async def _stop():
+            resp.update(await run_in_api_executor(self._client.stop_instances,
+                InstanceIds=instance_ids))
+        await run_with_retries(_stop, [], {}, True, FailedToShutDownError,
             exceptions_whitelist=(ClientError,), # should be tuple
             log_msg_prefix="Shutdown")
+        return self._current_states(resp.get('StoppingInstances', []))
+
+    async def _terminate(self, instance_ids):
+        logging.info("Terminating instances %s", instance_ids)
+        resp = await run_in_api_executor(self._client.terminate_instances,
+            InstanceIds=instance_ids)
+        return self._current_states(resp.get('TerminatingInstances', []))
+
+    def _current_states(self, state_changes):
+        return {e['InstanceId']: e['CurrentState']['Name'] for e in state_changes}
 
 
 class AutoShutdownScheduler(object):
+    """Schedules instances to shut themselves down after some number of
+    minutes, without needing to install anything on them.
+
+    Methods:
+     - 'systemd': transient systemd timer (via systemd-run) that powers off
+        the instance, replacing any timer previously scheduled; scheduled
+        over ssh
+     - 'shutdown': 'shutdown -h +N'; scheduled over ssh
+     - 'tag': tags instances with their expiration time; nothing is run on
+        the instances, and expired instances are terminated by `reap`, which
+        is expected to be run periodically (e.g. by cron)
+
+    With the ssh based methods, whether the instance stops or terminates
+    depends on its instance initiated shutdown behavior.
+    """
 
-    def __init__(self, ssh_key):
+    METHODS = ('systemd', 'shutdown', 'tag')
+
+    TAG_KEY = 'afaws:auto-shutdown-at'
+    TIMER_UNIT = 'afaws-auto-shutdown'
+    # Records scheduled time on the instance, so that it can be listed;
+    # /run is cleared on reboot, like the transient timer / scheduled shutdown
+    MARKER_FILE = '/run/afaws-auto-shutdown-at'
+    TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+    def __init__(self, ssh_key=None, method='systemd', profile=None,
+            region=None):
+        if method not in self.METHODS:
+            raise ValueError("Invalid auto-shutdown method '{}'. Must be one "
+                "of {}".format(method, ', '.join(self.METHODS)))
+        if method != 'tag' and not ssh_key:
+            raise ValueError("ssh key required for auto-shutdown method "
+                "'{}'".format(method))
         self._ssh_key = ssh_key
+        self._method = method
+        self._aws_context = resolve_aws_context(profile, region)
+
+    ## Public Interface
 
+    @uses_aws_context
     async def schedule_termination(self, instances_or_identifiers,
             minutes_until_auto_shutdown):
         logging.info("Scheduling auto-shutdown in %s minutes",
             minutes_until_auto_shutdown)
-        executer = Ec2SshExecuter(self._ssh_key, instances_or_identifiers)
-        await executer.wait_for_ssh_connectivity()
-        await executer.execute("which at || sudo apt-get install -y at")
-        await executer.execute('echo "sudo halt" | at now + {} minutes'.format(
-            minutes_until_auto_shutdown))
+        shutdown_at = (datetime.datetime.utcnow()
+            + datetime.timedelta(minutes=minutes_until_auto_shutdown)
+            ).strftime(self.TIME_FORMAT)
+
+        if self._method == 'tag':
+            with bypass_cache():
+                instances = await Instance.find_many(instances_or_identifiers)
+            await run_in_api_executor(get_client('ec2').create_tags,
+                Resources=[i.id for i in instances],
+                Tags=[{'Key': self.TAG_KEY, 'Value': shutdown_at}])
+            Instance.invalidate_cache()
+
+        else:
+            if self._method == 'systemd':
+                # Replace any previously scheduled timer, since the unit
+                # name must be unique; halt would stop the OS but leave the
+                # instance running, so power off
+                cmd = ("sudo systemctl stop {unit}.timer {unit}.service"
+                    " 2>/dev/null; sudo systemctl reset-failed {unit}.timer"
+                    " {unit}.service 2>/dev/null;"
+                    " sudo systemd-run --unit={unit} --on-active={m}m"
+                    " /bin/systemctl poweroff").format(unit=self.TIMER_UNIT,
+                    m=minutes_until_auto_shutdown)
+            else:
+                cmd = "sudo shutdown -h +{}".format(minutes_until_auto_shutdown)
+            cmd += " && echo {} | sudo tee {} > /dev/null".format(
+                shutdown_at, self.MARKER_FILE)
+
+            executer = Ec2SshExecuter(self._ssh_key, instances_or_identifiers)
+            await executer.wait_for_ssh_connectivity()
+            await executer.execute(cmd)
+
+    @uses_aws_context
+    async def list_scheduled(self, instances_or_identifiers=None):
+        """Returns dict of scheduled shutdown times, keyed by instance id
+
+        With the 'tag' method, instances_or_identifiers is optional; if not
+        specified, all tagged instances are returned.
+        """
+        if self._method == 'tag':
+            kwargs = dict(Filters=[{'Name': 'tag-key', 'Values': [self.TAG_KEY]}])
+            # tags may have been changed elsewhere
+            with bypass_cache():
+                if instances_or_identifiers:
+                    kwargs['InstanceIds'] = [i.id for i in
+                        await Instance.find_many(instances_or_identifiers)]
+                instances = await Instance.find(**kwargs)
+            return {i.id: self._get_tag(i) for i in instances}
+
+        if not instances_or_identifiers:
+            raise ValueError("Specify instances to list auto-shutdowns for")
+        return await self._execute_per_instance(instances_or_identifiers,
+            "cat {} 2>/dev/null || true".format(self.MARKER_FILE))
+
+    @uses_aws_context
+    async def cancel(self, instances_or_identifiers):
+        logging.info("Cancelling auto-shutdown of %s", instances_or_identifiers)
+        if self._method == 'tag':
+            with bypass_cache():
+                instances = await Instance.find_many(instances_or_identifiers)
+            await run_in_api_executor(get_client('ec2').delete_tags,
+                Resources=[i.id for i in instances],
+                Tags=[{'Key': self.TAG_KEY}])
+            Instance.invalidate_cache()
+
+        else:
+            # cancel both timer and scheduled shutdown, in case either was
+            # scheduled by a different method
+            await self._execute_per_instance(instances_or_identifiers, (
+                "sudo systemctl stop {unit}.timer 2>/dev/null;"
+                " sudo shutdown -c 2>/dev/null;"
+                " sudo rm -f {marker}").format(unit=self.TIMER_UNIT,
+                marker=self.MARKER_FILE))
+
+    @uses_aws_context
+    async def reap(self, terminate=True):
+        """Stops or terminates all instances whose auto-shutdown tag has
+        expired, with a single API call. For use with the 'tag' method.
+
+        Returns list of ids of instances shut down
+        """
+        now = datetime.datetime.utcnow().strftime(self.TIME_FORMAT)
+        # Not reading through the inventory cache, which could have tags
+        # that were since removed or extended elsewhere
+        with bypass_cache():
+            instances = await Instance.find(Filters=[
+                {'Name': 'tag-key', 'Values': [self.TAG_KEY]},
+                {'Name': 'instance-state-name', 'Values': ['pending', 'running']}
+            ])
+        # TIME_FORMAT sorts lexicographically
+        expired = [i for i in instances if (self._get_tag(i) or now) < now]
+        if not expired:
+            logging.info("No expired instances")
+            return []
+
+        instance_ids = [i.id for i in expired]
+        logging.info("%s expired instances %s",
+            'Terminating' if terminate else 'Stopping', instance_ids)
+        client = get_client('ec2')
+        if terminate:
+            await run_in_api_executor(client.terminate_instances,
+                InstanceIds=instance_ids)
+        else:
+            await run_in_api_executor(client.stop_instances,
+                InstanceIds=instance_ids)
+            await run_in_api_executor(client.delete_tags,
+                Resources=instance_ids, Tags=[{'Key': self.TAG_KEY}])
+        Instance.invalidate_cache()
+        return instance_ids
+
+    ## Helpers
+
+    def _get_tag(self, instance):
+        for t in instance.tags or []:
+            if t['Key'] == self.TAG_KEY:
+                return t['Value']
+
+    async def _execute_per_instance(self, instances_or_identifiers, cmd):
+        with bypass_cache():
+            instances = await Instance.find_many(instances_or_identifiers)
+        executer = Ec2SshExecuter(self._ssh_key, instances)
+        output = await executer.execute(cmd, ignore_errors=True)
+        results = {}
+        for i in instances:
+            ip = i.classic_address.public_ip if i.classic_address else None
+            lines = [l.strip() for _, out in output['STDOUT'].get(ip, [])
+                for l in out]
+            results[i.id] = lines[0] if lines else None
+        return results
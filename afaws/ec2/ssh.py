@@ -9,21 +9,94 @@ or
 > with SshClient('sdsdf', 1.2.3.4) as client:
 >     client.execute('echo Foo')
 
+Long-running processes (e.g. the afaws daemon) can call
+`enable_connection_pool`, after which closed clients' connections are kept
+open, for up to max_idle_time seconds, and reused by new clients to the
+same host.
 """
 
+import io
 import logging
 import os
-
-from fabric.connection import Connection
-from invoke.exceptions import UnexpectedExit
+import posixpath
+import shlex
+import tarfile
+import threading
+import time
 
 from ..asyncutils import run_in_loop_executor
 
+__all__ = [
+    'SshClient',
+    'SshConnectionPool',
+    'enable_connection_pool',
+    'get_connection_pool'
+]
+
+class SshConnectionPool(object):
+
+    def __init__(self, max_idle_time=300):
+        self._max_idle_time = max_idle_time
+        # lists of (connection, time released), keyed by (ip, key, timeout);
+        # each connection is used by only one client at a time
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Returns idle, open connection for key, or None
+        """
+        self.close_expired()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                connection, _ = idle.pop()
+                if connection.is_connected:
+                    logging.debug("Reusing ssh connection to %s", key[0])
+                    return connection
+        return None
+
+    def release(self, key, connection):
+        if connection.is_connected:
+            with self._lock:
+                self._idle.setdefault(key, []).append((connection, time.time()))
+
+    def close_expired(self):
+        expired = []
+        with self._lock:
+            cutoff = time.time() - self._max_idle_time
+            for key in list(self._idle):
+                expired.extend([c for c, t in self._idle[key] if t < cutoff])
+                self._idle[key] = [(c, t) for c, t in self._idle[key]
+                    if t >= cutoff]
+        for connection in expired:
+            connection.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, _ in connections:
+                connection.close()
+
+_connection_pool = None
+
+def enable_connection_pool(max_idle_time=300):
+    global _connection_pool
+    if _connection_pool is None:
+        _connection_pool = SshConnectionPool(max_idle_time)
+    return _connection_pool
+
+def get_connection_pool():
+    """Returns connection pool, or None if not enabled
+    """
+    return _connection_pool
+
 class SshClient(object):
 
-    def __init__(self, ssh_key, ip):
+    def __init__(self, ssh_key, ip, connect_timeout=None):
         self._ssh_key = ssh_key
         self._ip = ip
+        self._connect_timeout = connect_timeout
         self.client = None
 
     def __enter__(self):
@@ -33,18 +106,37 @@ class SshClient(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    @property
+    def _pool_key(self):
+        return (self._ip, self._ssh_key, self._connect_timeout)
+
     def _create_client(self):
+        if self.client is None and _connection_pool:
+            self.client = _connection_pool.acquire(self._pool_key)
+
         if self.client is None:
+            # imported here so that fabric/paramiko are only loaded when needed
+            from fabric.connection import Connection
             self.client = Connection(host=self._ip, user="ubuntu",
-                connect_kwargs={"key_filename": self._ssh_key})
+                connect_kwargs={"key_filename": self._ssh_key},
+                connect_timeout=self._connect_timeout)
 
         return self.client
 
-    async def execute(self, cmd, ignore_errors=False):
+    async def execute(self, cmd, ignore_errors=False, stdin=None):
+        """
+        kwargs
+         - stdin -- text to write to the command's standard input, e.g. to
+            pass values that shouldn't appear in logs or in the remote
+            process list
+        """
+        from invoke.exceptions import UnexpectedExit
+
         logging.info("About to run %s on %s", cmd, self._ip)
+        kwargs = {'in_stream': io.StringIO(stdin)} if stdin is not None else {}
         try:
             return await run_in_loop_executor(
-                self.client.run, cmd, hide=True
+                self.client.run, cmd, hide=True, **kwargs
             )
         except UnexpectedExit as e:
             if ignore_errors:
@@ -54,27 +146,107 @@ class SshClient(object):
         # TODO: handle other exceptions?
 
 
-    async def put(self, local_file_path, remote_file_path):
+    async def put(self, local_file_path, remote_file_path, use_tar=True,
+            compress=False):
         """Uploads local file(s) to remote server, recursively if passed a
         directory.
+
+        By default, directories are streamed as a single tar archive over one
+        channel and unpacked remotely, rather than being uploaded file by
+        file. Pass use_tar=False to fall back to per-file SFTP uploads.
         """
         if os.path.isdir(local_file_path):
-            await self.execute('mkdir {}'.format(remote_file_path))
-            for f in os.listdir(local_file_path):
-                await self.put(os.path.join(local_file_path, f),
-                    os.path.join(remote_file_path, f))
+            if use_tar:
+                await run_in_loop_executor(self._put_dir_as_tar,
+                    local_file_path, remote_file_path, compress)
+            else:
+                await self.execute('mkdir -p {}'.format(
+                    shlex.quote(remote_file_path)))
+                for f in os.listdir(local_file_path):
+                    await self.put(os.path.join(local_file_path, f),
+                        posixpath.join(remote_file_path, f), use_tar=False)
         else:
             await run_in_loop_executor(self.client.put, local_file_path,
                 remote=remote_file_path)
 
-    async def get(self, remote_file_path, local_file_path):
+    async def get(self, remote_file_path, local_file_path, recursive=False,
+            compress=False):
         """Downloads remote files to local file system
 
-        TODO: Support recusrive mode if passed a directory
+        If recursive is True and the remote path is a directory, the
+        directory is streamed back as a single tar archive and unpacked
+        to local_file_path.
         """
-        await run_in_loop_executor(self.client.get, remote_file_path,
-            local=local_file_path)
+        if recursive and await self._is_remote_dir(remote_file_path):
+            await run_in_loop_executor(self._get_dir_as_tar,
+                remote_file_path, local_file_path, compress)
+        else:
+            await run_in_loop_executor(self.client.get, remote_file_path,
+                local=local_file_path)
+
+    async def _is_remote_dir(self, remote_file_path):
+        result = await self.execute('test -d {}'.format(
+            shlex.quote(remote_file_path)), ignore_errors=True)
+        return result.return_code == 0
+
+    ## Tar streaming helpers (blocking; run in executor)
+
+    def _exec_channel(self, cmd):
+        self.client.open()
+        return self.client.client.exec_command(cmd)
+
+    def _put_dir_as_tar(self, local_dir, remote_dir, compress):
+        logging.info("Streaming %s to %s:%s as tar archive", local_dir,
+            self._ip, remote_dir)
+        cmd = 'mkdir -p {dir} && tar -x{z}f - -C {dir}'.format(
+            dir=shlex.quote(remote_dir), z='z' if compress else '')
+        stdin, stdout, stderr = self._exec_channel(cmd)
+        with tarfile.open(fileobj=stdin, mode='w|gz' if compress else 'w|') as tar:
+            for f in sorted(os.listdir(local_dir)):
+                tar.add(os.path.join(local_dir, f), arcname=f)
+        stdin.channel.shutdown_write()
+        self._check_exit_status(cmd, stdout, stderr)
+
+    def _get_dir_as_tar(self, remote_dir, local_dir, compress):
+        logging.info("Streaming %s:%s to %s as tar archive", self._ip,
+            remote_dir, local_dir)
+        os.makedirs(local_dir, exist_ok=True)
+        cmd = 'tar -c{z}f - -C {dir} .'.format(
+            dir=shlex.quote(remote_dir), z='z' if compress else '')
+        stdin, stdout, stderr = self._exec_channel(cmd)
+        root = os.path.realpath(local_dir)
+        with tarfile.open(fileobj=stdout, mode='r|gz' if compress else 'r|') as tar:
+            for member in tar:
+                # don't allow archive members to escape local_dir by path
+                path = os.path.realpath(os.path.join(root, member.name))
+                if os.path.commonpath([root, path]) != root:
+                    raise RuntimeError("Unsafe path in archive: {}".format(
+                        member.name))
+                # Links, which could also point outside of local_dir, and
+                # devices, etc. are skipped rather than failing the transfer
+                if not (member.isfile() or member.isdir()):
+                    logging.warning("Skipping %s:%s/%s - not a regular file "
+                        "or directory (e.g. link or device)", self._ip,
+                        remote_dir, member.name)
+                    continue
+                tar.extract(member, root, **self._extract_kwargs)
+        self._check_exit_status(cmd, stdout, stderr)
+
+    # The 'data' filter (python 3.12+, and security releases of earlier
+    # versions) additionally rejects absolute paths and unsafe permissions
+    _extract_kwargs = ({'filter': 'data'} if hasattr(tarfile, 'data_filter')
+        else {})
+
+    def _check_exit_status(self, cmd, stdout, stderr):
+        status = stdout.channel.recv_exit_status()
+        if status != 0:
+            raise RuntimeError("'{}' failed on {} ({}): {}".format(cmd,
+                self._ip, status, stderr.read().decode().strip()))
 
     def close(self):
         if self.client and self.client.is_connected:
-            self.client.close()
+            if _connection_pool:
+                _connection_pool.release(self._pool_key, self.client)
+            else:
+                self.client.close()
+        self.client = None
@@ -0,0 +1,251 @@
+"""Process-wide, adaptive AWS API rate limiting.
+
+Every EC2 and ELB API call made through afaws' shared sessions (see
+afaws.session) passes through a token bucket for its profile, region,
+service, and API family - e.g. EC2 describe calls, EC2 mutating calls, and
+EC2's resource intensive calls (RunInstances, etc.), which AWS throttles
+separately. Other services, like S3, aren't limited.
+Buckets start at AWS's documented refill rates and adapt with AIMD: the
+rate increases additively with each successful call, up to a ceiling, and
+is halved when a call is throttled. Large fleet operations thus run at
+the highest sustainable rate, rather than alternating between bursts and
+long back-offs.
+
+Limiting is done by hooking into botocore's 'before-call' and 'after-call'
+events, so that calls made by paginators, waiters, and resources are
+limited as well as direct client calls. Since calls run in threads of a
+dedicated executor (see run_in_api_executor), waiting for a token blocks
+one of those threads, not the event loop or the default executor's
+threads, which SSH, S3 transfers, etc. use.
+
+Limiting is enabled by default. Set AFAWS_RATE_LIMIT=0, or call
+`configure(enabled=False)`, to disable it.
+"""
+
+import logging
+import os
+import threading
+import time
+
+__all__ = [
+    'AdaptiveTokenBucket',
+    'RateLimiter',
+    'configure',
+    'get_rate_limiter',
+    'is_throttling_error',
+    'register'
+]
+
+THROTTLING_ERROR_CODES = set([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'RequestThrottled',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'EC2ThrottledException',
+    'PriorRequestNotComplete',
+    'SlowDown'
+])
+
+def is_throttling_error(e):
+    """Returns True if e is a botocore ClientError due to throttling
+    """
+    response = getattr(e, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+class AdaptiveTokenBucket(object):
+
+    # Rate changes
+    ADDITIVE_INCREASE = 0.1 # calls per second, per successful call
+    MULTIPLICATIVE_DECREASE = 0.5
+    # Minimum seconds between decreases, so that a burst of throttled
+    # calls made at the old rate only decreases the rate once
+    DECREASE_COOLDOWN = 1.0
+
+    def __init__(self, rate, burst, max_rate=None, min_rate=0.5):
+        """
+        args
+         - rate -- initial rate, in calls per second
+         - burst -- bucket size
+
+        kwargs
+         - max_rate -- ceiling for additive increases; defaults to rate
+         - min_rate -- floor for multiplicative decreases
+        """
+        self.rate = float(rate)
+        self._burst = float(burst)
+        self._max_rate = float(max_rate or rate)
+        self._min_rate = float(min_rate)
+        self._tokens = self._burst
+        self._last = time.monotonic()
+        self._last_decrease = -float('inf')
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self._burst,
+            self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Takes a token, blocking until one is available. Tokens are
+        reserved in order, so waiting callers are served first come, first
+        served.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = 0 if self._tokens >= 0 else -self._tokens / self.rate
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self._max_rate, self.rate + self.ADDITIVE_INCREASE)
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < self.DECREASE_COOLDOWN:
+                return
+            self._last_decrease = now
+            self._refill(now)
+            self.rate = max(self._min_rate,
+                self.rate * self.MULTIPLICATIVE_DECREASE)
+            # Calls already holding tokens will probably be throttled too
+            self._tokens = min(self._tokens, 0)
+
+
+class RateLimiter(object):
+
+    # (rate, burst) by (service, family), from AWS's documented EC2 request
+    # token buckets. Only services with limits are limited; others (e.g.
+    # S3, whose limits are per prefix and far higher) aren't
+    LIMITS = {
+        ('ec2', 'describe'): (20, 100),
+        ('ec2', 'mutate'): (5, 200),
+        ('ec2', 'resource'): (5, 50),
+        ('elbv2', 'describe'): (10, 20),
+        ('elbv2', 'mutate'): (10, 20)
+    }
+    # For families of limited services not in LIMITS
+    DEFAULT_LIMIT = (10, 20)
+    # Rates may increase beyond initial rates, up to this factor, in case
+    # the account's limits have been raised
+    MAX_RATE_FACTOR = 4
+
+    DESCRIBE_PREFIXES = ('Describe', 'Get', 'List', 'Head')
+    RESOURCE_INTENSIVE_OPERATIONS = set([
+        'RunInstances',
+        'StartInstances',
+        'StopInstances',
+        'TerminateInstances',
+        'CreateImage',
+        'CopyImage',
+        'CreateVolume',
+        'CreateSnapshot'
+    ])
+
+    def __init__(self, enabled=True, limits=None):
+        """
+        kwargs
+         - enabled -- whether to limit calls
+         - limits -- dict of (rate, burst) tuples keyed by (service, family),
+            overriding or adding to LIMITS
+        """
+        self._enabled = enabled
+        self._limits = dict(self.LIMITS)
+        self._limits.update(limits or {})
+        self._services = set(k[0] for k in self._limits)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def is_limited(self, service_name):
+        return self._enabled and service_name in self._services
+
+    def family(self, service_name, operation_name):
+        if operation_name.startswith(self.DESCRIBE_PREFIXES):
+            return 'describe'
+        if (service_name == 'ec2'
+                and operation_name in self.RESOURCE_INTENSIVE_OPERATIONS):
+            return 'resource'
+        return 'mutate'
+
+    def bucket(self, aws_context, service_name, operation_name):
+        family = self.family(service_name, operation_name)
+        key = tuple(aws_context) + (service_name, family)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    rate, burst = self._limits.get((service_name, family),
+                        self.DEFAULT_LIMIT)
+                    bucket = AdaptiveTokenBucket(rate, burst,
+                        max_rate=rate * self.MAX_RATE_FACTOR)
+                    self._buckets[key] = bucket
+        return bucket
+
+    ## botocore event handlers
+
+    def before_call(self, aws_context, model):
+        if not self.is_limited(model.service_model.service_name):
+            return
+        bucket = self.bucket(aws_context, model.service_model.service_name,
+            model.name)
+        wait = bucket.acquire()
+        if wait:
+            logging.debug("Waited %.2fs to call %s", wait, model.name)
+
+    def after_call(self, aws_context, model, parsed):
+        if not self.is_limited(model.service_model.service_name):
+            return
+        bucket = self.bucket(aws_context, model.service_model.service_name,
+            model.name)
+        code = (parsed or {}).get('Error', {}).get('Code')
+        if code in THROTTLING_ERROR_CODES:
+            logging.debug("%s throttled; reducing rate from %.2f/s",
+                model.name, bucket.rate)
+            bucket.on_throttle()
+        elif not code:
+            bucket.on_success()
+
+
+_rate_limiter = None
+
+def configure(**kwargs):
+    """Sets up the process-wide rate limiter. See RateLimiter for kwargs
+    """
+    global _rate_limiter
+    _rate_limiter = RateLimiter(**kwargs)
+    return _rate_limiter
+
+def get_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(
+            enabled=os.environ.get('AFAWS_RATE_LIMIT') != '0')
+    return _rate_limiter
+
+def register(events, aws_context):
+    """Registers handlers on a session's event emitter, which must be done
+    before the session's clients are created. Handlers use whichever rate
+    limiter is configured at the time of each call.
+    """
+    def _before_call(model, **kwargs):
+        get_rate_limiter().before_call(aws_context, model)
+
+    def _after_call(model, parsed, **kwargs):
+        get_rate_limiter().after_call(aws_context, model, parsed)
+
+    events.register('before-call', _before_call)
+    events.register('after-call', _after_call)
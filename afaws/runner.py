@@ -0,0 +1,166 @@
+"""Runs a multi-step plan of afaws operations (see afaws.daemon) in one
+process and event loop, so that steps share boto3 clients, resource
+lookups (through the inventory cache, if enabled), and ssh connections,
+and steps that don't depend on each other run concurrently.
+
+A plan is a dict (e.g. loaded from a yaml file) with a list of steps, each
+with a unique 'name', an 'operation' (e.g. 'ec2.launch'), the operation's
+'args', and, optionally, the names of steps it runs 'after', and the
+'profile' and 'region' to run in:
+
+    steps:
+      - name: launch
+        operation: ec2.launch
+        args:
+          new_instance_names: [web-7, web-8]
+          ...
+      - name: add-to-pool
+        operation: elb.add
+        after: [launch]
+        args:
+          pool_name: web
+          instance_identifiers: [web-7, web-8]
+
+If the plan sets 'ordered: true', each step runs after the one before it.
+
+If a step fails, steps that depend on it (directly or indirectly) are
+skipped, while independent steps run to completion.
+"""
+
+import asyncio
+import logging
+import time
+
+from .daemon import OPERATIONS
+from .session import aws_context, resolve_aws_context
+
+__all__ = [
+    'InvalidPlanError',
+    'StepRunner'
+]
+
+class InvalidPlanError(ValueError):
+    pass
+
+
+class StepRunner(object):
+
+    def __init__(self, plan):
+        """
+        args
+         - plan -- dict with 'steps', and, optionally, 'ordered'
+        """
+        self._steps = self._validate(plan)
+
+    @property
+    def steps(self):
+        return self._steps
+
+    ## Validation
+
+    def _validate(self, plan):
+        steps = plan.get('steps') if isinstance(plan, dict) else None
+        if not steps or not isinstance(steps, list):
+            raise InvalidPlanError("Plan must define a list of steps")
+
+        validated = []
+        for idx, step in enumerate(steps):
+            if not isinstance(step, dict):
+                raise InvalidPlanError("Invalid step #{}".format(idx + 1))
+            name = str(step.get('name') or idx + 1)
+            if name in [s['name'] for s in validated]:
+                raise InvalidPlanError("Duplicate step name: {}".format(name))
+            if step.get('operation') not in OPERATIONS:
+                raise InvalidPlanError("Step {} - invalid operation: {}".format(
+                    name, step.get('operation')))
+
+            after = step.get('after') or []
+            after = [after] if isinstance(after, str) else [str(a) for a in after]
+            if plan.get('ordered') and validated:
+                after.append(validated[-1]['name'])
+
+            validated.append({
+                'name': name,
+                'operation': step['operation'],
+                'args': step.get('args') or {},
+                'after': sorted(set(after)),
+                'profile': step.get('profile'),
+                'region': step.get('region')
+            })
+
+        names = [s['name'] for s in validated]
+        for s in validated:
+            unknown = [a for a in s['after'] if a not in names]
+            if unknown:
+                raise InvalidPlanError("Step {} - unknown steps: {}".format(
+                    s['name'], ', '.join(unknown)))
+        self._check_for_cycles(validated)
+
+        return validated
+
+    def _check_for_cycles(self, steps):
+        after = {s['name']: s['after'] for s in steps}
+        done = set()
+        while len(done) < len(after):
+            ready = [n for n in after if n not in done
+                and all(a in done for a in after[n])]
+            if not ready:
+                raise InvalidPlanError("Circular dependencies between steps: "
+                    "{}".format(', '.join(n for n in after if n not in done)))
+            done.update(ready)
+
+    ## Running
+
+    async def run(self):
+        """Runs steps, each as soon as the steps it runs after have
+        succeeded, in the current AWS context unless the step specifies a
+        profile or region.
+
+        Returns dict keyed by step name, with 'status' ('succeeded',
+        'failed', or 'skipped'), 'result', 'error', and 'elapsed_s' for
+        each step
+        """
+        self._results = {s['name']: {
+            'status': None,
+            'result': None,
+            'error': None,
+            'elapsed_s': None
+        } for s in self._steps}
+        self._done = {s['name']: asyncio.Event() for s in self._steps}
+
+        await asyncio.gather(*[self._run_step(s) for s in self._steps])
+        return self._results
+
+    async def _run_step(self, step):
+        name = step['name']
+        result = self._results[name]
+        try:
+            for a in step['after']:
+                await self._done[a].wait()
+            failed = [a for a in step['after']
+                if self._results[a]['status'] != 'succeeded']
+            if failed:
+                logging.warning("Skipping step %s, since %s didn't succeed",
+                    name, ', '.join(failed))
+                result['status'] = 'skipped'
+                result['error'] = "Depends on {}".format(', '.join(failed))
+                return
+
+            logging.info("Running step %s (%s)", name, step['operation'])
+            start = time.monotonic()
+            try:
+                with aws_context(*resolve_aws_context(step['profile'],
+                        step['region'])):
+                    result['result'] = await OPERATIONS[step['operation']](
+                        **step['args'])
+                result['status'] = 'succeeded'
+            except Exception as e:
+                logging.error("Step %s failed: %s", name, e)
+                result['status'] = 'failed'
+                result['error'] = str(e) or e.__class__.__name__
+            result['elapsed_s'] = round(time.monotonic() - start, 2)
+            logging.info("Step %s %s in %ss", name, result['status'],
+                result['elapsed_s'])
+
+        finally:
+            self._done[name].set()
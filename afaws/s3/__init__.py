@@ -1,21 +1,187 @@
+import asyncio
+import collections
+import gzip
 import logging
 import os
 
-import boto3
-import botocore
+from .checksums import ChecksumMismatchError, ChecksummingWriter
+from .progress import TransferProgress
+from ..asyncutils import run_in_loop_executor
+from ..session import get_client, resolve_aws_context, uses_aws_context
+
+__all__ = [
+    'iter_objects',
+    'iter_objects_sharded',
+    'DownloadTooLargeError',
+    'S3Downloader',
+    'S3ObjectStream',
+    'S3Reader'
+]
+
+async def _iter_pages(client, **kwargs):
+    pages = iter(client.get_paginator('list_objects_v2').paginate(**kwargs))
+    while True:
+        page = await run_in_loop_executor(next, pages, None)
+        if page is None:
+            return
+        yield page
+
+async def iter_objects(client, bucket_name, path=None):
+    """Async generator yielding object summaries (dicts with 'Key', 'Size',
+    'ETag', etc.) under path, in key order, listing a page at a time
+    """
+    kwargs = {'Bucket': bucket_name}
+    if path:
+        kwargs['Prefix'] = path
+    async for page in _iter_pages(client, **kwargs):
+        for o in page.get('Contents', []):
+            yield o
+
+_LISTING_DONE = object()
+
+async def iter_objects_sharded(client, bucket_name, path=None,
+        max_concurrency=8, shard_depth=2, max_buffered=10000):
+    """Async generator yielding object summaries under path, like
+    iter_objects, but listing sub-prefixes concurrently, and so not in key
+    order.
+
+    Sub-prefixes are discovered by listing with '/' as delimiter, down to
+    shard_depth levels below path (e.g. date and hour, in
+    'forecasts/<date>/<hour>/...'), below which each sub-prefix is listed
+    sequentially, without delimiter. Listing scales with the number of
+    sub-prefixes, up to max_concurrency; a prefix containing many keys
+    and no sub-prefixes is still listed sequentially.
+
+    kwargs
+     - max_concurrency -- number of prefixes listed at once
+     - shard_depth -- number of levels of sub-prefixes to list
+        concurrently; 0 is equivalent to iter_objects
+     - max_buffered -- maximum number of listed objects not yet consumed,
+        beyond which listing pauses
+    """
+    prefixes = asyncio.Queue()
+    results = asyncio.Queue(maxsize=max_buffered)
+    # prefixes queued or being listed
+    outstanding = [1]
+    # Listing starts inside path, so that its sub-prefixes are at the first
+    # level (and sibling prefixes, e.g. 'forecasts-old/', aren't included)
+    if path and not path.endswith('/'):
+        path += '/'
+    prefixes.put_nowait((path or '', 0))
+
+    async def _list(prefix, depth):
+        if depth >= shard_depth:
+            async for o in iter_objects(client, bucket_name, prefix):
+                await results.put(o)
+            return
+
+        kwargs = {'Bucket': bucket_name, 'Delimiter': '/'}
+        if prefix:
+            kwargs['Prefix'] = prefix
+        async for page in _iter_pages(client, **kwargs):
+            for p in page.get('CommonPrefixes', []):
+                outstanding[0] += 1
+                prefixes.put_nowait((p['Prefix'], depth + 1))
+            for o in page.get('Contents', []):
+                await results.put(o)
+
+    async def _worker():
+        while True:
+            prefix, depth = await prefixes.get()
+            try:
+                await _list(prefix, depth)
+            except Exception as e:
+                await results.put(e)
+            outstanding[0] -= 1
+            if not outstanding[0]:
+                await results.put(_LISTING_DONE)
+
+    workers = [asyncio.ensure_future(_worker())
+        for i in range(max(1, max_concurrency))]
+    try:
+        while True:
+            o = await results.get()
+            if o is _LISTING_DONE:
+                return
+            if isinstance(o, Exception):
+                raise o
+            yield o
+
+    finally:
+        for w in workers:
+            w.cancel()
+
+class DownloadTooLargeError(RuntimeError):
+    pass
 
 class S3Downloader(object):
+    """Downloads objects concurrently, with each transfer run in the loop's
+    executor, so that downloads can overlap with other afaws operations in
+    the same process; e.g. to stage data while instances boot:
+
+    > downloader = S3Downloader('/data/', 'data-bucket')
+    > keys, new_instances = await asyncio.gather(
+    >     downloader.download_all('weather/'),
+    >     Ec2Launcher(image, config).launch(['web-5', 'web-6']))
+    """
+
+    DEFAULT_MAX_CONCURRENCY = 10
+    # Attempts per object, if checksums don't match
+    MAX_ATTEMPTS = 3
+    PARTIAL_SUFFIX = '.afaws-partial'
+    QUARANTINE_SUFFIX = '.corrupt'
+    # seconds between progress reports
+    PROGRESS_REPORT_INTERVAL = 10
+    DEFAULT_LIST_CONCURRENCY = 8
+    DEFAULT_SHARD_DEPTH = 2
 
     def __init__(self, dest_dir, bucket_name, **kwargs):
+        """
+        kwargs
+         - create_dest_dir -- create dest_dir if it doesn't exist
+         - mirror_s3_path -- include bucket name and full key path in local
+            file paths
+         - max_concurrency -- maximum number of objects downloaded at once;
+            default: 10
+         - verify -- verify ETags and any additional checksums while
+            downloading, quarantining (as <file>.corrupt) and retrying
+            objects that don't match; default: True
+         - max_bytes -- fail, before downloading anything, if the objects
+            to download total more than this many bytes; implies listing
+            all objects first, as with largest_first
+         - list_concurrency -- number of sub-prefixes listed at once;
+            default: 8 (see iter_objects_sharded)
+         - shard_depth -- number of levels of sub-prefixes, delimited by
+            '/', to list concurrently; default: 2
+         - largest_first -- list all objects before downloading any, and
+            download them largest first, which holds the whole listing in
+            memory; otherwise, unless max_bytes is set, start downloading
+            while listing, in which case totals aren't known up front;
+            default: False
+         - profile -- AWS profile; defaults to current context's
+         - region -- AWS region; defaults to current context's
+        """
         if not os.path.isdir(dest_dir) and not kwargs.get("create_dest_dir"):
             raise RuntimeError("Desination dir {} does not exist".format(dest_dir))
         self.dest_dir = dest_dir
 
-        s3 = boto3.resource('s3')
-        self.bucket = s3.Bucket(bucket_name)
+        self._aws_context = resolve_aws_context(kwargs.get('profile'),
+            kwargs.get('region'))
+        # clients, unlike resources, can be shared by executor threads
+        self._client = get_client('s3', *self._aws_context)
         self.bucket_name = bucket_name
 
         self.mirror_s3_path =  kwargs.get('mirror_s3_path')
+        self.max_concurrency = (kwargs.get('max_concurrency')
+            or self.DEFAULT_MAX_CONCURRENCY)
+        self.verify = kwargs.get('verify', True)
+        self.max_bytes = kwargs.get('max_bytes')
+        self.list_concurrency = (kwargs.get('list_concurrency')
+            or self.DEFAULT_LIST_CONCURRENCY)
+        self.shard_depth = kwargs.get('shard_depth', self.DEFAULT_SHARD_DEPTH)
+        self.largest_first = kwargs.get('largest_first', False)
+        # Replaced for each call to download_all / iter_downloads
+        self.progress = TransferProgress()
 
         self.local_bucket_dir = (os.path.join(dest_dir, bucket_name)
             if self.mirror_s3_path else dest_dir)
@@ -23,35 +189,353 @@ class S3Downloader(object):
         if not os.path.exists(self.local_bucket_dir):
             os.makedirs(self.local_bucket_dir)
 
-    def download_all(self, path):
+    ## Public Interface
+
+    async def plan(self, path):
+        """Lists objects under path, returning dict with 'objects' (object
+        summaries, largest first), 'total_objects', and 'total_bytes'.
+
+        Raises DownloadTooLargeError if max_bytes is set and exceeded
+        """
+        path = path.strip('/')
+        objects = [o async for o in self._iter_objects(path)]
+        # Largest first, so that big transfers don't start last and
+        # stretch out the tail
+        objects.sort(key=lambda o: o['Size'], reverse=True)
+        plan = {
+            'objects': objects,
+            'total_objects': len(objects),
+            'total_bytes': sum(o['Size'] for o in objects)
+        }
+        logging.info("%s objects (%s bytes) under %s > %s",
+            plan['total_objects'], plan['total_bytes'], self.bucket_name, path)
+        if self.max_bytes is not None and plan['total_bytes'] > self.max_bytes:
+            raise DownloadTooLargeError("{} bytes under {} > {} exceeds limit "
+                "of {}".format(plan['total_bytes'], self.bucket_name, path,
+                self.max_bytes))
+        return plan
+
+    async def download_all(self, path):
+        """Downloads all objects under path, returning list of keys
+        successfully downloaded. See self.progress for throughput
+        """
+        return [key async for key in self.iter_downloads(path)]
+
+    async def iter_downloads(self, path):
+        """Async generator that downloads all objects under path, as
+        they're listed (or largest first, after listing all of them, if
+        largest_first or max_bytes), at most
+        max_concurrency at a time, yielding each key as its download
+        completes. Progress is logged periodically, and tracked in
+        self.progress
+        """
         path = path.strip('/')
-        for o in self.bucket.objects.all():
-            if not path or o.key.startswith(path):
-                self.download_one(o.key, path=path)
+        self.progress = TransferProgress()
+        reporter = asyncio.ensure_future(self._report_progress())
+        pending = set()
+        try:
+            async for o in self._iter_objects_to_download(path):
+                if len(pending) >= self.max_concurrency:
+                    done, pending = await asyncio.wait(pending,
+                        return_when=asyncio.FIRST_COMPLETED)
+                    for k in self._completed(done):
+                        yield k
+                pending.add(asyncio.ensure_future(
+                    self.download_one(o['Key'], path=path)))
+
+            while pending:
+                done, pending = await asyncio.wait(pending,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for k in self._completed(done):
+                    yield k
 
-    def download_one(self, key, path=None):
+        finally:
+            # e.g. if consumer stops iterating early
+            for t in pending:
+                t.cancel()
+            reporter.cancel()
+            self.progress.finish()
+            logging.info("Downloaded %(objects)s of %(total_objects)s objects "
+                "(%(bytes)s bytes) in %(elapsed_s)ss - %(mb_per_s)s MB/s, "
+                "%(objects_per_s)s objects/s", self.progress.summary())
+
+    @uses_aws_context
+    async def download_one(self, key, path=None):
+        """Downloads key, returning the key if successful and None if not
+        """
         # strip path just in case called by client directly with path defined
         path = path and path.strip('/')
         key = key.lstrip('/')
 
         logging.info("Downloading %s > %s", self.bucket_name, key)
 
-        # TODO: check size and warn user if over some threshold
         local_file_name = os.path.join(self.local_bucket_dir, key)
         if not self.mirror_s3_path and path:
             local_file_name = local_file_name.replace(path+'/', '')
 
         local_dir = os.path.dirname(local_file_name)
         if not os.path.exists(local_dir):
-            os.makedirs(local_dir)
+            os.makedirs(local_dir, exist_ok=True)
 
-        try:
-            self.bucket.download_file(key, local_file_name)
+        import botocore.exceptions
+        attempts = 0
+        while True:
+            try:
+                await run_in_loop_executor(self._download, key,
+                    local_file_name)
+                self.progress.add_object()
+                return key
 
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                logging.error("*** %s > %s does not exist",
-                    self.bucket_name, key)
+            except ChecksumMismatchError as e:
+                attempts += 1
+                if attempts >= self.MAX_ATTEMPTS:
+                    logging.error("*** %s > %s failed verification %s times: %s",
+                        self.bucket_name, key, attempts, e)
+                    self.progress.add_object(succeeded=False)
+                    return
+                logging.warning("%s > %s failed verification (%s); retrying",
+                    self.bucket_name, key, e)
+
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+                    logging.error("*** %s > %s does not exist",
+                        self.bucket_name, key)
+                else:
+                    logging.error("*** Failed to download %s > %s",
+                        self.bucket_name, key)
+                self.progress.add_object(succeeded=False)
+                return
+
+            except Exception as e:
+                # e.g. parameter validation or connection errors, which
+                # shouldn't abort other downloads
+                logging.error("*** Failed to download %s > %s: %s",
+                    self.bucket_name, key, e)
+                self.progress.add_object(succeeded=False)
+                return
+
+    ## Helpers
+
+    def _download(self, key, local_file_name):
+        """Downloads key, removing bytes counted in self.progress if the
+        attempt fails, so that retries aren't counted twice. Run in executor
+        thread
+        """
+        attempt_bytes = [0]
+        def _callback(num_bytes):
+            attempt_bytes[0] += num_bytes
+            self.progress.add_bytes(num_bytes)
+
+        try:
+            if self.verify:
+                self._download_verified(key, local_file_name, _callback)
             else:
-                logging.error("*** Failed to download %s > %s",
-                    self.bucket_name, key)
+                self._client.download_file(self.bucket_name, key,
+                    local_file_name, Callback=_callback)
+        except Exception:
+            self.progress.add_bytes(-attempt_bytes[0])
+            raise
+
+    def _supports_param(self, operation_name, param):
+        """Returns whether the installed botocore supports param, since
+        some (e.g. HeadObject's ChecksumMode) are newer than others
+        """
+        operation = self._client.meta.service_model.operation_model(
+            operation_name)
+        return param in operation.input_shape.members
+
+    def _download_verified(self, key, local_file_name, callback):
+        """Downloads to a partial file, computing checksums while writing,
+        and then moves it into place if they match, or to a quarantine file
+        if they don't. Run in executor thread
+        """
+        kwargs = {}
+        if self._supports_param('HeadObject', 'ChecksumMode'):
+            # Additional checksums are only returned if requested
+            kwargs['ChecksumMode'] = 'ENABLED'
+        head = self._client.head_object(Bucket=self.bucket_name, Key=key,
+            **kwargs)
+        part_size = None
+        if '-' in head['ETag']:
+            # Multipart upload; ETag verification requires the part size
+            part_size = self._client.head_object(Bucket=self.bucket_name,
+                Key=key, PartNumber=1)['ContentLength']
+
+        partial_file_name = local_file_name + self.PARTIAL_SUFFIX
+        try:
+            with open(partial_file_name, 'wb') as f:
+                writer = ChecksummingWriter(f, head, part_size=part_size)
+                self._client.download_fileobj(self.bucket_name, key, writer,
+                    Callback=callback)
+            writer.verify()
+
+        except ChecksumMismatchError:
+            os.replace(partial_file_name,
+                local_file_name + self.QUARANTINE_SUFFIX)
+            raise
+
+        except Exception:
+            if os.path.exists(partial_file_name):
+                os.remove(partial_file_name)
+            raise
+
+        logging.debug("Verified %s of %s > %s", ', '.join(writer.algorithms),
+            self.bucket_name, key)
+        os.replace(partial_file_name, local_file_name)
+
+    def _iter_objects(self, path):
+        return iter_objects_sharded(self._client, self.bucket_name, path,
+            max_concurrency=self.list_concurrency, shard_depth=self.shard_depth)
+
+    async def _iter_objects_to_download(self, path):
+        # max_bytes can only be enforced before anything is downloaded
+        # if all objects are listed first
+        if self.largest_first or self.max_bytes is not None:
+            plan = await self.plan(path)
+            self.progress.total_objects = plan['total_objects']
+            self.progress.total_bytes = plan['total_bytes']
+            for o in plan['objects']:
+                yield o
+            return
+
+        async for o in self._iter_objects(path):
+            yield o
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(self.PROGRESS_REPORT_INTERVAL)
+            self.progress.report()
+
+    def _completed(self, done):
+        return [t.result() for t in done if t.result()]
+
+
+class S3ObjectStream(object):
+    """Streaming body of an S3 object, optionally decompressed, with
+    async methods that read in the loop's executor. Use `raw` to read
+    synchronously (e.g. from code already running in a thread).
+    """
+
+    def __init__(self, key, response, decompress=False):
+        self.key = key
+        self.content_length = response.get('ContentLength')
+        self.content_range = response.get('ContentRange')
+        self.etag = response.get('ETag')
+        self.metadata = response.get('Metadata', {})
+        self._body = response['Body']
+        self.decompressed = bool(decompress and (key.endswith('.gz')
+            or response.get('ContentEncoding') == 'gzip'))
+        self.raw = (gzip.GzipFile(fileobj=self._body, mode='rb')
+            if self.decompressed else self._body)
+
+    async def read(self, size=-1):
+        """Returns up to size bytes, or all remaining bytes if size is
+        negative; returns b'' at end of stream
+        """
+        return await run_in_loop_executor(self.raw.read, size)
+
+    async def iter_chunks(self, chunk_size=1024 * 1024):
+        while True:
+            chunk = await self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    async def iter_lines(self, chunk_size=1024 * 1024):
+        """Async generator yielding lines (as bytes, without line endings)
+        """
+        pending = b''
+        async for chunk in self.iter_chunks(chunk_size):
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip(b'\r')
+        if pending:
+            yield pending.rstrip(b'\r')
+
+    def close(self):
+        if self.decompressed:
+            self.raw.close()
+        self._body.close()
+
+
+class S3Reader(object):
+    """Reads objects directly from S3, as streams, rather than via files
+    on disk, so that consumers can process data as it arrives:
+
+    > reader = S3Reader('data-bucket')
+    > async for stream in reader.iter_streams('weather/', decompress=True):
+    >     async for line in stream.iter_lines():
+    >         process(stream.key, line)
+
+    Up to max_prefetch objects beyond the one being consumed are requested
+    ahead of time, so that their responses are ready when needed.
+    """
+
+    DEFAULT_MAX_PREFETCH = 4
+
+    def __init__(self, bucket_name, profile=None, region=None,
+            max_prefetch=DEFAULT_MAX_PREFETCH):
+        """
+        kwargs
+         - max_prefetch -- number of objects to request ahead of the one
+            being consumed; note that each holds a connection from the s3
+            client's pool (of 10, by default) until it's consumed
+        """
+        self.bucket_name = bucket_name
+        self.max_prefetch = max_prefetch
+        self._aws_context = resolve_aws_context(profile, region)
+        self._client = get_client('s3', *self._aws_context)
+
+    @uses_aws_context
+    async def open(self, key, byte_range=None, decompress=False):
+        """Returns S3ObjectStream for key
+
+        kwargs
+         - byte_range -- (first, last) byte positions to read, inclusive,
+            with last None for the rest of the object; positions apply
+            to the stored bytes, and so, with decompress, ranges other
+            than (0, None) only make sense for uncompressed objects
+         - decompress -- decompress gzipped objects (those with '.gz'
+            extensions or gzip content encoding)
+        """
+        kwargs = {'Bucket': self.bucket_name, 'Key': key}
+        if byte_range:
+            kwargs['Range'] = 'bytes={}-{}'.format(byte_range[0],
+                '' if byte_range[1] is None else byte_range[1])
+        response = await run_in_loop_executor(self._client.get_object,
+            **kwargs)
+        return S3ObjectStream(key, response, decompress=decompress)
+
+    async def iter_streams(self, path, byte_range=None, decompress=False):
+        """Async generator yielding S3ObjectStream for each object under
+        path, in key order. Each stream is closed when the next one is
+        requested, so consumers must be done with it by then.
+
+        See `open` for kwargs
+        """
+        path = path.strip('/')
+        pending = collections.deque()
+        stream = None
+        try:
+            async for o in iter_objects(self._client, self.bucket_name, path):
+                pending.append(asyncio.ensure_future(self.open(o['Key'],
+                    byte_range=byte_range, decompress=decompress)))
+                if len(pending) > self.max_prefetch:
+                    stream = await pending.popleft()
+                    yield stream
+                    stream.close()
+
+            while pending:
+                stream = await pending.popleft()
+                yield stream
+                stream.close()
+
+        finally:
+            # e.g. if consumer stops iterating early
+            if stream:
+                stream.close()
+            for t in pending:
+                t.cancel()
+                if t.done() and not t.cancelled() and not t.exception():
+                    t.result().close()
@@ -0,0 +1,192 @@
+"""Incremental verification of S3 objects' ETags and checksums, computed as
+bytes are written, so that downloads don't need a second pass over files.
+
+ETags of objects uploaded in one part are the MD5 of their contents.
+Those of multipart uploads are the MD5 of the concatenated MD5 digests of
+the parts, followed by '-<number of parts>', and so verifying them
+requires knowing the part size (which S3Downloader gets by requesting the
+first part's metadata). Additional checksums (SHA256, SHA1, CRC32, and
+CRC32C), if the object was uploaded with them, are either of the full
+object, or, if followed by '-<number of parts>', composites computed in
+the same way as multipart ETags.
+
+CRC32C requires awscrt (installed with botocore[crt]) or crc32c; if
+neither is installed, CRC32C checksums aren't verified.
+"""
+
+import base64
+import hashlib
+import logging
+import zlib
+
+__all__ = [
+    'ChecksumMismatchError',
+    'ChecksummingWriter'
+]
+
+class ChecksumMismatchError(RuntimeError):
+    pass
+
+
+class _Crc32(object):
+
+    digest_size = 4
+
+    def __init__(self):
+        self._value = 0
+
+    def update(self, data):
+        self._value = self._func(data, self._value)
+
+    def digest(self):
+        return self._value.to_bytes(4, 'big')
+
+    def _func(self, data, value):
+        return zlib.crc32(data, value)
+
+class _Crc32c(_Crc32):
+
+    def _func(self, data, value):
+        return _crc32c_func()(data, value)
+
+_CRC32C_FUNC = None
+
+def _crc32c_func():
+    global _CRC32C_FUNC
+    if _CRC32C_FUNC is None:
+        try:
+            from awscrt import checksums
+            _CRC32C_FUNC = checksums.crc32c
+        except ImportError:
+            import crc32c
+            _CRC32C_FUNC = crc32c.crc32c
+    return _CRC32C_FUNC
+
+def _crc32c_available():
+    try:
+        _crc32c_func()
+        return True
+    except ImportError:
+        return False
+
+HASHERS = {
+    'MD5': hashlib.md5,
+    'SHA256': hashlib.sha256,
+    'SHA1': hashlib.sha1,
+    'CRC32': _Crc32,
+    'CRC32C': _Crc32c
+}
+
+
+class _Checksum(object):
+    """Computes a full object or composite (per part) checksum
+    """
+
+    def __init__(self, algorithm, expected, part_size=None, encoding='base64'):
+        self.algorithm = algorithm
+        self.expected = expected
+        self._encoding = encoding
+        value, _, num_parts = expected.partition('-')
+        self._composite = bool(num_parts)
+        if self._composite and not part_size:
+            raise ValueError("Part size required to verify composite "
+                "{} checksum".format(algorithm))
+        self._part_size = part_size
+        self._hasher = HASHERS[algorithm]()
+        self._part_digests = []
+        self._part_bytes = 0
+
+    def update(self, data):
+        if not self._composite:
+            self._hasher.update(data)
+            return
+
+        while data:
+            chunk = data[:self._part_size - self._part_bytes]
+            self._hasher.update(chunk)
+            self._part_bytes += len(chunk)
+            data = data[len(chunk):]
+            if self._part_bytes == self._part_size:
+                self._end_part()
+
+    def _end_part(self):
+        self._part_digests.append(self._hasher.digest())
+        self._hasher = HASHERS[self.algorithm]()
+        self._part_bytes = 0
+
+    def _encode(self, digest):
+        if self._encoding == 'hex':
+            return digest.hex()
+        return base64.b64encode(digest).decode()
+
+    def computed(self):
+        if not self._composite:
+            return self._encode(self._hasher.digest())
+
+        part_digests = list(self._part_digests)
+        if self._part_bytes:
+            part_digests.append(self._hasher.digest())
+        hasher = HASHERS[self.algorithm]()
+        hasher.update(b''.join(part_digests))
+        return '{}-{}'.format(self._encode(hasher.digest()), len(part_digests))
+
+
+class ChecksummingWriter(object):
+    """Writes to fileobj, while computing the ETag and any additional
+    checksums of the bytes written.
+
+    Since it isn't seekable, boto3's managed transfers write to it in
+    order, buffering parts downloaded out of order.
+    """
+
+    CHECKSUM_ALGORITHMS = ('SHA256', 'SHA1', 'CRC32', 'CRC32C')
+
+    def __init__(self, fileobj, head, part_size=None):
+        """
+        args
+         - fileobj -- file object to write to
+         - head -- head_object response (with ChecksumMode='ENABLED')
+
+        kwargs
+         - part_size -- size of the object's first part, for multipart
+            uploads
+        """
+        self._fileobj = fileobj
+        self._checksums = []
+
+        etag = head['ETag'].strip('"')
+        # ETags of objects encrypted with KMS or customer provided keys
+        # aren't MD5s of their contents
+        if (head.get('ServerSideEncryption') != 'aws:kms'
+                and not head.get('SSECustomerAlgorithm')):
+            self._checksums.append(_Checksum('MD5', etag,
+                part_size=part_size, encoding='hex'))
+
+        for algorithm in self.CHECKSUM_ALGORITHMS:
+            expected = head.get('Checksum' + algorithm)
+            if not expected:
+                continue
+            if algorithm == 'CRC32C' and not _crc32c_available():
+                logging.debug("Can't verify CRC32C checksum without "
+                    "awscrt or crc32c")
+                continue
+            self._checksums.append(_Checksum(algorithm, expected,
+                part_size=part_size))
+
+    def write(self, data):
+        for c in self._checksums:
+            c.update(data)
+        return self._fileobj.write(data)
+
+    def verify(self):
+        """Raises ChecksumMismatchError if any checksum doesn't match
+        """
+        for c in self._checksums:
+            computed = c.computed()
+            if computed != c.expected:
+                raise ChecksumMismatchError("{} mismatch - expected {}, "
+                    "computed {}".format(c.algorithm, c.expected, computed))
+
+    @property
+    def algorithms(self):
+        return [c.algorithm for c in self._checksums]
@@ -0,0 +1,265 @@
+"""Distributes S3 objects to ec2 instances, with each instance pulling
+objects from S3 itself, using presigned URLs, so that instances need no
+AWS credentials and data doesn't pass through the operator's machine.
+
+By default, the objects under a path are partitioned across instances,
+balanced by size, with each instance pulling only its share. With
+`shared=True`, every instance gets every object - either by each pulling
+all of them from S3, or, with `relay=True`, by each pulling its share
+from S3 and then fetching the rest from its peers over the private
+network. Relaying serves each instance's dest dir over http (with
+`python3 -m http.server`), on the instances' private ips, for the
+duration of the transfer; the instances' security groups must allow
+traffic between them on the relay port. Note that the server isn't
+authenticated, and serves everything in dest dir, not just the
+distributed objects, to anything that can reach the relay port.
+
+Presigned URLs, which grant access to objects to anyone who has them,
+are passed to instances over the ssh connection's stdin, rather than in
+commands, so that they don't appear in logs or in instances' process
+lists.
+
+Instances need curl (and, for relaying, python3).
+"""
+
+import asyncio
+import logging
+import os
+import shlex
+import urllib.parse
+
+from . import iter_objects
+from ..asyncutils import run_in_loop_executor
+from ..ec2.resources import Instance
+from ..ec2.ssh import SshClient
+from ..session import get_client, resolve_aws_context, uses_aws_context
+
+__all__ = [
+    'S3FleetDistributor'
+]
+
+class S3FleetDistributor(object):
+
+    DEFAULT_RELAY_PORT = 8765
+    RELAY_PID_FILE = '/tmp/afaws-relay.pid'
+
+    def __init__(self, ssh_key, bucket_name, dest_dir, profile=None,
+            region=None, parallel_downloads_per_host=4, url_expiration=3600,
+            relay_port=DEFAULT_RELAY_PORT):
+        """
+        args
+         - ssh_key -- key for ssh'ing to instances
+         - bucket_name -- bucket to distribute objects from
+         - dest_dir -- directory on instances to save objects in, with
+            paths relative to the path being distributed
+
+        kwargs
+         - parallel_downloads_per_host -- number of objects each instance
+            downloads at once
+         - url_expiration -- seconds before presigned URLs expire
+         - relay_port -- port on which instances serve objects to peers
+        """
+        self._ssh_key = ssh_key
+        self._bucket_name = bucket_name
+        self._dest_dir = dest_dir.rstrip('/') or '/'
+        self._parallel_downloads_per_host = parallel_downloads_per_host
+        self._url_expiration = url_expiration
+        self._relay_port = relay_port
+        self._aws_context = resolve_aws_context(profile, region)
+        self._client = get_client('s3', *self._aws_context)
+
+    ## Public Interface
+
+    @uses_aws_context
+    async def distribute(self, instances_or_identifiers, path=None,
+            shared=False, relay=False):
+        """Distributes objects under path to instances concurrently.
+
+        Returns dict keyed by instance id, with 'name', 'ip', 'keys' (number
+        of objects), 'bytes', and 'error' for each instance
+
+        kwargs
+         - shared -- have every instance get every object, rather than
+            partitioning objects across instances
+         - relay -- with shared, pull each object from S3 only once, and
+            relay it between instances
+        """
+        if relay and not shared:
+            raise ValueError("Relaying only applies to shared objects")
+
+        path = (path or '').strip('/')
+        instances = await Instance.find_many(instances_or_identifiers)
+        # Listing path + '/', so that, e.g., 'data' doesn't match
+        # 'database/...', and skipping 'directory' placeholder objects
+        objects = [o async for o in iter_objects(self._client,
+            self._bucket_name, path and path + '/')
+            if not o['Key'].endswith('/')]
+        # Fail before pulling anything if any objects would be saved
+        # outside of dest_dir
+        for o in objects:
+            self._local_path(o['Key'], path)
+        logging.info("Distributing %s objects (%s bytes) to %s instances",
+            len(objects), sum(o['Size'] for o in objects), len(instances))
+
+        results = {i.id: {
+            'name': i.name,
+            'ip': i.classic_address.public_ip if i.classic_address else None,
+            'keys': 0,
+            'bytes': 0,
+            'error': None
+        } for i in instances}
+
+        if shared and not relay:
+            shares = {i.id: objects for i in instances}
+        else:
+            shares = self._partition(objects, instances)
+
+        await asyncio.gather(*[
+            self._pull_from_s3(i, shares[i.id], path, results[i.id])
+            for i in instances
+        ])
+
+        if relay:
+            await self._relay(instances, shares, path, results)
+
+        return results
+
+    ## Partitioning
+
+    def _partition(self, objects, instances):
+        """Assigns objects, largest first, to the instance with the fewest
+        bytes assigned so far
+        """
+        shares = {i.id: [] for i in instances}
+        totals = {i.id: 0 for i in instances}
+        for o in sorted(objects, key=lambda o: o['Size'], reverse=True):
+            i_id = min(totals, key=lambda k: totals[k])
+            shares[i_id].append(o)
+            totals[i_id] += o['Size']
+        return shares
+
+    ## Pulling
+
+    def _local_path(self, key, path):
+        rel_path = key[len(path) + 1:] if path else key
+        local_path = os.path.normpath(os.path.join(self._dest_dir, rel_path))
+        # e.g. keys containing '../'
+        if os.path.commonpath([self._dest_dir, local_path]) != self._dest_dir:
+            raise ValueError("Key {} would be saved outside of {}".format(
+                key, self._dest_dir))
+        return local_path
+
+    def _presign(self, keys):
+        return [self._client.generate_presigned_url('get_object',
+            Params={'Bucket': self._bucket_name, 'Key': k},
+            ExpiresIn=self._url_expiration) for k in keys]
+
+    def _curl_config_value(self, value):
+        return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+    def _download_command(self, sources, dests):
+        """Returns command that downloads each source url to the
+        corresponding dest path, several at a time, and the curl config,
+        listing urls and dest paths, to pass to it over stdin.
+
+        The config is split into one file per parallel download, in a
+        private temp dir, each downloaded by its own curl process
+        """
+        config = ''.join('url = {}\noutput = {}\n'.format(
+                self._curl_config_value(s), self._curl_config_value(d))
+            for s, d in zip(sources, dests))
+        per_curl = -(-len(sources) // self._parallel_downloads_per_host)
+        cmd = ("mkdir -p {dir} && t=$(mktemp -d) && trap 'rm -rf \"$t\"' EXIT"
+            " && split -l {lines} - \"$t/urls.\""
+            " && ls \"$t\"/urls.* | xargs -n 1 -P {n}"
+            " curl -sSfL --retry 3 --retry-connrefused --create-dirs"
+            " --fail-early -K").format(dir=shlex.quote(self._dest_dir),
+            lines=2 * per_curl, n=self._parallel_downloads_per_host)
+        return cmd, config
+
+    async def _execute(self, instance, cmd, result, stdin=None):
+        """Runs command on instance, recording any failure in result
+        """
+        ip = result['ip']
+        if not ip:
+            result['error'] = "No public ip address"
+            return False
+        try:
+            with SshClient(self._ssh_key, ip) as client:
+                await client.execute(cmd, stdin=stdin)
+        except Exception as e:
+            logging.warning("Failed to run command on %s (%s): %s",
+                instance.id, ip, e)
+            result['error'] = str(e) or e.__class__.__name__
+            return False
+        return True
+
+    async def _pull_from_s3(self, instance, objects, path, result):
+        if not objects:
+            return
+        keys = [o['Key'] for o in objects]
+        urls = await run_in_loop_executor(self._presign, keys)
+        cmd, config = self._download_command(urls,
+            [self._local_path(k, path) for k in keys])
+        logging.info("Pulling %s objects from S3 to %s", len(keys),
+            instance.id)
+        if await self._execute(instance, cmd, result, stdin=config):
+            result['keys'] += len(objects)
+            result['bytes'] += sum(o['Size'] for o in objects)
+
+    ## Relaying
+
+    async def _relay(self, instances, shares, path, results):
+        # Only instances that got their shares can serve them
+        seeders = [i for i in instances if not results[i.id]['error']]
+        serving = []
+        try:
+            started = await asyncio.gather(*[
+                self._execute(i, self._start_server_cmd(i), results[i.id])
+                for i in seeders
+            ])
+            serving = [i for i, s in zip(seeders, started) if s]
+            await asyncio.gather(*[
+                self._pull_from_peers(i, serving, shares, path, results[i.id])
+                for i in instances if not results[i.id]['error']
+            ])
+
+        finally:
+            await asyncio.gather(*[
+                self._execute(i, self._stop_server_cmd(), dict(results[i.id]))
+                for i in serving
+            ])
+
+        for i in instances:
+            missing = [p for p in instances if p not in serving
+                and p.id != i.id and shares[p.id]]
+            if missing and not results[i.id]['error']:
+                results[i.id]['error'] = "Failed to get objects from {}".format(
+                    ', '.join(p.id for p in missing))
+
+    def _start_server_cmd(self, instance):
+        return ("cd {} && (nohup python3 -m http.server {} --bind {} "
+            "> /dev/null 2>&1 & echo $! > {})").format(
+            shlex.quote(self._dest_dir), self._relay_port,
+            instance.private_ip_address, self.RELAY_PID_FILE)
+
+    def _stop_server_cmd(self):
+        return "kill $(cat {pid}) && rm {pid}".format(pid=self.RELAY_PID_FILE)
+
+    async def _pull_from_peers(self, instance, peers, shares, path, result):
+        objects = [o for p in peers if p.id != instance.id
+            for o in shares[p.id]]
+        if not objects:
+            return
+        sources = ["http://{}:{}/{}".format(p.private_ip_address,
+                self._relay_port, urllib.parse.quote(
+                os.path.relpath(self._local_path(o['Key'], path),
+                self._dest_dir)))
+            for p in peers if p.id != instance.id for o in shares[p.id]]
+        cmd, config = self._download_command(sources,
+            [self._local_path(o['Key'], path) for o in objects])
+        logging.info("Pulling %s objects from peers to %s", len(objects),
+            instance.id)
+        if await self._execute(instance, cmd, result, stdin=config):
+            result['keys'] += len(objects)
+            result['bytes'] += sum(o['Size'] for o in objects)
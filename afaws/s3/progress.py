@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+
+__all__ = [
+    'TransferProgress'
+]
+
+MB = 1024 * 1024
+
+class TransferProgress(object):
+    """Tracks bytes and objects transferred, which may be recorded from
+    executor threads (e.g. in boto3 transfer callbacks)
+    """
+
+    def __init__(self, total_objects=None, total_bytes=None):
+        self.total_objects = total_objects
+        self.total_bytes = total_bytes
+        self.objects = 0
+        self.bytes = 0
+        self.failed_objects = 0
+        self._start = time.monotonic()
+        self._end = None
+        self._lock = threading.Lock()
+        # for rates since last report
+        self._last_report = (self._start, 0, 0)
+
+    def add_bytes(self, num_bytes):
+        with self._lock:
+            self.bytes += num_bytes
+
+    def add_object(self, succeeded=True):
+        with self._lock:
+            if succeeded:
+                self.objects += 1
+            else:
+                self.failed_objects += 1
+
+    def finish(self):
+        self._end = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return (self._end or time.monotonic()) - self._start
+
+    def summary(self):
+        elapsed = self.elapsed
+        return {
+            'objects': self.objects,
+            'failed_objects': self.failed_objects,
+            'bytes': self.bytes,
+            'total_objects': self.total_objects,
+            'total_bytes': self.total_bytes,
+            'elapsed_s': round(elapsed, 2),
+            'mb_per_s': round(self.bytes / MB / elapsed, 2) if elapsed else None,
+            'objects_per_s': round(self.objects / elapsed, 2) if elapsed else None
+        }
+
+    def report(self):
+        """Logs progress, with rates since the last report as well as
+        overall rates, so that degraded transfer rates stand out
+        """
+        now = time.monotonic()
+        with self._lock:
+            last_time, last_bytes, last_objects = self._last_report
+            self._last_report = (now, self.bytes, self.objects)
+            interval = now - last_time
+            logging.info("%s/%s objects, %.1f/%.1f MB; current %.2f MB/s, "
+                "%.2f objects/s; overall %.2f MB/s",
+                self.objects, self.total_objects or '?', self.bytes / MB,
+                (self.total_bytes or 0) / MB,
+                (self.bytes - last_bytes) / MB / interval if interval else 0,
+                (self.objects - last_objects) / interval if interval else 0,
+                self.bytes / MB / max(now - self._start, 0.001))
@@ -1,5 +1,8 @@
 import abc
+import asyncio
+import itertools
 import logging
+import os
 import sys
 import traceback
 
@@ -7,9 +10,16 @@ import afscripting
 # note: afconfig is installed by afscripting
 import afconfig
 
+from . import cache
+from .asyncutils import start_loop_watchdog
+from .session import aws_context, aws_context_label
+
 __all__ = [
     'exit_with_msg',
-    'AwsScriptArgs'
+    'AwsScriptArgs',
+    'aws_contexts',
+    'run_in_aws_contexts',
+    'raise_context_errors'
 ]
 
 def exit_with_msg(msg):
@@ -22,17 +32,129 @@ class AwsScriptArgs(abc.ABC):
     REQUIRED_ARGS = []
     OPTIONAL_ARGS = []
     EXAMPLE_STRING = ""
+    # Whether the script can be run in multiple profiles and regions
+    MULTIPLE_AWS_CONTEXTS = True
+    # Whether to use the inventory cache even if --cache isn't specified
+    CACHE_BY_DEFAULT = False
+    # Types of entries to cache even if the cache isn't otherwise enabled
+    CACHED_KINDS = []
+
+    # Supported by all scripts
+    COMMON_OPTIONAL_ARGS = [
+        {
+            'long': '--cache',
+            'help': ("read AWS inventory (instances, security groups, etc.)"
+                " through local cache; can also be enabled by setting"
+                " AFAWS_CACHE=1"),
+            'action': 'store_true'
+        },
+        {
+            'long': '--refresh',
+            'help': "ignore and repopulate cached AWS inventory; implies --cache",
+            'action': 'store_true'
+        },
+        {
+            'long': '--profile',
+            'dest': 'profiles',
+            'help': ("AWS profile to use; repeat to operate on multiple"
+                " accounts concurrently; default: default profile"),
+            'action': 'append',
+            'default': []
+        },
+        {
+            'long': '--region',
+            'dest': 'regions',
+            'help': ("AWS region to use; repeat to operate on multiple"
+                " regions concurrently; default: profile's region"),
+            'action': 'append',
+            'default': []
+        },
+        {
+            'long': '--loop-watchdog',
+            'help': ("report (with stack traces) anything blocking the event"
+                " loop for longer than this many seconds; can also be enabled"
+                " by setting AFAWS_LOOP_WATCHDOG=<seconds>"),
+            'type': float
+        }
+    ]
 
     def __init__(self):
         _, self.args = afscripting.args.parse_args(self.REQUIRED_ARGS,
-            self.OPTIONAL_ARGS, epilog=self.EXAMPLE_STRING)
+            self.OPTIONAL_ARGS + self.COMMON_OPTIONAL_ARGS,
+            epilog=self.EXAMPLE_STRING)
+        self._configure_cache()
+        self._start_loop_watchdog()
+        if not self.MULTIPLE_AWS_CONTEXTS and len(aws_contexts(self.args)) > 1:
+            exit_with_msg("Only one profile and region may be specified")
         self._check_args()
 
+    def _configure_cache(self):
+        enabled = (self.CACHE_BY_DEFAULT or self.args.cache or self.args.refresh
+            or os.environ.get('AFAWS_CACHE') == '1')
+        cache.configure(enabled=enabled, refresh=self.args.refresh,
+            enabled_kinds=self.CACHED_KINDS)
+
+    def _start_loop_watchdog(self):
+        threshold = (self.args.loop_watchdog
+            or float(os.environ.get('AFAWS_LOOP_WATCHDOG') or 0))
+        if not threshold:
+            return
+        try:
+            start_loop_watchdog(threshold)
+        except RuntimeError:
+            # not running in an event loop
+            logging.warning("Event loop watchdog not started")
+
     def _check_args(self):
         # Override in derived classes
         pass
 
 
+def aws_contexts(args):
+    """Returns list of (profile, region) tuples for all combinations of the
+    profiles and regions specified on the command line
+    """
+    return list(itertools.product(args.profiles or [None],
+        args.regions or [None]))
+
+async def run_in_aws_contexts(args, func, *func_args, **func_kwargs):
+    """Runs coroutine function `func` concurrently in each combination of
+    the profiles and regions specified on the command line.
+
+    Returns (results, errors), where results is list of (label, result)
+    tuples for the contexts in which func succeeded, and errors is list of
+    (label, exception) tuples for those in which it failed, and where label
+    is e.g. 'prod:us-west-2'. Each exception is logged, with its context.
+    Failing in one context thus doesn't discard results from others;
+    scripts output results and then call raise_context_errors.
+    """
+    contexts = aws_contexts(args)
+
+    async def _run(profile, region):
+        with aws_context(profile, region):
+            return await func(*func_args, **func_kwargs)
+
+    results = await asyncio.gather(*[_run(*c) for c in contexts],
+        return_exceptions=True)
+
+    labels = [aws_context_label(*c) for c in contexts]
+    errors = [(l, r) for l, r in zip(labels, results)
+        if isinstance(r, Exception)]
+    for label, e in errors:
+        logging.error("Failed in %s: %s", label, e)
+
+    return ([(l, r) for l, r in zip(labels, results)
+        if not isinstance(r, Exception)], errors)
+
+def raise_context_errors(errors):
+    """Raises the first of the errors returned by run_in_aws_contexts, if
+    any, so that scripts exit with failure after outputting results from
+    the contexts that succeeded
+    """
+    if errors:
+        raise errors[0][1]
+
+
 def get_config(args):
     """Merges config file and command line config overrides
 
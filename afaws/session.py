@@ -0,0 +1,158 @@
+"""Shared, lazily created boto3 sessions, clients, and resources.
+
+boto3 is imported, and each session, client and resource is created, only
+on first use, so that importing afaws modules (e.g. to print a script's
+--help) doesn't pay for loading boto3 and service models. Subsequent calls
+return the same objects. Clients are thread-safe and are shared across
+threads; resources are not, and so are cached per thread.
+
+There's one session per AWS profile and region. Which one is used is
+determined by the current AWS context, which defaults to the default
+profile and region, and which can be set for a block of code with
+`aws_context`:
+
+> with aws_context(profile='prod', region='us-east-1'):
+>     instances = await Instance.find_many(['web-1', 'web-2'])
+
+The AWS context is stored in a context variable, so each asyncio task,
+and each function run with run_in_loop_executor, sees the context it was
+started in. This lets operations in several regions or accounts run
+concurrently in one process.
+
+Classes that operate on AWS resources (launchers, executers, ElbPool,
+etc.) accept profile and region kwargs, and capture the current context if
+they're not specified.
+"""
+
+import contextlib
+import contextvars
+import functools
+import threading
+
+__all__ = [
+    'aws_context',
+    'current_aws_context',
+    'resolve_aws_context',
+    'aws_context_label',
+    'uses_aws_context',
+    'get_session',
+    'get_client',
+    'get_resource',
+    'is_resource',
+    'reset'
+]
+
+_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+_thread_local = threading.local()
+
+# (profile, region)
+_current_aws_context = contextvars.ContextVar('afaws_aws_context',
+    default=(None, None))
+
+
+##
+## AWS context
+##
+
+@contextlib.contextmanager
+def aws_context(profile=None, region=None):
+    token = _current_aws_context.set((profile, region))
+    try:
+        yield
+    finally:
+        _current_aws_context.reset(token)
+
+def current_aws_context():
+    """Returns (profile, region) tuple; either may be None, for default
+    """
+    return _current_aws_context.get()
+
+def resolve_aws_context(profile=None, region=None):
+    """Returns (profile, region), using values from the current context
+    for those not specified
+    """
+    current_profile, current_region = current_aws_context()
+    return (profile or current_profile, region or current_region)
+
+def aws_context_label(profile=None, region=None):
+    """Returns human readable label for the given (or current) context,
+    e.g. 'default:us-west-2'
+    """
+    session = get_session(profile, region)
+    return '{}:{}'.format(session.profile_name or 'default',
+        session.region_name or '?')
+
+def uses_aws_context(method):
+    """Decorator for async methods of objects that capture an AWS context
+    (as self._aws_context) at construction, running the method within it
+    """
+    @functools.wraps(method)
+    async def _method(self, *args, **kwargs):
+        with aws_context(*self._aws_context):
+            return await method(self, *args, **kwargs)
+    return _method
+
+
+##
+## Sessions, clients, and resources
+##
+
+def get_session(profile=None, region=None):
+    key = resolve_aws_context(profile, region)
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                import boto3.session
+                session = boto3.session.Session(profile_name=key[0],
+                    region_name=key[1])
+                from . import ratelimit
+                ratelimit.register(session.events, key)
+                _sessions[key] = session
+    return session
+
+def get_client(service_name, profile=None, region=None):
+    key = resolve_aws_context(profile, region) + (service_name,)
+    client = _clients.get(key)
+    if client is None:
+        session = get_session(*key[:2])
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                # Note: session.client isn't itself thread-safe, which
+                # is why it's called while holding the lock
+                client = session.client(service_name)
+                _clients[key] = client
+    return client
+
+def get_resource(service_name, profile=None, region=None):
+    key = resolve_aws_context(profile, region) + (service_name,)
+    session = get_session(*key[:2])
+    resources = getattr(_thread_local, 'resources', None)
+    if resources is None:
+        resources = _thread_local.resources = {}
+    # check session identity, in case sessions were reset
+    if key not in resources or resources[key][0] is not session:
+        with _lock:
+            resources[key] = (session, session.resource(service_name))
+    return resources[key][1]
+
+def reset():
+    """Discards all sessions, clients, and resources, so that new ones are
+    created on next use (e.g. after changing credentials)
+    """
+    global _sessions, _clients
+    with _lock:
+        _sessions = {}
+        _clients = {}
+
+def is_resource(obj):
+    """Returns True if obj is a boto3 resource object (e.g. ec2.Instance)
+    """
+    if isinstance(obj, str):
+        return False
+    import boto3.resources.base
+    return isinstance(obj, boto3.resources.base.ServiceResource)
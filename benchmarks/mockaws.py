@@ -0,0 +1,85 @@
+"""Local, in-process AWS stand-in for benchmarks, using moto, along with
+counting of AWS API calls made through afaws' shared boto3 session.
+"""
+
+import collections
+import contextlib
+import os
+import threading
+
+from afaws import session
+
+__all__ = [
+    'ApiCallCounter',
+    'mock_aws_backend'
+]
+
+class ApiCallCounter(object):
+    """Counts API calls, by '<service>.<operation>', by hooking into
+    botocore's 'before-call' event
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = collections.Counter()
+
+    def __call__(self, model, **kwargs):
+        with self._lock:
+            self._counts['{}.{}'.format(
+                model.service_model.service_name, model.name)] += 1
+
+    @property
+    def counts(self):
+        with self._lock:
+            return dict(self._counts)
+
+    @property
+    def total(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+
+def _moto_context():
+    try:
+        # moto >= 5
+        from moto import mock_aws
+        return mock_aws()
+
+    except ImportError:
+        import moto
+        stack = contextlib.ExitStack()
+        for name in ('mock_ec2', 'mock_elbv2', 'mock_iam', 'mock_s3'):
+            stack.enter_context(getattr(moto, name)())
+        return stack
+
+@contextlib.contextmanager
+def mock_aws_backend(region='us-west-2'):
+    """Starts a fresh mocked AWS backend and afaws session, yielding an
+    ApiCallCounter registered on that session
+    """
+    env = {
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_SECURITY_TOKEN': 'testing',
+        'AWS_SESSION_TOKEN': 'testing',
+        'AWS_DEFAULT_REGION': region
+    }
+    old_env = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        with _moto_context():
+            session.reset()
+            counter = ApiCallCounter()
+            session.get_session().events.register('before-call', counter)
+            yield counter
+    finally:
+        session.reset()
+        for k, v in old_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
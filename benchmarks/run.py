@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+"""run.py: Benchmarks afaws fleet operations against a local mocked AWS
+backend (moto), at various fleet sizes and object counts.
+
+For each operation and size, records wall time, AWS API call counts (per
+operation and total), and peak python memory allocated, and writes the
+results as JSON, so that they can be compared between commits.
+
+Example calls:
+ > python benchmarks/run.py
+ > python benchmarks/run.py -o ec2-launch -o ec2-shutdown -s 10 -s 100
+ > python benchmarks/run.py --output /tmp/before.json
+ > python benchmarks/run.py --compare /tmp/before.json /tmp/after.json
+
+Note that peak memory includes allocations made by the in-process AWS
+stand-in, and that wall time includes any polling sleeps.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tabulate
+
+from afaws.config import Config
+from afaws.ec2.elb import ElbPool
+from afaws.ec2.launch import Ec2Launcher
+from afaws.ec2.network import SecurityGroupManager
+from afaws.ec2.shutdown import Ec2Shutdown
+from afaws.s3 import S3Downloader
+from afaws.session import get_client
+
+from mockaws import mock_aws_backend
+
+FLEET_SIZES = [10, 100, 500]
+OBJECT_COUNTS = [100, 1000, 10000]
+NAME = 'afaws-bench'
+
+
+##
+## Setup helpers
+##
+
+def _create_security_group():
+    client = get_client('ec2')
+    vpc_id = client.describe_vpcs()['Vpcs'][0]['VpcId']
+    return client.create_security_group(GroupName=NAME, Description=NAME,
+        VpcId=vpc_id)['GroupId']
+
+def _get_image_id():
+    return get_client('ec2').describe_images()['Images'][0]['ImageId']
+
+def _run_instances(size, sg_id):
+    client = get_client('ec2')
+    resp = client.run_instances(ImageId=_get_image_id(), InstanceType='t2.micro',
+        MinCount=size, MaxCount=size, SecurityGroupIds=[sg_id])
+    instance_ids = [i['InstanceId'] for i in resp['Instances']]
+    for idx, i_id in enumerate(instance_ids):
+        client.create_tags(Resources=[i_id],
+            Tags=[{'Key': 'Name', 'Value': '{}-{}'.format(NAME, idx)}])
+    return instance_ids
+
+def _authorize_instance_ips(sg_id, instance_ids):
+    client = get_client('ec2')
+    resp = client.describe_instances(InstanceIds=instance_ids)
+    ips = [i['PublicIpAddress'] for r in resp['Reservations']
+        for i in r['Instances'] if i.get('PublicIpAddress')]
+    for ip in ips:
+        client.authorize_security_group_ingress(GroupId=sg_id,
+            IpPermissions=[{'IpProtocol': 'tcp', 'FromPort': 8080,
+                'ToPort': 8080, 'IpRanges': [{'CidrIp': '{}/32'.format(ip)}]}])
+
+
+##
+## Cases
+##
+## Each case is a pair of functions - setup (not timed) and run (timed) -
+## with setup returning state passed to run
+
+# ec2-launch
+
+async def setup_launch(size):
+    _create_security_group()
+    get_client('ec2').create_key_pair(KeyName=NAME)
+    get_client('iam').create_instance_profile(InstanceProfileName=NAME)
+    return {'image_id': _get_image_id()}
+
+async def run_launch(size, state):
+    config = Config({
+        'iam_instance_profile': {'Name': NAME},
+        'per_instance_security_group_rules': [[NAME, True, 'tcp', 8080, 8080]]
+    })
+    launcher = Ec2Launcher(state['image_id'], config, instance_type='t2.micro',
+        key_pair_name=NAME, security_groups=[NAME], ebs_volume_size=8,
+        ebs_device_name='/dev/xvda')
+    await launcher.launch(['{}-{}'.format(NAME, i) for i in range(size)])
+
+# ec2-shutdown
+
+async def setup_shutdown(size):
+    sg_id = _create_security_group()
+    instance_ids = _run_instances(size, sg_id)
+    _authorize_instance_ips(sg_id, instance_ids)
+    return {'instance_ids': instance_ids}
+
+async def run_shutdown(size, state):
+    await Ec2Shutdown().shutdown(state['instance_ids'], terminate=True,
+        wait=True)
+
+# elb-all
+
+async def setup_elb_all(size):
+    ec2_client = get_client('ec2')
+    elb_client = get_client('elbv2')
+    sg_id = _create_security_group()
+    vpc_id = ec2_client.describe_vpcs()['Vpcs'][0]['VpcId']
+    subnets = ec2_client.describe_subnets(
+        Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])['Subnets']
+    lb_arn = elb_client.create_load_balancer(Name=NAME,
+        Subnets=[s['SubnetId'] for s in subnets[:2]],
+        SecurityGroups=[sg_id])['LoadBalancers'][0]['LoadBalancerArn']
+    tg_arn = elb_client.create_target_group(Name=NAME, Protocol='HTTP',
+        Port=80, VpcId=vpc_id)['TargetGroups'][0]['TargetGroupArn']
+    elb_client.create_listener(LoadBalancerArn=lb_arn, Protocol='HTTP',
+        Port=80, DefaultActions=[{'Type': 'forward', 'TargetGroupArn': tg_arn}])
+    instance_ids = _run_instances(size, sg_id)
+    elb_client.register_targets(TargetGroupArn=tg_arn,
+        Targets=[{'Id': i} for i in instance_ids])
+    return {}
+
+async def run_elb_all(size, state):
+    await ElbPool.all()
+
+# sg-remove-instance-from-rules
+
+async def setup_sg_remove(size):
+    sg_id = _create_security_group()
+    instance_ids = _run_instances(size, sg_id)
+    _authorize_instance_ips(sg_id, instance_ids)
+    return {'instance_ids': instance_ids}
+
+async def run_sg_remove(size, state):
+    for i_id in state['instance_ids']:
+        await SecurityGroupManager.remove_instance_from_rules(i_id)
+
+async def run_sg_remove_batched(size, state):
+    await SecurityGroupManager.remove_instances_from_rules(
+        state['instance_ids'])
+
+# s3-download-all
+
+async def setup_s3_download(size):
+    client = get_client('s3')
+    client.create_bucket(Bucket=NAME,
+        CreateBucketConfiguration={'LocationConstraint': client.meta.region_name})
+    for i in range(size):
+        client.put_object(Bucket=NAME, Key='data/{}.txt'.format(i),
+            Body=b'x' * 1024)
+    return {'dest_dir': tempfile.mkdtemp(prefix=NAME)}
+
+async def run_s3_download(size, state):
+    await S3Downloader(state['dest_dir'], NAME).download_all('data')
+
+CASES = {
+    # name: (setup, run, sizes)
+    'ec2-launch': (setup_launch, run_launch, FLEET_SIZES),
+    'ec2-shutdown': (setup_shutdown, run_shutdown, FLEET_SIZES),
+    'elb-all': (setup_elb_all, run_elb_all, FLEET_SIZES),
+    'sg-remove-instance-from-rules': (setup_sg_remove, run_sg_remove, FLEET_SIZES),
+    'sg-remove-instances-from-rules': (setup_sg_remove, run_sg_remove_batched,
+        FLEET_SIZES),
+    's3-download-all': (setup_s3_download, run_s3_download, OBJECT_COUNTS)
+}
+
+
+##
+## Running
+##
+
+async def run_case(name, size):
+    setup, run, _ = CASES[name]
+    logging.info("Running %s with size %s", name, size)
+    with mock_aws_backend() as counter:
+        state = await setup(size)
+        counter.reset()
+        tracemalloc.start()
+        t = time.perf_counter()
+        error = None
+        try:
+            await run(size, state)
+        except Exception as e:
+            logging.exception("%s (%s) failed", name, size)
+            error = str(e)
+        wall_time = time.perf_counter() - t
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {
+            'operation': name,
+            'size': size,
+            'wall_time_s': round(wall_time, 4),
+            'api_calls': counter.counts,
+            'total_api_calls': counter.total,
+            'peak_memory_bytes': peak_memory,
+            'error': error
+        }
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+async def run_all(operations, sizes):
+    results = []
+    for name in operations:
+        for size in (sizes or CASES[name][2]):
+            results.append(await run_case(name, size))
+    return results
+
+def output_results(results):
+    rows = [[r['operation'], r['size'], r['wall_time_s'], r['total_api_calls'],
+        round(r['peak_memory_bytes'] / 1024**2, 1), r['error'] or '']
+        for r in results]
+    print(tabulate.tabulate(rows, headers=['operation', 'size', 'wall time (s)',
+        'api calls', 'peak mem (MB)', 'error']))
+
+def compare(before_file, after_file):
+    with open(before_file) as f:
+        before = {(r['operation'], r['size']): r for r in json.load(f)['results']}
+    with open(after_file) as f:
+        after = {(r['operation'], r['size']): r for r in json.load(f)['results']}
+
+    def _pct(b, a):
+        return '{:+.1f}%'.format(100.0 * (a - b) / b) if b else 'n/a'
+
+    rows = []
+    for k in sorted(set(before).intersection(after)):
+        b, a = before[k], after[k]
+        rows.append(list(k) + [
+            b['wall_time_s'], a['wall_time_s'],
+            _pct(b['wall_time_s'], a['wall_time_s']),
+            b['total_api_calls'], a['total_api_calls'],
+            _pct(b['total_api_calls'], a['total_api_calls']),
+            _pct(b['peak_memory_bytes'], a['peak_memory_bytes'])
+        ])
+    print(tabulate.tabulate(rows, headers=['operation', 'size', 'time before',
+        'time after', 'time change', 'calls before', 'calls after',
+        'calls change', 'mem change']))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--operation', dest='operations',
+        action='append', default=[], choices=list(CASES),
+        help="operation to benchmark; default: all")
+    parser.add_argument('-s', '--size', dest='sizes', action='append',
+        type=int, default=[], help=("fleet size or object count; default: {}"
+        " for ec2 operations, {} for s3").format(FLEET_SIZES, OBJECT_COUNTS))
+    parser.add_argument('--output', help=("json file to write results to;"
+        " default: benchmarks/results/<commit>.json"))
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+        help="compare two results files, rather than running benchmarks")
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    commit = git_commit()
+    results = asyncio.run(run_all(args.operations or list(CASES), args.sizes))
+    output_results(results)
+
+    output_file = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'results',
+        '{}.json'.format(commit or 'local'))
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    with open(output_file, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'timestamp': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'results': results
+        }, f, indent=4)
+    print("\nWrote results to {}".format(output_file))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""simulate.py: Runs afaws fleet operations against simulated AWS and SSH
+backends with configurable latency, throttling, and eventual-consistency
+delays (see simulator.py), to benchmark fan-out, retry, and polling
+strategies deterministically.
+
+Example calls:
+ > python benchmarks/simulate.py -c ssh-execute -n 200 \\
+    --handshake-latency 0.5 --command-latency 0.2
+ > python benchmarks/simulate.py -c launch -n 50 --api-latency 0.1 \\
+    --instance-visibility-delay 2 --tag-visibility-delay 2
+ > python benchmarks/simulate.py -c wait-for-ip -n 100 --ip-assignment-delay 15
+ > python benchmarks/simulate.py -c shutdown -n 100 --rate-limit 20
+ > python benchmarks/simulate.py -c ssh-execute -c ssm-execute -n 200 \\
+    --handshake-latency 0.5 --api-latency 0.1 --ssm-delivery-latency 1
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tabulate
+
+from afaws.config import Config
+from afaws.ec2.execute import Ec2SshExecuter, Ec2SsmExecuter
+from afaws.ec2.initialization import InstanceInitializerSsh
+from afaws.ec2.resources import Instance
+from afaws.ec2.shutdown import Ec2Shutdown
+
+import run as bench
+from simulator import AwsSimulator, FakeSshServerPool, simulated_environment
+
+SSH_KEY = '/dev/null'
+
+##
+## Scenarios
+##
+
+async def setup_instances(size):
+    sg_id = bench._create_security_group()
+    return {'instance_ids': bench._run_instances(size, sg_id)}
+
+async def run_ssh_execute(size, state):
+    executer = Ec2SshExecuter(SSH_KEY, state['instance_ids'])
+    await executer.execute(['uptime', 'df -h /'])
+
+async def run_ssm_execute(size, state):
+    executer = Ec2SsmExecuter(state['instance_ids'])
+    await executer.execute(['uptime', 'df -h /'])
+
+async def run_initialize(size, state):
+    config = Config({
+        'iam_instance_profile': {'Name': bench.NAME},
+        'docker_compose_yaml_root_dirs': ['/srv/'],
+        'makefile_root_dirs': ['/srv/']
+    })
+    await InstanceInitializerSsh(SSH_KEY, config).initialize(
+        state['instance_ids'])
+
+async def run_wait_for_ip(size, state):
+    instances = await Instance.find_many(state['instance_ids'])
+    await asyncio.gather(*[Instance.wait_for_ip_address(i) for i in instances])
+
+async def run_shutdown(size, state):
+    await Ec2Shutdown().shutdown(state['instance_ids'], terminate=True,
+        wait=True)
+
+SCENARIOS = {
+    # name: (setup, run)
+    'ssh-execute': (setup_instances, run_ssh_execute),
+    'ssm-execute': (setup_instances, run_ssm_execute),
+    'initialize': (setup_instances, run_initialize),
+    'launch': (bench.setup_launch, bench.run_launch),
+    'wait-for-ip': (setup_instances, run_wait_for_ip),
+    'shutdown': (bench.setup_shutdown, bench.run_shutdown)
+}
+
+
+##
+## Running
+##
+
+async def run_scenario(name, size, aws, ssh, ssm_delivery_latency=0.0):
+    setup, run = SCENARIOS[name]
+    with simulated_environment(aws, ssh,
+            ssm_delivery_latency=ssm_delivery_latency) as (counter, aws, ssh):
+        state = await setup(size)
+        counter.reset()
+        t = time.perf_counter()
+        error = None
+        try:
+            await run(size, state)
+        except Exception as e:
+            logging.exception("%s (%s) failed", name, size)
+            error = str(e)
+        return {
+            'scenario': name,
+            'size': size,
+            'wall_time_s': round(time.perf_counter() - t, 4),
+            'api_calls': counter.counts,
+            'total_api_calls': counter.total,
+            'throttled_api_calls': aws.throttled,
+            'ssh_connections': ssh.num_connections,
+            'error': error
+        }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--scenario', dest='scenarios', action='append',
+        default=[], choices=list(SCENARIOS), help="default: all")
+    parser.add_argument('-n', '--num-hosts', dest='sizes', action='append',
+        type=int, default=[], help="default: 100")
+    aws = parser.add_argument_group('AWS simulation')
+    aws.add_argument('--api-latency', type=float, default=0.0)
+    aws.add_argument('--jitter', type=float, default=0.0)
+    aws.add_argument('--rate-limit', type=float,
+        help="calls per second allowed per API operation")
+    aws.add_argument('--burst', type=float)
+    aws.add_argument('--instance-visibility-delay', type=float, default=0.0)
+    aws.add_argument('--tag-visibility-delay', type=float, default=0.0)
+    aws.add_argument('--ip-assignment-delay', type=float, default=0.0)
+    ssh = parser.add_argument_group('SSH simulation')
+    ssh.add_argument('--handshake-latency', type=float, default=0.0)
+    ssh.add_argument('--command-latency', type=float, default=0.0)
+    ssh.add_argument('--transfer-latency', type=float, default=0.0)
+    ssh.add_argument('--boot-delay', type=float, default=0.0)
+    ssh.add_argument('--connect-timeout', type=float, default=0.0)
+    ssm = parser.add_argument_group('SSM simulation')
+    ssm.add_argument('--ssm-delivery-latency', type=float, default=0.0,
+        help="seconds between sending commands and their running")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="json file to write results to")
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    results = []
+    for name in (args.scenarios or list(SCENARIOS)):
+        for size in (args.sizes or [100]):
+            # new simulators for each run, so that state doesn't carry over
+            aws = AwsSimulator(api_latency=args.api_latency, jitter=args.jitter,
+                rate_limit=args.rate_limit, burst=args.burst,
+                instance_visibility_delay=args.instance_visibility_delay,
+                tag_visibility_delay=args.tag_visibility_delay,
+                ip_assignment_delay=args.ip_assignment_delay, seed=args.seed)
+            ssh = FakeSshServerPool(handshake_latency=args.handshake_latency,
+                command_latency=args.command_latency,
+                transfer_latency=args.transfer_latency,
+                boot_delay=args.boot_delay,
+                connect_timeout=args.connect_timeout, seed=args.seed)
+            results.append(asyncio.run(run_scenario(name, size, aws, ssh,
+                ssm_delivery_latency=args.ssm_delivery_latency)))
+
+    rows = [[r['scenario'], r['size'], r['wall_time_s'], r['total_api_calls'],
+        r['throttled_api_calls'], r['ssh_connections'], r['error'] or '']
+        for r in results]
+    print(tabulate.tabulate(rows, headers=['scenario', 'hosts', 'wall time (s)',
+        'api calls', 'throttled', 'ssh connections', 'error']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,552 @@
+"""Latency-injecting AWS and SSH simulation, for testing and benchmarking
+concurrency (fan-out, retries, polling) with realistic per-call latency and
+hundreds of hosts, without real infrastructure.
+
+ - AwsSimulator adds configurable API latency, throttling, and
+   eventual-consistency delays to the moto-backed AWS stand-in, by hooking
+   into botocore events on afaws' shared session.
+ - FakeSshServerPool is an in-process pool of fake ssh hosts, with
+   configurable handshake and command latencies and boot delays. It
+   replaces fabric's Connection, which is what SshClient uses, so that
+   Ec2SshExecuter, InstanceInitializerSsh, etc. run against it unmodified.
+ - FakeSsmService stands in for SSM Run Command, running scripts sent with
+   SendCommand on the fake ssh hosts, so that Ec2SsmExecuter and
+   InstanceInitializerSsm run against the same hosts.
+
+> with simulated_environment(AwsSimulator(api_latency=0.1),
+>         FakeSshServerPool(handshake_latency=0.5)) as (counter, aws, ssh):
+>     await Ec2SshExecuter('key', instance_ids).execute('uptime')
+
+All randomness (jitter, boot ids) is seeded, so that runs are repeatable.
+"""
+
+import contextlib
+import io
+import random
+import re
+import tarfile
+import threading
+import time
+import uuid
+
+from afaws import session
+
+from mockaws import mock_aws_backend
+
+__all__ = [
+    'AwsSimulator',
+    'FakeSshServerPool',
+    'FakeSsmService',
+    'simulated_environment'
+]
+
+
+##
+## AWS
+##
+
+class _ErrorResponse(object):
+    """Stands in for the http response in short-circuited calls; botocore
+    raises ClientError for any status >= 300
+    """
+    status_code = 400
+
+class _TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst,
+            self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+class AwsSimulator(object):
+
+    THROTTLING_ERROR_CODES = {
+        'ec2': 'RequestLimitExceeded'
+    }
+    DEFAULT_THROTTLING_ERROR_CODE = 'Throttling'
+
+    def __init__(self, api_latency=0.0, jitter=0.0, latencies=None,
+            rate_limit=None, burst=None, rate_limits=None,
+            instance_visibility_delay=0.0, tag_visibility_delay=0.0,
+            ip_assignment_delay=0.0, seed=0):
+        """
+        kwargs
+         - api_latency -- seconds added to every API call
+         - jitter -- maximum random seconds added to api_latency
+         - latencies -- dict of latencies overriding api_latency, keyed by
+            '<service>.<Operation>' (e.g. 'ec2.DescribeInstances')
+         - rate_limit -- calls per second allowed per API operation, beyond
+            which calls fail with the service's throttling error
+         - burst -- token bucket size for rate limits; defaults to rate limit
+         - rate_limits -- dict of rate limits overriding rate_limit, keyed
+            like latencies
+         - instance_visibility_delay -- seconds after launch during which
+            new instances are missing from DescribeInstances and can't be
+            tagged (InvalidInstanceID.NotFound)
+         - tag_visibility_delay -- seconds after tagging during which new
+            tags are missing from DescribeInstances
+         - ip_assignment_delay -- seconds after launch during which
+            instances don't have public ip addresses
+        """
+        self._api_latency = api_latency
+        self._jitter = jitter
+        self._latencies = latencies or {}
+        self._rate_limit = rate_limit
+        self._burst = burst
+        self._rate_limits = rate_limits or {}
+        self._instance_visibility_delay = instance_visibility_delay
+        self._tag_visibility_delay = tag_visibility_delay
+        self._ip_assignment_delay = ip_assignment_delay
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._instance_launch_times = {}
+        self._tag_times = {}
+        self.throttled = 0
+
+    def register(self, events):
+        events.register('before-call', self._before_call)
+        events.register('after-call.ec2.RunInstances', self._after_run_instances)
+        events.register('after-call.ec2.CreateTags', self._after_create_tags)
+        events.register('after-call.ec2.DescribeInstances',
+            self._after_describe_instances)
+
+    ## Latency and throttling
+
+    def _before_call(self, model, params, context, **kwargs):
+        op = '{}.{}'.format(model.service_model.service_name, model.name)
+        # stash params for after-call handlers, which aren't passed them
+        context['afaws_sim_params'] = params
+
+        latency = self._latencies.get(op, self._api_latency)
+        with self._lock:
+            latency += self._random.uniform(0, self._jitter)
+        if latency:
+            # Calls are made in executor threads, so this blocks like a
+            # real network call would
+            time.sleep(latency)
+
+        if self._is_throttled(op):
+            code = self.THROTTLING_ERROR_CODES.get(
+                model.service_model.service_name,
+                self.DEFAULT_THROTTLING_ERROR_CODE)
+            return self._error(code, "Rate exceeded")
+
+        if model.name == 'CreateTags' and self._instance_visibility_delay:
+            for r in params.get('Resources', []):
+                if self._is_invisible(r):
+                    return self._error('InvalidInstanceID.NotFound',
+                        "The instance ID '{}' does not exist".format(r))
+
+    def _is_throttled(self, op):
+        rate = self._rate_limits.get(op, self._rate_limit)
+        if not rate:
+            return False
+        with self._lock:
+            if op not in self._buckets:
+                self._buckets[op] = _TokenBucket(rate, self._burst or rate)
+            if self._buckets[op].take():
+                return False
+            self.throttled += 1
+            return True
+
+    def _error(self, code, msg):
+        return (_ErrorResponse(), {
+            'Error': {'Code': code, 'Message': msg},
+            'ResponseMetadata': {'HTTPStatusCode': _ErrorResponse.status_code}
+        })
+
+    ## Eventual consistency
+
+    def _after_run_instances(self, parsed, **kwargs):
+        now = time.monotonic()
+        with self._lock:
+            for i in parsed.get('Instances', []):
+                self._instance_launch_times[i['InstanceId']] = now
+
+    def _after_create_tags(self, http_response, context, **kwargs):
+        if http_response.status_code >= 300:
+            # after-call is emitted even for failed calls
+            return
+        params = context.get('afaws_sim_params', {})
+        now = time.monotonic()
+        with self._lock:
+            for r in params.get('Resources', []):
+                for t in params.get('Tags', []):
+                    self._tag_times[(r, t['Key'])] = now
+
+    def _age(self, instance_id):
+        launched = self._instance_launch_times.get(instance_id)
+        return None if launched is None else time.monotonic() - launched
+
+    def _is_invisible(self, instance_id):
+        age = self._age(instance_id)
+        return age is not None and age < self._instance_visibility_delay
+
+    def _after_describe_instances(self, parsed, context, **kwargs):
+        params = context.get('afaws_sim_params', {})
+        tag_filter_keys = [f['Name'][4:] for f in params.get('Filters', [])
+            if f['Name'].startswith('tag:')]
+        now = time.monotonic()
+
+        for r in parsed.get('Reservations', []):
+            instances = []
+            for i in r['Instances']:
+                if self._is_invisible(i['InstanceId']):
+                    continue
+
+                hidden_keys = set(t['Key'] for t in i.get('Tags', [])
+                    if now - self._tag_times.get((i['InstanceId'], t['Key']),
+                        -float('inf')) < self._tag_visibility_delay)
+                if hidden_keys.intersection(tag_filter_keys):
+                    # wouldn't have matched the filter
+                    continue
+                if hidden_keys:
+                    i['Tags'] = [t for t in i['Tags']
+                        if t['Key'] not in hidden_keys]
+
+                age = self._age(i['InstanceId'])
+                if age is not None and age < self._ip_assignment_delay:
+                    i.pop('PublicIpAddress', None)
+                    i.pop('PublicDnsName', None)
+
+                instances.append(i)
+            r['Instances'] = instances
+
+        parsed['Reservations'] = [r for r in parsed.get('Reservations', [])
+            if r['Instances']]
+
+
+##
+## SSH
+##
+
+def _result(cmd, stdout='', stderr='', return_code=0):
+    from invoke.runners import Result
+    return Result(stdout=stdout, stderr=stderr, exited=return_code,
+        command=cmd, hide=('stdout', 'stderr'))
+
+class FakeSshHost(object):
+
+    def __init__(self, ip, pool):
+        self.ip = ip
+        self._pool = pool
+        self._first_contact = None
+        self.boot_id = str(uuid.UUID(int=pool._random.getrandbits(128)))
+        self.commands = []
+
+    def connect(self):
+        if self._first_contact is None:
+            self._first_contact = time.monotonic()
+        if time.monotonic() - self._first_contact < self._pool.boot_delay:
+            time.sleep(self._pool.connect_timeout)
+            import paramiko.ssh_exception
+            raise paramiko.ssh_exception.NoValidConnectionsError(
+                {(self.ip, 22): OSError("Connection refused")})
+        time.sleep(self._pool.handshake_latency)
+
+    def run(self, cmd):
+        time.sleep(self._pool.command_latency)
+        with self._pool._lock:
+            self.commands.append(cmd)
+        for pattern, response in self._pool.responses:
+            if re.search(pattern, cmd):
+                r = response(self, cmd) if callable(response) else response
+                if isinstance(r, str):
+                    r = (r, '', 0)
+                return _result(cmd, *r)
+        return _result(cmd)
+
+class _FakeChannel(object):
+
+    def __init__(self, host):
+        self._host = host
+
+    def shutdown_write(self):
+        pass
+
+    def recv_exit_status(self):
+        return 0
+
+class _FakeChannelFile(io.BytesIO):
+
+    def __init__(self, host, initial_bytes=b''):
+        super().__init__(initial_bytes)
+        self.channel = _FakeChannel(host)
+
+class _FakeParamikoClient(object):
+    """Supports exec_command, as used by SshClient's tar streaming
+    """
+
+    def __init__(self, host):
+        self._host = host
+
+    def exec_command(self, cmd):
+        self._host.run(cmd)
+        stdout = b''
+        if cmd.startswith('tar -c'):
+            # respond with empty archive
+            buf = io.BytesIO()
+            mode = 'w:gz' if cmd.startswith('tar -cz') else 'w'
+            tarfile.open(fileobj=buf, mode=mode).close()
+            stdout = buf.getvalue()
+        return (_FakeChannelFile(self._host), _FakeChannelFile(self._host, stdout),
+            _FakeChannelFile(self._host))
+
+class FakeSshServerPool(object):
+
+    def __init__(self, handshake_latency=0.0, command_latency=0.0,
+            transfer_latency=0.0, boot_delay=0.0, connect_timeout=0.0,
+            responses=None, seed=0):
+        """
+        kwargs
+         - handshake_latency -- seconds to establish each connection
+         - command_latency -- seconds to run each command
+         - transfer_latency -- seconds for each file put/get
+         - boot_delay -- seconds after first contact during which a host
+            refuses connections
+         - connect_timeout -- seconds each refused connection attempt takes
+         - responses -- list of (regex, response) tuples, where response is
+            stdout string, (stdout, stderr, return_code) tuple, or function
+            taking host and command and returning either of those
+        """
+        self.handshake_latency = handshake_latency
+        self.command_latency = command_latency
+        self.transfer_latency = transfer_latency
+        self.boot_delay = boot_delay
+        self.connect_timeout = connect_timeout
+        self.responses = list(responses or []) + [
+            (r'boot_id', lambda host, cmd: host.boot_id)
+        ]
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.hosts = {}
+        self.num_connections = 0
+
+    def host(self, ip):
+        with self._lock:
+            if ip not in self.hosts:
+                self.hosts[ip] = FakeSshHost(ip, self)
+            return self.hosts[ip]
+
+    def connection_class(self):
+        pool = self
+
+        class FakeConnection(object):
+            """Stands in for fabric.connection.Connection
+            """
+
+            def __init__(self, host, user=None, connect_kwargs=None, **kwargs):
+                self.host = host
+                self._host = pool.host(host)
+                self.client = None
+
+            @property
+            def is_connected(self):
+                return self.client is not None
+
+            def open(self):
+                if self.client is None:
+                    self._host.connect()
+                    with pool._lock:
+                        pool.num_connections += 1
+                    self.client = _FakeParamikoClient(self._host)
+
+            def run(self, cmd, hide=False, warn=False, **kwargs):
+                self.open()
+                result = self._host.run(cmd)
+                if result.return_code != 0 and not warn:
+                    from invoke.exceptions import UnexpectedExit
+                    raise UnexpectedExit(result)
+                return result
+
+            def put(self, local, remote=None, **kwargs):
+                self.open()
+                time.sleep(pool.transfer_latency)
+
+            def get(self, remote, local=None, **kwargs):
+                self.open()
+                time.sleep(pool.transfer_latency)
+
+            def close(self):
+                self.client = None
+
+        return FakeConnection
+
+    @contextlib.contextmanager
+    def install(self):
+        """Replaces fabric's Connection with fake connections to this pool
+        """
+        import fabric.connection
+        original = fabric.connection.Connection
+        fabric.connection.Connection = self.connection_class()
+        try:
+            yield self
+        finally:
+            fabric.connection.Connection = original
+
+
+##
+## SSM
+##
+
+class _SuccessResponse(object):
+    """Stands in for the http response in short-circuited calls
+    """
+    status_code = 200
+
+class _FakeInvocation(object):
+
+    def __init__(self, command_id, instance_id, host):
+        self.command_id = command_id
+        self.instance_id = instance_id
+        self.host = host
+        self.status = 'InProgress'
+        self.stdout = ''
+        self.stderr = ''
+
+class FakeSsmService(object):
+    """Handles SSM SendCommand, ListCommandInvocations, and
+    DescribeInstanceInformation calls by short-circuiting them in
+    'before-call' handlers, after the AWS simulator's latency and
+    throttling are applied. Scripts sent with SendCommand run, line by line,
+    on the hosts of the fake ssh server pool with the instances' public ips.
+    """
+
+    # SSM truncates output returned by ListCommandInvocations
+    MAX_OUTPUT_LENGTH = 2500
+    ERROR_SEPARATOR = '\n----------ERROR-------\n'
+
+    def __init__(self, ssh, delivery_latency=0.0, offline_instance_ids=None):
+        """
+        kwargs
+         - delivery_latency -- seconds between SendCommand and scripts
+            starting to run
+         - offline_instance_ids -- instances whose SSM agents aren't online
+        """
+        self._ssh = ssh
+        self._delivery_latency = delivery_latency
+        self._offline_instance_ids = set(offline_instance_ids or [])
+        self._lock = threading.Lock()
+        self._invocations = {}
+        self.num_commands = 0
+
+    def register(self, events):
+        # Registered for all operations, rather than for the three handled,
+        # so that it's called after the call counter and AWS simulator
+        events.register('before-call', self._before_call)
+
+    def _before_call(self, model, params, **kwargs):
+        if model.service_model.service_name != 'ssm':
+            return
+        handler = getattr(self, '_' + re.sub(r'(?<!^)([A-Z])', r'_\1',
+            model.name).lower(), None)
+        if handler:
+            return (_SuccessResponse(), handler(params,
+                kwargs['request_signer'].region_name))
+
+    def _ips(self, instance_ids, region):
+        ec2 = session.get_client('ec2', None, region)
+        return {i['InstanceId']: i.get('PublicIpAddress')
+            for r in ec2.describe_instances(InstanceIds=instance_ids)['Reservations']
+            for i in r['Instances']}
+
+    ## Operations
+
+    def _describe_instance_information(self, params, region):
+        instance_ids = [v for f in params.get('Filters', [])
+            if f['Key'] == 'InstanceIds' for v in f['Values']]
+        return {'InstanceInformationList': [
+            {'InstanceId': i, 'PingStatus': 'Online'} for i in instance_ids
+            if i not in self._offline_instance_ids
+        ]}
+
+    def _send_command(self, params, region):
+        command_id = str(uuid.uuid4())
+        lines = params['Parameters']['commands']
+        ips = self._ips(params['InstanceIds'], region)
+        with self._lock:
+            self.num_commands += 1
+            self._invocations[command_id] = [
+                _FakeInvocation(command_id, i, self._ssh.host(ips[i]))
+                for i in params['InstanceIds']]
+            invocations = list(self._invocations[command_id])
+        for invocation in invocations:
+            threading.Thread(target=self._run, args=(invocation, lines),
+                daemon=True).start()
+        return {'Command': {'CommandId': command_id,
+            'InstanceIds': params['InstanceIds'], 'Status': 'Pending'}}
+
+    def _list_command_invocations(self, params, region):
+        with self._lock:
+            invocations = list(self._invocations.get(params['CommandId'], []))
+        return {'CommandInvocations': [self._invocation_response(i)
+            for i in invocations]}
+
+    def _invocation_response(self, invocation):
+        output = invocation.stdout
+        if invocation.stderr:
+            output += self.ERROR_SEPARATOR + invocation.stderr
+        return {
+            'CommandId': invocation.command_id,
+            'InstanceId': invocation.instance_id,
+            'Status': invocation.status,
+            'StatusDetails': invocation.status,
+            'CommandPlugins': [{
+                'Name': 'aws:runShellScript',
+                'Status': invocation.status,
+                'Output': output[:self.MAX_OUTPUT_LENGTH]
+            }]
+        }
+
+    ## Execution
+
+    def _run(self, invocation, lines):
+        time.sleep(self._delivery_latency)
+        exit_on_error = False
+        status = 'Success'
+        for line in lines:
+            echo = re.match(r"^echo '(.*)'( >&2)?$", line)
+            if line == 'set -e':
+                exit_on_error = True
+            elif echo:
+                stream = 'stderr' if echo.group(2) else 'stdout'
+                setattr(invocation, stream,
+                    getattr(invocation, stream) + echo.group(1) + '\n')
+            else:
+                result = invocation.host.run(line)
+                invocation.stdout += result.stdout
+                invocation.stderr += result.stderr
+                if result.return_code != 0:
+                    status = 'Failed'
+                    if exit_on_error:
+                        break
+        invocation.status = status
+
+
+@contextlib.contextmanager
+def simulated_environment(aws=None, ssh=None, ssm_delivery_latency=0.0):
+    """Starts mocked AWS backend, with aws simulator and fake SSM service
+    registered, and installs fake ssh server pool. Yields (api call counter,
+    aws simulator, ssh pool)
+    """
+    aws = aws or AwsSimulator()
+    ssh = ssh or FakeSshServerPool()
+    with mock_aws_backend() as counter:
+        aws.register(session.get_session().events)
+        FakeSsmService(ssh, delivery_latency=ssm_delivery_latency).register(
+            session.get_session().events)
+        with ssh.install():
+            yield counter, aws, ssh
@@ -14,14 +14,21 @@ setup(
     author_email='jdubowy@gmail.com',
     packages=find_packages(),
     scripts=[
+        'bin/afaws-daemon',
+        'bin/afaws-run',
+        'bin/ec2-auto-shutdown',
         'bin/ec2-execute',
+        'bin/ec2-facts',
         'bin/ec2-initialize',
         'bin/ec2-launch',
+        'bin/ec2-map',
         'bin/ec2-network',
+        'bin/ec2-reconcile',
         'bin/ec2-reboot',
         'bin/ec2-resources',
         'bin/ec2-shutdown',
         'bin/elb-manage',
+        'bin/s3-distribute',
         'bin/s3-download',
     ],
     classifiers=[